@@ -0,0 +1,183 @@
+"""
+Admission control for the routes hit by everyone at once when a week opens.
+At most `max_concurrent` guarded requests run at the same time. The others
+get a ticket in a FIFO waiting room and poll their position; when capacity
+frees up the head of the queue gets a pass, and requests with a pass go in
+ahead of new arrivals. State is per process.
+"""
+
+import time
+import uuid
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Optional
+
+
+@dataclass
+class Decision:
+    """Outcome of `AdmissionController.enter` or `status`"""
+    entered: bool
+    ticket: Optional[str] = None
+    pass_token: Optional[str] = None
+    position: Optional[int] = None
+    eta_seconds: Optional[int] = None
+
+
+class AdmissionController:
+    """
+    Concurrency budget with a waiting room.
+
+    A request enters if it holds a valid pass and a slot is free, or if
+    nobody is waiting and a slot is free. Otherwise it is queued under its
+    ticket (the same ticket keeps its place). A pass holder finding every
+    slot busy is sent back to the waiting room at the head of the line,
+    keeping the pass: requests never wait for a slot inside their thread.
+    Tickets not seen for `ticket_timeout` seconds are dropped.
+
+    A pass lasts `pass_seconds`, so the calendar render and the registration
+    that follows go in without queueing again. Passes not used within
+    `ticket_timeout` seconds stop reserving their slot.
+    """
+
+    def __init__(self, max_concurrent, pass_seconds=120, ticket_timeout=30):
+        """
+        Initialize the controller.
+
+        Args:
+            max_concurrent: Guarded requests running at the same time (0 = no limit)
+            pass_seconds: Validity of a pass given to an admitted ticket
+            ticket_timeout: Seconds after which an unpolled ticket or unused pass expires
+        """
+        self.max_concurrent = max_concurrent
+        self.pass_seconds = pass_seconds
+        self.ticket_timeout = ticket_timeout
+        self._lock = threading.Lock()
+        self._active = 0
+        # ticket -> last seen
+        self._queue = OrderedDict()
+        # ticket -> pass token, for admitted tickets that have not come back yet
+        self._admitted = {}
+        # pass token -> {'expires', 'claim_by', 'used'}
+        self._passes = {}
+        # Moving average of the duration of a guarded request
+        self._avg_seconds = 0.2
+        self.entered = 0
+        self.queued = 0
+        self.admitted = 0
+        self.expired = 0
+        self.bounced = 0
+
+    @property
+    def enabled(self):
+        return self.max_concurrent > 0
+
+    # Internal state (called with the lock held)
+
+    def _expire(self, now):
+        for ticket, last_seen in list(self._queue.items()):
+            if now - last_seen > self.ticket_timeout:
+                del self._queue[ticket]
+                self.expired += 1
+        for token, entry in list(self._passes.items()):
+            if now >= entry['expires'] or (not entry['used'] and now >= entry['claim_by']):
+                del self._passes[token]
+        for ticket, token in list(self._admitted.items()):
+            if token not in self._passes:
+                del self._admitted[ticket]
+
+    def _reserved(self):
+        return sum(1 for entry in self._passes.values() if not entry['used'])
+
+    def _admit_waiting(self, now):
+        """Give passes to the head of the queue while slots are free"""
+        while self._queue and self._active + self._reserved() < self.max_concurrent:
+            ticket, _ = self._queue.popitem(last=False)
+            token = uuid.uuid4().hex
+            self._passes[token] = {'expires': now + self.pass_seconds,
+                                   'claim_by': now + self.ticket_timeout, 'used': False}
+            self._admitted[ticket] = token
+            self.admitted += 1
+
+    def _waiting(self, ticket, now):
+        if ticket not in self._queue:
+            ticket = uuid.uuid4().hex
+            self.queued += 1
+        self._queue[ticket] = now
+        position = list(self._queue).index(ticket) + 1
+        return Decision(False, ticket=ticket, position=position, eta_seconds=self._eta(position))
+
+    def _eta(self, position):
+        return max(1, round(position * self._avg_seconds / self.max_concurrent))
+
+    # Public API
+
+    def enter(self, ticket=None, pass_token=None):
+        """
+        Try to start a guarded request with the caller's ticket and pass.
+        On success the caller must call `leave` when the request is done.
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._expire(now)
+            self._admit_waiting(now)
+
+            # Ticket admitted since the last poll: it becomes the pass
+            if ticket in self._admitted:
+                pass_token = self._admitted.pop(ticket)
+
+            entry = self._passes.get(pass_token)
+            if entry is not None:
+                if self._active < self.max_concurrent:
+                    entry['used'] = True
+                    self._active += 1
+                    self.entered += 1
+                    return Decision(True, pass_token=pass_token)
+                # All slots busy: retry from the waiting room, still ahead of the queue
+                self.bounced += 1
+                return Decision(False, pass_token=pass_token, position=1, eta_seconds=self._eta(1))
+
+            if not self._queue and self._active + self._reserved() < self.max_concurrent:
+                self._active += 1
+                self.entered += 1
+                return Decision(True)
+
+            return self._waiting(ticket, now)
+
+    def leave(self, duration):
+        """End a guarded request that took `duration` seconds"""
+        with self._lock:
+            self._active -= 1
+            self._avg_seconds = 0.8 * self._avg_seconds + 0.2 * duration
+            self._admit_waiting(time.monotonic())
+
+    def status(self, ticket):
+        """
+        Position of a waiting ticket (refreshing it), or entered=True with the
+        pass if it has been admitted or is no longer queued (the caller retries).
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._expire(now)
+            self._admit_waiting(now)
+            if ticket in self._admitted:
+                return Decision(True, pass_token=self._admitted.pop(ticket))
+            if ticket not in self._queue:
+                return Decision(True)
+            return self._waiting(ticket, now)
+
+    def stats(self):
+        """Return current load and counters"""
+        with self._lock:
+            return {
+                'max_concurrent': self.max_concurrent,
+                'active': self._active,
+                'waiting': len(self._queue),
+                'passes': len(self._passes),
+                'avg_seconds': round(self._avg_seconds, 3),
+                'entered': self.entered,
+                'queued': self.queued,
+                'admitted': self.admitted,
+                'expired': self.expired,
+                'bounced': self.bounced
+            }
@@ -0,0 +1,53 @@
+"""
+Lottery allocation of oversubscribed weeks.
+While a week's allocation window is open, registrations are stored as
+preferences. When the window closes, `allocate` turns them into
+registrations in one pass: users take turns in a random order that
+reverses every round (snake draft), each taking their next preferred event
+that still has a free slot, until the slots, the preferences or the
+per-user limits run out.
+"""
+
+import random
+
+
+def allocate(preferences, capacity, limit=0, existing=None, seed=None):
+    """
+    Assign slots from preferences.
+
+    Args:
+        preferences: {user: [event_id, ...]} in the user's order of preference
+        capacity: {event_id: free slots}; events missing here are not assigned
+        limit: Maximum events per user in the week, existing ones included (0 = no limit)
+        existing: {user: set of event_ids} the user is already registered to
+        seed: Seed of the random turn order (stored, so a run can be reproduced)
+
+    Returns [(event_id, user)] in assignment order.
+    """
+    existing = existing or {}
+    free = dict(capacity)
+    remaining = {user: list(events) for user, events in preferences.items() if events}
+    taken = {user: set(existing.get(user, ())) for user in remaining}
+
+    order = sorted(remaining)
+    random.Random(seed).shuffle(order)
+
+    assignments = []
+    while order:
+        next_order = []
+        for user in order:
+            if limit and len(taken[user]) >= limit:
+                continue
+            wanted = remaining[user]
+            while wanted:
+                event_id = wanted.pop(0)
+                if event_id not in taken[user] and free.get(event_id, 0) > 0:
+                    free[event_id] -= 1
+                    taken[user].add(event_id)
+                    assignments.append((event_id, user))
+                    break
+            if wanted and not (limit and len(taken[user]) >= limit):
+                next_order.append(user)
+        # Snake draft: whoever picked last in this round picks first in the next one
+        order = next_order[::-1]
+    return assignments
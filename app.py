@@ -1,4 +1,4 @@
-from flask import Flask, render_template, request, redirect, url_for, session, make_response, flash, g, jsonify
+from flask import Flask, render_template, request, redirect, url_for, session, make_response, flash, g, jsonify, has_request_context
 from icalendar import Calendar, Event, Alarm
 import sqlite3
 import os
@@ -6,13 +6,29 @@ import csv
 import io
 import json
 import time
+import uuid
+import random
 import logging
 from authlib.integrations.flask_client import OAuth
 from dotenv import load_dotenv
 from datetime import datetime, timedelta
 from functools import wraps
-from flask_socketio import SocketIO, emit 
-from notifications import NotificationManager
+from collections import Counter
+from dataclasses import replace
+from flask_socketio import SocketIO, emit, join_room, leave_room, rooms
+from email_fallback import email_fallback_from_env
+from job_queue import JobQueue
+from leader_election import LeaderElection
+from live_updates import LiveUpdates, FULL_ROOM, COMPACT_ROOM, COMPACT_KEYS
+from http_cache import DataVersions, ETagStore, SingleFlight
+from idempotency import IdempotencyStore, PENDING
+from admission import AdmissionController
+from allocation import allocate
+from read_model import ReadModel
+from models import LogEntry, EventView, ParticipantEvent, fetch_all
+from queries import run, run_many
+from retention import retention_from_env
+from notifications import NotificationManager, load_user_preferences, parse_reminder_offset, MAX_REMINDER_OFFSETS
 
 # -------------------------------
 # Helper Functions
@@ -61,6 +77,14 @@ def compute_week_day_dates(pool_start_str, week_number):
     except Exception:
         return {}
 
+def note_page_valid_until(moment):
+    """Segnala che la pagina in costruzione cambia a `moment`: il suo ETag scade lì"""
+    if not has_request_context():
+        return
+    current = g.get('etag_valid_until')
+    if current is None or moment < current:
+        g.etag_valid_until = moment
+
 def is_event_passed(event_date, end_time):
     """Controlla se un evento è già passato usando la data completa"""
     # Se non c'è una data, non bloccare (per retrocompatibilità)
@@ -79,6 +103,10 @@ def is_event_passed(event_date, end_time):
         # Crea datetime completo dell'evento
         event_end = event_date_obj.replace(hour=end_h, minute=end_m, second=0, microsecond=0)
         
+        # La pagina che mostra l'evento cambia quando l'evento diventa passato
+        if now <= event_end:
+            note_page_valid_until(event_end)
+        
         # Ritorna True se l'evento è passato
         return now > event_end
     except:
@@ -90,34 +118,29 @@ def auto_update_display_week():
     - Se tutti gli eventi della settimana corrente del display sono passati, 
       passa alla settimana successiva (se esiste e ha eventi)
     - Questo permette la transizione automatica tra settimane
-    """
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
     
+    Il controllo usa il read model: il database viene aperto solo per il cambio di settimana.
+    """
     try:
+        state = read_model.snapshot()
+        
         # Ottieni display_week corrente
-        c.execute("SELECT value FROM settings WHERE key = 'display_week'")
-        display_week_row = c.fetchone()
-        if not display_week_row:
+        if state.setting('display_week') is None:
             return
-        display_week = int(display_week_row[0])
+        display_week = state.int_setting('display_week')
         
         # Ottieni pool_start per calcolare le date
-        c.execute("SELECT value FROM settings WHERE key = 'pool_start'")
-        pool_start_row = c.fetchone()
-        if not pool_start_row:
+        pool_start = state.setting('pool_start')
+        if pool_start is None:
             return
-        pool_start = pool_start_row[0]
         
         # Ottieni tutti gli eventi della settimana corrente del display
-        c.execute("SELECT id, day, start_time, end_time, event_date FROM events WHERE week = ?", (display_week,))
-        events = c.fetchall()
+        events = state.week_events(display_week)
         
         if not events:
             # Nessun evento, prova con la settimana successiva
             if display_week < 4:
-                c.execute("UPDATE settings SET value = ? WHERE key = 'display_week'", (str(display_week + 1),))
-                conn.commit()
+                set_display_week(display_week + 1)
             return
         
         # Calcola le date per questa settimana
@@ -126,12 +149,10 @@ def auto_update_display_week():
         # Controlla se tutti gli eventi sono passati
         all_passed = True
         for event in events:
-            event_id, day, start_time, end_time, event_date = event
-            
             # Usa event_date se disponibile, altrimenti calcola da day_dates
-            concrete_date = event_date if event_date else day_dates.get(day)
+            concrete_date = event.concrete_date(day_dates)
             
-            if concrete_date and not is_event_passed(concrete_date, end_time):
+            if concrete_date and not is_event_passed(concrete_date, event.end_time):
                 all_passed = False
                 break
         
@@ -140,18 +161,38 @@ def auto_update_display_week():
             new_display_week = display_week + 1
             
             # Verifica che la nuova settimana abbia eventi
-            c.execute("SELECT COUNT(*) FROM events WHERE week = ?", (new_display_week,))
-            count = c.fetchone()[0]
-            
-            if count > 0:
-                c.execute("UPDATE settings SET value = ? WHERE key = 'display_week'", (str(new_display_week),))
-                conn.commit()
+            if state.week_events(new_display_week):
+                set_display_week(new_display_week)
                 app.logger.info(f"Display automaticamente aggiornato da Week {display_week} a Week {new_display_week}")
     
     except Exception as e:
         app.logger.warning(f"Errore nell'aggiornamento automatico display_week: {e}")
+
+def set_display_week(week):
+    """Salva la nuova settimana del display, la registra nel change feed e la notifica ai kiosk"""
+    conn = sqlite3.connect(DB_PATH)
+    c = conn.cursor()
+    try:
+        run(c, 'setting_set', (str(week), 'display_week'))
+        record_setting_change(c, 'display_week', str(week))
+        conn.commit()
     finally:
         conn.close()
+    # La pagina in corso legge subito la nuova settimana
+    read_model.sync()
+    emit_display_week(week)
+
+def event_snapshot(c, event_id):
+    """Stato completo di un evento con i partecipanti (None se non esiste), usando un cursore esistente"""
+    event = run(c, 'event_by_id', (event_id,)).fetchone()
+    if not event:
+        return None
+    
+    registrations = run(c, 'registrations_by_event', (event_id,)).fetchall()
+    
+    return dict(event.to_dict(),
+                participants=[r.participant_name for r in registrations],
+                absent=[r.participant_name for r in registrations if r.is_absent])
 
 def emit_event_update(event_id, action='update'):
     """Emetti aggiornamento WebSocket per un evento specifico"""
@@ -160,38 +201,13 @@ def emit_event_update(event_id, action='update'):
         c = conn.cursor()
         
         # Ottieni dettagli evento aggiornati
-        c.execute("""
-            SELECT id, title, description, day, start_time, end_time, max_slots, registered, compensation, week
-            FROM events WHERE id = ?
-        """, (event_id,))
-        event = c.fetchone()
-        
-        if event:
-            # Ottieni partecipanti
-            c.execute("SELECT participant_name FROM registrations WHERE event_id = ? ORDER BY registration_date", 
-                     (event_id,))
-            participants = [p[0] for p in c.fetchall()]
-            
-            event_data = {
-                'id': event[0],
-                'title': event[1],
-                'description': event[2],
-                'day': event[3],
-                'start_time': event[4],
-                'end_time': event[5],
-                'max_slots': event[6],
-                'registered': event[7],
-                'compensation': event[8],
-                'week': event[9],
-                'participants': participants,
-                'action': action  # 'update', 'delete', 'create'
-            }
-            
-            # In Flask-SocketIO, broadcast è il comportamento di default
-            # Non serve specificare broadcast=True
-            socketio.emit('event_update', event_data)
-        
+        event_data = event_snapshot(c, event_id)
         conn.close()
+        
+        if event_data:
+            event_data['action'] = action  # 'update', 'delete', 'create'
+            
+            live_updates.emit('event_update', event_data)
     except Exception as e:
         app.logger.error(f"Error emitting event update: {e}")
 
@@ -206,6 +222,8 @@ logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(
 # Silenzia i log di engineio e socketio che sono troppo verbosi di default
 logging.getLogger('socketio').setLevel(logging.WARNING)
 logging.getLogger('engineio').setLevel(logging.WARNING)
+# APScheduler logga ogni esecuzione (heartbeat del leader ogni pochi secondi)
+logging.getLogger('apscheduler').setLevel(logging.WARNING)
 
 # Inizializzazione Flask App
 app = Flask(__name__)
@@ -215,11 +233,60 @@ app.secret_key = os.getenv('SECRET_KEY', 'dev-secret-key-change-this')
 # In produzione, specifica il dominio esatto invece di "*"
 # Esempio: cors_allowed_origins="https://tuodominio.com"
 cors_origins = os.getenv('CORS_ORIGINS', '*')  # In dev usa "*", in prod specifica il dominio
+
+# Trasporti provati dal client, in ordine. Con 'websocket-first' il client salta il long-polling
+# iniziale e ripiega sul polling solo se il WebSocket non passa (proxy, reti scolastiche)
+SOCKETIO_TRANSPORT_POLICIES = {
+    'websocket-first': ['websocket', 'polling'],
+    'websocket-only': ['websocket'],
+    'polling-first': ['polling', 'websocket']
+}
+socketio_transport_policy = os.getenv('SOCKETIO_TRANSPORT', 'websocket-first')
+socketio_client_transports = SOCKETIO_TRANSPORT_POLICIES.get(socketio_transport_policy,
+                                                             SOCKETIO_TRANSPORT_POLICIES['websocket-first'])
+
 socketio = SocketIO(app, 
                     cors_allowed_origins=cors_origins,
                     async_mode='threading',  # Importante per Gunicorn/production
                     logger=False,            # Usiamo il logger di Flask
-                    engineio_logger=False)   # Usiamo il logger di Flask
+                    engineio_logger=False,   # Usiamo il logger di Flask
+                    transports=['websocket'] if socketio_client_transports == ['websocket'] else ['polling', 'websocket'],
+                    # Ogni ping costa una richiesta HTTP ai client in polling: intervallo più lungo del default (25s)
+                    ping_interval=int(os.getenv('SOCKETIO_PING_INTERVAL', '40')),
+                    ping_timeout=int(os.getenv('SOCKETIO_PING_TIMEOUT', '30')))
+
+# Broadcast numerati con buffer circolare: al reconnect i client ricevono solo i messaggi persi
+# I client con più di LIVE_MAX_QUEUE pacchetti in uscita non ricevono più delta e poi un solo 'resync'
+live_updates = LiveUpdates(socketio,
+                           buffer_size=int(os.getenv('LIVE_BUFFER_SIZE', '1000')),
+                           max_queue=int(os.getenv('LIVE_MAX_QUEUE', '100')))
+
+# Versioni dei dati (incrementate dalle route di scrittura) ed ETag delle pagine renderizzate
+data_versions = DataVersions()
+etag_store = ETagStore()
+# Coalescenza delle richieste identiche concorrenti (calendario per settimana e versione)
+calendar_flights = SingleFlight()
+
+# Sala d'attesa: al massimo ADMISSION_MAX_CONCURRENT richieste di calendario e iscrizioni
+# in esecuzione insieme (0 = nessun limite), le altre aspettano il proprio turno in coda
+admission = AdmissionController(int(os.getenv('ADMISSION_MAX_CONCURRENT', '20')),
+                                pass_seconds=int(os.getenv('ADMISSION_PASS_SECONDS', '120')))
+# Ogni quanti secondi la sala d'attesa chiede la propria posizione
+WAITING_ROOM_POLL_SECONDS = 2
+
+# Room Socket.IO degli admin (log in tempo reale)
+ADMIN_ROOM = 'admins'
+# Room dei display in modalità kiosk (cambi di settimana del display)
+DISPLAY_ROOM = 'display'
+
+def user_room(login):
+    """Room Socket.IO dei client di un utente (messaggi personali, es. promozione dalla lista d'attesa)"""
+    return f'user:{login}'
+
+# Kiosk: pagina mostrata a rotazione con il calendario (vuoto = nessuna rotazione)
+DISPLAY_ROTATE_URL = os.getenv('DISPLAY_ROTATE_URL', 'https://monitoring.42firenze.it/tv/clusters.html')
+DISPLAY_ROTATE_SECONDS = int(os.getenv('DISPLAY_ROTATE_SECONDS', '30'))
+DISPLAY_ROTATE_ORIGIN = '/'.join(DISPLAY_ROTATE_URL.split('/')[:3]) if DISPLAY_ROTATE_URL else ''
 
 # Force HTTPS in URL generation for production (behind Cloudflare)
 app.config['PREFERRED_URL_SCHEME'] = 'https'
@@ -259,6 +326,11 @@ def event_type_class(title):
 # Filtro Jinja per formattare la data evento
 app.jinja_env.filters['format_event_date'] = format_event_date
 
+@app.context_processor
+def inject_live_state():
+    """Epoch e ultimo seq al momento del render (il client riprende da qui) e chiavi del formato compatto"""
+    return {'live_state': dict(live_updates.head(), keys=COMPACT_KEYS, transports=socketio_client_transports)}
+
 # Database path - uses volume for persistence in Docker
 DB_DIR = os.getenv('DB_DIR', './calendar_data')
 os.makedirs(DB_DIR, exist_ok=True)
@@ -280,6 +352,13 @@ DB_PATH = os.path.join(DB_DIR, "calendar.db")
 # -------------------------------
 notification_manager = None
 
+# Numero massimo di dispositivi con notifiche push per utente
+PUSH_MAX_SUBSCRIPTIONS_PER_USER = int(os.getenv('PUSH_MAX_SUBSCRIPTIONS_PER_USER', '5'))
+
+# 'worker' (default): il web programma le notifiche, il worker le invia
+# 'inline': scheduler e invio nel processo web (sviluppo locale senza worker)
+notification_delivery = os.getenv('NOTIFICATION_DELIVERY', 'worker')
+
 # Only initialize if VAPID keys are configured
 vapid_private_key = os.getenv('VAPID_PRIVATE_KEY')
 vapid_public_key = os.getenv('VAPID_PUBLIC_KEY')
@@ -291,9 +370,19 @@ if vapid_private_key and vapid_public_key and vapid_email:
             db_path=DB_PATH,
             vapid_private_key=vapid_private_key,
             vapid_public_key=vapid_public_key,
-            vapid_claims={'sub': f'mailto:{vapid_email}'}
+            vapid_claims={'sub': f'mailto:{vapid_email}'},
+            digest_window_minutes=int(os.getenv('NOTIFICATION_DIGEST_WINDOW_MINUTES', '5')),
+            # In modalità worker i broadcast vengono accodati e inviati dal worker
+            job_queue=JobQueue(DB_PATH, lease_seconds=int(os.getenv('JOB_LEASE_SECONDS', '60'))) if notification_delivery == 'worker' else None,
+            start_scheduler=(notification_delivery == 'inline'),
+            # Con più processi web solo il leader esegue i job schedulati
+            leader_election=LeaderElection(DB_PATH, lease_seconds=int(os.getenv('LEADER_LEASE_SECONDS', '15'))),
+            broadcast_concurrency=int(os.getenv('BROADCAST_CONCURRENCY', '32')),
+            # Il fallback email gira nello scheduler: serve solo in modalità inline
+            email_fallback=email_fallback_from_env() if notification_delivery == 'inline' else None,
+            retention=retention_from_env(DB_PATH)
         )
-        app.logger.info("✅ Notification system initialized")
+        app.logger.info(f"✅ Notification system initialized (delivery: {notification_delivery})")
     except Exception as e:
         app.logger.error(f"❌ Failed to initialize notification system: {e}")
 else:
@@ -323,6 +412,21 @@ def after_request_timing(response):
         )
     return response
 
+@app.teardown_request
+def flush_data_versions(exc):
+    """
+    Aggiorna il read model e incrementa le versioni degli scope modificati dalla
+    richiesta (a commit avvenuto). Il read model va aggiornato prima: chi vede la
+    nuova versione deve leggere anche i nuovi dati.
+    """
+    scopes = g.pop('data_changes', None)
+    if scopes is not None:
+        try:
+            read_model.sync(users=[scope[5:] for scope in scopes if scope.startswith('user:')])
+        except Exception as e:
+            app.logger.error(f"❌ Aggiornamento read model fallito: {e}")
+        data_versions.bump(scopes)
+
 @app.after_request
 def set_csp(response):
     """Set Content Security Policy headers"""
@@ -333,6 +437,7 @@ def set_csp(response):
         "font-src 'self' https://cdn.jsdelivr.net; "
         "img-src 'self' data: https:; "
         "connect-src 'self' https://api.intra.42.fr; "
+        f"frame-src 'self' {DISPLAY_ROTATE_ORIGIN}; "
         "frame-ancestors 'none'; "
     )
     response.headers['Content-Security-Policy'] = csp
@@ -357,22 +462,17 @@ def _log_action_db(c, user_id, username, action_type, description=None,
     """
     try:
         timestamp = datetime.now()
-        ip_address = request.headers.get('X-Forwarded-For', request.remote_addr)
-        user_agent = request.headers.get('User-Agent', '')[:200]  # Limita lunghezza
-        
-        c.execute(
-            '''
-            INSERT INTO action_logs 
-            (timestamp, user_id, username, action_type, action_description,
-             ip_address, user_agent, resource_id, resource_type, old_value, new_value)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-            ''',
-            (
-                timestamp, user_id, username, action_type, description,
-                ip_address, user_agent, resource_id, resource_type,
-                old_value, new_value
-            )
-        )
+        ip_address = user_agent = None
+        # Fuori da una richiesta (job in background) non ci sono IP né user agent
+        if has_request_context():
+            ip_address = request.headers.get('X-Forwarded-For', request.remote_addr)
+            user_agent = request.headers.get('User-Agent', '')[:200]  # Limita lunghezza
+        
+        run(c, 'log_insert', (
+            timestamp, user_id, username, action_type, description,
+            ip_address, user_agent, resource_id, resource_type,
+            old_value, new_value
+        ))
         return c.lastrowid
     except Exception as e:
         app.logger.error(f"Errore nel logging: {e}")
@@ -404,22 +504,106 @@ def log_action(user_id, username, action_type, description=None,
             emit_log_update(log_id)
         return log_id
 
+def change_scopes(entity, entity_id=None, data=None):
+    """Scope di versione toccati da una modifica (vedi DataVersions)"""
+    scopes = [entity]
+    if entity == 'event':
+        if entity_id is not None:
+            scopes.append(f'event:{entity_id}')
+        if data and 'week' in data:
+            scopes.append(f"week:{data['week']}")
+        else:
+            # Eliminazione: la settimana non è nota
+            scopes.append('weeks')
+    elif entity == 'week':
+        # Eventi creati/eliminati in blocco: anche gli id eliminati vanno invalidati
+        scopes += [f'week:{entity_id}', 'weeks']
+    return scopes
+
+def mark_data_changed(*scopes):
+    """
+    Registra gli scope modificati dalla richiesta corrente. Le versioni vengono
+    incrementate a fine richiesta, dopo il commit (vedi flush_data_versions).
+    """
+    if has_request_context():
+        g.setdefault('data_changes', set()).update(scopes)
+
+def record_change(c, entity, op, entity_id=None, data=None):
+    """
+    Aggiunge una voce al change feed usando un cursore esistente, nella stessa
+    transazione della modifica. NON esegue il commit.
+    
+    Restituisce il numero di sequenza della voce.
+    entity: 'event', 'week', 'setting', 'whitelist', 'template', 'allocation', 'waitlist'
+    op: 'upsert' (data = stato completo dell'entità), 'delete' o 'delete_all' (tutte le entità del tipo)
+    """
+    mark_data_changed(*change_scopes(entity, entity_id, data))
+    run(c, 'change_insert', (entity, None if entity_id is None else str(entity_id), op,
+         None if data is None else json.dumps(data, separators=(',', ':')), datetime.now())
+    )
+    return c.lastrowid
+
+def record_event_change(c, event_id):
+    """Registra nel change feed lo stato attuale di un evento, o la sua eliminazione"""
+    snapshot = event_snapshot(c, event_id)
+    return record_change(c, 'event', 'upsert' if snapshot else 'delete', event_id, snapshot)
+
+def record_week_change(c, week):
+    """Registra nel change feed tutti gli eventi di una settimana (sostituiscono quelli noti al client)"""
+    events = [event_snapshot(c, row[0]) for row in run(c, 'event_ids_by_week', (week,)).fetchall()]
+    return record_change(c, 'week', 'upsert', week, {'week': week, 'events': events})
+
+def record_setting_change(c, key, value):
+    """Registra nel change feed il nuovo valore di un'impostazione"""
+    return record_change(c, 'setting', 'upsert', key, {'value': value})
+
+def record_allocation_change(c, week):
+    """
+    Registra nel change feed la finestra di sorteggio di una settimana (o la sua
+    eliminazione). Anche le preferenze la registrano: le pagine in cache degli
+    altri processi mostrano le richieste dell'utente e la domanda per evento.
+    """
+    window = run(c, 'allocation_window', (week,)).fetchone()
+    if window is None:
+        return record_change(c, 'allocation', 'delete', week)
+    return record_change(c, 'allocation', 'upsert', week, {'week': week, 'closes_at': window[0], 'status': window[1]})
+
+def emit_display_week(week):
+    """Notifica ai display in modalità kiosk il passaggio a una nuova settimana"""
+    live_updates.emit('display_week', {'week': week}, room=DISPLAY_ROOM)
+
+def emit_week_changed(week=None):
+    """Notifica una modifica in blocco agli eventi di una settimana (None = tutte le settimane)"""
+    live_updates.emit('week_changed', {'week': week})
+
 def emit_log_update(log_id):
     """Recupera un log dal DB e lo emette via Socket.IO."""
     if not log_id:
         return
     try:
         read_conn = sqlite3.connect(DB_PATH)
-        read_conn.row_factory = sqlite3.Row
-        read_c = read_conn.cursor()
-        read_c.execute("SELECT * FROM action_logs WHERE id = ?", (log_id,))
-        new_log_row = read_c.fetchone()
+        new_log = run(read_conn.cursor(), 'log_by_id', (log_id,)).fetchone()
         read_conn.close()
-        if new_log_row:
-            socketio.emit('new_log', dict(new_log_row))
+        if new_log:
+            # I log contengono IP e user agent: solo agli admin
+            live_updates.emit('new_log', new_log.to_dict(), room=ADMIN_ROOM)
     except Exception as e:
         app.logger.error(f"Errore durante l'emissione del log Socket.IO: {e}")
 
+def start_broadcast(campaign_id):
+    """Avvia l'invio di una campagna broadcast già salvata.
+    In modalità worker la campagna è già in coda; in modalità inline parte in background."""
+    if not notification_manager or notification_manager.job_queue:
+        return
+
+    def run():
+        try:
+            notification_manager.run_broadcast(campaign_id)
+        except Exception as e:
+            app.logger.error(f"❌ Broadcast {campaign_id} fallito: {e}")
+
+    socketio.start_background_task(run)
+
 # -------------------------------
 # Admin Configuration
 # -------------------------------
@@ -583,6 +767,16 @@ def init_db():
         )
     ''')
     
+    # Tabella per gli anticipi dei promemoria scelti dall'utente (minuti prima dell'evento)
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS user_notification_offsets (
+            user_id INTEGER NOT NULL,
+            offset_minutes INTEGER NOT NULL,
+            PRIMARY KEY (user_id, offset_minutes),
+            FOREIGN KEY (user_id) REFERENCES users(id)
+        )
+    ''')
+    
     # Tabella per le push subscriptions (browser)
     c.execute('''
         CREATE TABLE IF NOT EXISTS push_subscriptions (
@@ -591,11 +785,25 @@ def init_db():
             endpoint TEXT NOT NULL UNIQUE,
             p256dh TEXT NOT NULL,
             auth TEXT NOT NULL,
+            user_agent TEXT,
             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            last_success_at DATETIME,
+            last_failure_at DATETIME,
+            failure_count INTEGER DEFAULT 0,
             FOREIGN KEY (user_id) REFERENCES users(id)
         )
     ''')
     
+    # Migrazione: stato di consegna e dispositivo delle sottoscrizioni push
+    for column in ("user_agent TEXT", "last_success_at DATETIME", "last_failure_at DATETIME",
+                   "failure_count INTEGER DEFAULT 0"):
+        try:
+            c.execute(f"ALTER TABLE push_subscriptions ADD COLUMN {column}")
+        except sqlite3.OperationalError:
+            pass  # La colonna esiste già
+    
+    c.execute("CREATE INDEX IF NOT EXISTS idx_push_subscriptions_user ON push_subscriptions(user_id)")
+    
     # Tabella per le notifiche programmate
     c.execute('''
         CREATE TABLE IF NOT EXISTS scheduled_notifications (
@@ -604,20 +812,61 @@ def init_db():
             event_id INTEGER NOT NULL,
             registration_id INTEGER NOT NULL,
             notification_type TEXT NOT NULL,
+            offset_minutes INTEGER,
             scheduled_time DATETIME NOT NULL,
             sent BOOLEAN DEFAULT 0,
             sent_at DATETIME,
             error_message TEXT,
+            job_id INTEGER,
+            email_status TEXT,
             FOREIGN KEY (user_id) REFERENCES users(id),
             FOREIGN KEY (event_id) REFERENCES events(id),
             FOREIGN KEY (registration_id) REFERENCES registrations(id)
         )
     ''')
     
+    # Migrazione: aggiungi colonna offset_minutes alle notifiche programmate
+    try:
+        c.execute("ALTER TABLE scheduled_notifications ADD COLUMN offset_minutes INTEGER")
+    except sqlite3.OperationalError:
+        pass  # La colonna esiste già
+    
+    # Migrazione: aggiungi colonna job_id (job della coda che sta inviando la notifica)
+    try:
+        c.execute("ALTER TABLE scheduled_notifications ADD COLUMN job_id INTEGER")
+    except sqlite3.OperationalError:
+        pass  # La colonna esiste già
+    
+    # Migrazione: aggiungi colonna email_status (fallback email: pending/sent/failed/no_address/expired)
+    try:
+        c.execute("ALTER TABLE scheduled_notifications ADD COLUMN email_status TEXT")
+    except sqlite3.OperationalError:
+        pass  # La colonna esiste già
+    
     # Indici per le notifiche
+    # (sent, scheduled_time) serve la scansione delle notifiche in attesa,
+    # (registration_id, sent) la cancellazione alla disiscrizione
+    c.execute("DROP INDEX IF EXISTS idx_notifications_scheduled")
+    c.execute('''
+        CREATE INDEX IF NOT EXISTS idx_notifications_pending 
+        ON scheduled_notifications(sent, scheduled_time)
+    ''')
+    
+    c.execute('''
+        CREATE INDEX IF NOT EXISTS idx_notifications_registration 
+        ON scheduled_notifications(registration_id, sent)
+    ''')
+    
+    # Cancellazione a cascata delle notifiche quando si elimina un evento
     c.execute('''
-        CREATE INDEX IF NOT EXISTS idx_notifications_scheduled 
-        ON scheduled_notifications(scheduled_time, sent)
+        CREATE INDEX IF NOT EXISTS idx_notifications_event 
+        ON scheduled_notifications(event_id)
+    ''')
+    
+    # Indice parziale: solo le righe passate al fallback email
+    c.execute('''
+        CREATE INDEX IF NOT EXISTS idx_notifications_email 
+        ON scheduled_notifications(email_status, user_id) WHERE email_status IS NOT NULL
     ''')
     
     c.execute('''
@@ -630,6 +879,163 @@ def init_db():
         ON push_subscriptions(user_id)
     ''')
     
+    # Coda di job persistente consumata dal worker (python -m notifications worker)
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS job_queue (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            kind TEXT NOT NULL,
+            payload TEXT NOT NULL DEFAULT '{}',
+            status TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            max_attempts INTEGER NOT NULL DEFAULT 5,
+            available_at DATETIME NOT NULL,
+            lease_until DATETIME,
+            locked_by TEXT,
+            last_error TEXT,
+            created_at DATETIME NOT NULL,
+            finished_at DATETIME
+        )
+    ''')
+    
+    c.execute('''
+        CREATE INDEX IF NOT EXISTS idx_job_queue_status 
+        ON job_queue(status, available_at)
+    ''')
+    
+    # Lease per l'elezione del leader dei job schedulati (un solo processo alla volta)
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS leader_leases (
+            name TEXT PRIMARY KEY,
+            holder TEXT NOT NULL,
+            lease_until DATETIME NOT NULL,
+            heartbeat_at DATETIME NOT NULL
+        )
+    ''')
+    
+    # Campagne broadcast push (annunci admin, apertura week)
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS broadcast_campaigns (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            title TEXT NOT NULL,
+            body TEXT NOT NULL,
+            url TEXT,
+            audience TEXT NOT NULL DEFAULT 'all',
+            status TEXT NOT NULL DEFAULT 'queued',
+            total INTEGER DEFAULT 0,
+            sent INTEGER DEFAULT 0,
+            failed INTEGER DEFAULT 0,
+            pruned INTEGER DEFAULT 0,
+            last_subscription_id INTEGER DEFAULT 0,
+            error_message TEXT,
+            created_by TEXT,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            started_at DATETIME,
+            finished_at DATETIME
+        )
+    ''')
+    
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS broadcast_failures (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            campaign_id INTEGER NOT NULL,
+            subscription_id INTEGER,
+            endpoint TEXT,
+            status_code INTEGER,
+            error TEXT,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (campaign_id) REFERENCES broadcast_campaigns(id) ON DELETE CASCADE
+        )
+    ''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_broadcast_failures_campaign ON broadcast_failures(campaign_id)")
+    
+    # Contatori del motore di retention (una riga per policy)
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS retention_stats (
+            policy TEXT PRIMARY KEY,
+            last_run_at DATETIME,
+            last_deleted INTEGER DEFAULT 0,
+            total_deleted INTEGER DEFAULT 0,
+            backlog BOOLEAN DEFAULT 0
+        )
+    ''')
+    
+    # Change feed: una riga per modifica, letta dai client con /api/changes?since=<seq>
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS changes (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            entity TEXT NOT NULL,
+            entity_id TEXT,
+            op TEXT NOT NULL,
+            data TEXT,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_changes_entity ON changes(entity, entity_id, seq)")
+
+    # Chiavi di idempotenza: esito delle POST già eseguite (outcome NULL = in corso)
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS idempotency_keys (
+            key TEXT PRIMARY KEY,
+            outcome TEXT,
+            created_at TIMESTAMP NOT NULL,
+            expires_at TIMESTAMP NOT NULL
+        )
+    ''')
+
+    # Settimane a sorteggio: finché la finestra è aperta le iscrizioni sono solo preferenze,
+    # alla chiusura i posti vengono assegnati tutti insieme (status 'open' -> 'allocated')
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS week_allocations (
+            week INTEGER PRIMARY KEY,
+            closes_at TIMESTAMP NOT NULL,
+            status TEXT NOT NULL DEFAULT 'open',
+            seed INTEGER,
+            created_by TEXT,
+            created_at TIMESTAMP,
+            allocated_at TIMESTAMP
+        )
+    ''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_week_allocations_due ON week_allocations(status, closes_at)")
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS registration_preferences (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            week INTEGER NOT NULL,
+            event_id INTEGER NOT NULL,
+            participant_name TEXT NOT NULL,
+            created_at TIMESTAMP,
+            UNIQUE(event_id, participant_name)
+        )
+    ''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_preferences_week ON registration_preferences(week, participant_name)")
+
+    # Liste d'attesa degli eventi pieni: FIFO per evento, la testa è l'id più basso
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS waitlist (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            event_id INTEGER NOT NULL,
+            participant_name TEXT NOT NULL,
+            created_at TIMESTAMP,
+            UNIQUE(event_id, participant_name)
+        )
+    ''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_waitlist_event ON waitlist(event_id, id)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_waitlist_participant ON waitlist(participant_name)")
+    
+    # changes_floor: i client con since < floor devono ricaricare tutto.
+    # Si alza solo quando viene cancellata una voce non sostituita da una più recente
+    # (la compattazione delle voci superate non perde informazioni)
+    c.execute("INSERT OR IGNORE INTO settings (key, value) VALUES ('changes_floor', '0')")
+    c.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_changes_floor AFTER DELETE ON changes
+        WHEN NOT EXISTS (
+            SELECT 1 FROM changes n
+            WHERE n.entity = OLD.entity AND n.entity_id = OLD.entity_id AND n.seq > OLD.seq
+        )
+        BEGIN
+            UPDATE settings SET value = MAX(CAST(value AS INTEGER), OLD.seq) WHERE key = 'changes_floor';
+        END
+    ''')
+    
     # Migrazione: aggiungi colonna week se non esiste
     try:
         c.execute("ALTER TABLE events ADD COLUMN week INTEGER DEFAULT 1")
@@ -653,12 +1059,46 @@ def init_db():
         c.execute("ALTER TABLE registrations ADD COLUMN attended BOOLEAN DEFAULT 1")
     except sqlite3.OperationalError:
         pass  # La colonna esiste già
-    
+
+    # Indici usati dalle query frequenti del catalogo (dopo le migrazioni: week può essere appena stata aggiunta)
+    c.execute("CREATE INDEX IF NOT EXISTS idx_registrations_event ON registrations(event_id, participant_name)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_registrations_participant ON registrations(participant_name)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_events_week ON events(week, day)")
+
     conn.commit()
     conn.close()
 
 init_db()
 
+# Read model in memoria (eventi, iscrizioni, whitelist, impostazioni, wallet): servono le route di lettura
+read_model = ReadModel(DB_PATH)
+read_model.load()
+
+# Ogni READ_MODEL_SYNC_SECONDS applica le scritture degli altri processi (change feed),
+# ogni READ_MODEL_CHECK_SECONDS lo confronta con il database (0 = mai)
+READ_MODEL_SYNC_SECONDS = int(os.getenv('READ_MODEL_SYNC_SECONDS', '2'))
+READ_MODEL_CHECK_SECONDS = int(os.getenv('READ_MODEL_CHECK_SECONDS', '300'))
+# Scope di versione invalidati quando il read model riceve scritture non fatte da questo processo
+READ_MODEL_SCOPES = ['event', 'weeks', 'setting', 'whitelist', 'allocation']
+
+def read_model_loop():
+    """Sincronizzazione periodica del read model con il change feed e verifica di consistenza"""
+    last_check = time.time()
+    while True:
+        socketio.sleep(READ_MODEL_SYNC_SECONDS)
+        try:
+            if read_model.sync():
+                # Scritture di un altro processo: gli ETag di questo processo non sono più validi
+                data_versions.bump(READ_MODEL_SCOPES)
+            if READ_MODEL_CHECK_SECONDS and time.time() - last_check >= READ_MODEL_CHECK_SECONDS:
+                last_check = time.time()
+                if read_model.check():
+                    data_versions.bump(READ_MODEL_SCOPES)
+        except Exception as e:
+            app.logger.error(f"❌ Sincronizzazione read model fallita: {e}")
+
+socketio.start_background_task(read_model_loop)
+
 # -------------------------------
 # Decorators
 # -------------------------------
@@ -680,6 +1120,163 @@ def admin_required(f):
         return f(*args, **kwargs)
     return decorated_function
 
+def page_key(*scopes, realtime=False):
+    """
+    Chiave di cache di una pagina: versioni dei dati (globale o degli scope indicati),
+    identità e ruolo dell'utente, URL. Le pagine real-time includono l'ultimo seq
+    Socket.IO, perché il seq di partenza è scritto nella pagina.
+    """
+    user = session.get('user') or {}
+    key = (data_versions.epoch, data_versions.version(*scopes),
+           user.get('id'), user.get('login'), bool(user.get('is_admin')), request.full_path)
+    if realtime:
+        key += (live_updates.head()['seq'],)
+    return key
+
+def etag_cached(key_func):
+    """
+    ETag forte per una pagina GET. Se l'If-None-Match del client corrisponde
+    all'ETag ancora valido per la chiave, risponde 304 senza query né render.
+    """
+    def decorator(f):
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            # I messaggi flash vanno mostrati: niente 304
+            if session.get('_flashes'):
+                return f(*args, **kwargs)
+            
+            key = key_func(*args, **kwargs)
+            etag = etag_store.lookup(key)
+            if etag and request.if_none_match.contains(etag):
+                etag_store.record(True)
+                response = make_response('', 304)
+            else:
+                etag_store.record(False)
+                g.etag_valid_until = None
+                response = make_response(f(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+                etag = etag_store.store(key, g.etag_valid_until)
+            
+            response.set_etag(etag)
+            # Sempre rivalidata, mai condivisa tra utenti
+            response.headers['Cache-Control'] = 'private, no-cache'
+            return response
+        return decorated_function
+    return decorator
+
+def waiting_room_response(decision):
+    """Risposta 503 della sala d'attesa: JSON per fetch, altrimenti pagina leggera che ripete la richiesta"""
+    if wants_json():
+        response = jsonify({'error': "Troppe richieste: sei in coda", 'code': 'waiting_room',
+                            'position': decision.position, 'eta_seconds': decision.eta_seconds,
+                            'retry_after': WAITING_ROOM_POLL_SECONDS})
+    else:
+        form = [(name, value) for name, value in request.form.items(multi=True)]
+        response = make_response(render_template('waiting_room.html', position=decision.position,
+                                                 eta_seconds=decision.eta_seconds, method=request.method,
+                                                 action=request.full_path.rstrip('?'), form=form,
+                                                 poll_seconds=WAITING_ROOM_POLL_SECONDS))
+    response.status_code = 503
+    response.headers['Retry-After'] = str(WAITING_ROOM_POLL_SECONDS)
+    response.headers['Cache-Control'] = 'no-store'
+    return response
+
+def admission_controlled(f):
+    """
+    Limita le richieste concorrenti (calendario e iscrizioni) con la sala d'attesa.
+    Gli admin non fanno la coda. Da mettere dopo etag_cached (i 304 non fanno la coda)
+    e prima di idempotent (la risposta della sala d'attesa non va salvata come esito).
+    """
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if not admission.enabled or session.get('user', {}).get('is_admin'):
+            return f(*args, **kwargs)
+
+        decision = admission.enter(session.get('admission_ticket'), session.get('admission_pass'))
+        if not decision.entered:
+            session['admission_ticket'] = decision.ticket
+            return waiting_room_response(decision)
+
+        if 'admission_ticket' in session:
+            session.pop('admission_ticket')
+        if decision.pass_token and session.get('admission_pass') != decision.pass_token:
+            session['admission_pass'] = decision.pass_token
+        start = time.time()
+        try:
+            return f(*args, **kwargs)
+        finally:
+            admission.leave(time.time() - start)
+    return decorated_function
+
+# Chiavi di idempotenza: un retry o un doppio click con la stessa chiave riceve l'esito della prima richiesta
+idempotency_store = IdempotencyStore(DB_PATH, ttl_seconds=int(os.getenv('IDEMPOTENCY_TTL_SECONDS', '600')),
+                                     lease_seconds=int(os.getenv('IDEMPOTENCY_LEASE_SECONDS', '30')))
+# Secondi suggeriti (Retry-After) a chi ripete una richiesta ancora in corso
+IDEMPOTENCY_RETRY_AFTER = 1
+
+def new_idempotency_key():
+    """Chiave nuova per i form (campo nascosto idempotency_key)"""
+    return uuid.uuid4().hex
+
+app.jinja_env.globals['idempotency_key'] = new_idempotency_key
+
+def replay_outcome(outcome):
+    """Risposta salvata di una richiesta già eseguita: stessi messaggi, stesso redirect o JSON"""
+    for category, message in outcome['flashes']:
+        flash(message, category)
+    if outcome['body'] is not None:
+        response = make_response(outcome['body'], outcome['status'])
+        response.mimetype = 'application/json'
+    elif outcome['location']:
+        response = redirect(outcome['location'], outcome['status'])
+    else:
+        response = make_response('', outcome['status'])
+    response.headers['Idempotent-Replayed'] = 'true'
+    return response
+
+def idempotent(f):
+    """
+    POST con header Idempotency-Key (o campo idempotency_key): la prima richiesta
+    con una chiave viene eseguita e il suo esito salvato, le successive lo ricevono
+    senza rieseguire la route. Da mettere dopo login_required/admin_required.
+    """
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        client_key = request.headers.get('Idempotency-Key') or request.form.get('idempotency_key')
+        if not client_key or 'user' not in session:
+            return f(*args, **kwargs)
+
+        payload = [[name, value] for name, value in request.form.items(multi=True) if name != 'idempotency_key']
+        key = IdempotencyStore.scoped_key(session['user']['id'], request.method, request.path, client_key, payload)
+        outcome = idempotency_store.claim(key)
+        if outcome is PENDING:
+            # Richiesta gemella ancora in corso (doppio click): 409 subito, senza occupare il thread
+            if wants_json():
+                response = make_response(api_error('Richiesta già in corso', 409, 'in_progress', retry_after=IDEMPOTENCY_RETRY_AFTER))
+            else:
+                flash('Richiesta già in corso, attendi qualche secondo', 'warning')
+                response = make_response(redirect(request.referrer or url_for('index')))
+            response.headers['Retry-After'] = str(IDEMPOTENCY_RETRY_AFTER)
+            return response
+        if outcome is not None:
+            return replay_outcome(outcome)
+
+        flashes_before = len(session.get('_flashes', []))
+        try:
+            response = make_response(f(*args, **kwargs))
+        except Exception:
+            idempotency_store.release(key)
+            raise
+        idempotency_store.complete(key, {
+            'status': response.status_code,
+            'location': response.headers.get('Location'),
+            'flashes': [list(item) for item in session.get('_flashes', [])[flashes_before:]],
+            'body': response.get_data(as_text=True) if response.is_json else None
+        })
+        return response
+    return decorated_function
+
 # -------------------------------
 # Routes OAuth
 # -------------------------------
@@ -726,8 +1323,7 @@ def authorize():
         c = conn.cursor()
         
         # Controlla se l'utente esiste già
-        c.execute("SELECT id FROM users WHERE intra_id = ?", (user_info['id'],))
-        existing_user = c.fetchone()
+        existing_user = run(c, 'user_id_by_intra', (user_info['id'],)).fetchone()
         
         if existing_user:
             # Utente esistente: aggiorna tutti i dati incluso is_admin
@@ -761,6 +1357,8 @@ def authorize():
         
         conn.commit()
         conn.close()
+        # Il wallet è cambiato: profilo e read model vanno aggiornati
+        mark_data_changed(f"user:{user_info['login']}")
         
         # Salva in sessione
         session['user'] = {
@@ -789,17 +1387,89 @@ def logout():
 
 @app.route('/calendar')
 @login_required
+@etag_cached(lambda: page_key(realtime=True))
+@admission_controlled
 def home():
     # Mostra calendario per utenti (settimana attiva o precedenti se specificate)
     # Parametro opzionale: week (permette di navigare le settimane <= active_week)
     requested_week = request.args.get('week', type=int)
     
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
+    # La parte comune a tutti gli utenti viene calcolata una sola volta per le richieste
+    # identiche concorrenti (es. tutti i browser dopo un week_activated)
+    week_data = calendar_flights.do(
+        ('calendar', requested_week, data_versions.version()),
+        lambda: calendar_week_data(requested_week)
+    )
+    if week_data['valid_until']:
+        note_page_valid_until(week_data['valid_until'])
+    
+    # Campi per utente sovrapposti al risultato condiviso (che non va modificato)
+    current_login = session.get('user', {}).get('login')
+    calendar_grid = {
+        day: [replace(ev, is_user_registered=bool(current_login) and current_login in ev.participants_all)
+              for ev in ev_list]
+        for day, ev_list in week_data['calendar_grid'].items()
+    }
+    
+    # Eventi per cui l'utente ha chiesto di partecipare al sorteggio
+    lottery = week_data['lottery']
+    if lottery:
+        requested = []
+        if current_login:
+            conn = sqlite3.connect(DB_PATH)
+            try:
+                requested = [row[0] for row in run(conn.cursor(), 'preferences_user_week', (week_data['current_week'], current_login)).fetchall()]
+            finally:
+                conn.close()
+        lottery = dict(lottery, requested=requested)
+    
+    # Liste d'attesa dell'utente con la posizione (solo se la settimana ha eventi pieni)
+    waitlist = {}
+    if current_login and any(ev.registered >= ev.max_slots for ev_list in calendar_grid.values() for ev in ev_list):
+        conn = sqlite3.connect(DB_PATH)
+        try:
+            waitlist = dict(run(conn.cursor(), 'waitlist_user_week', (current_login, week_data['current_week'])).fetchall())
+        finally:
+            conn.close()
+    
+    return render_template("calendar.html", calendar_grid=calendar_grid, days=week_data['days'],
+                           active_week=week_data['active_week'], current_week=week_data['current_week'],
+                           day_dates=week_data['day_dates'], calendar_data=week_data['calendar_data'],
+                           lottery=lottery, waitlist=waitlist)
+
+def event_view(state, event, day_dates):
+    """EventView di un evento con la data concreta (event_date o derivata dal pool) e se è passato"""
+    concrete_date = event.concrete_date(day_dates)
+    return EventView(event, state.event_registrations(event.id),
+                     concrete_date=concrete_date,
+                     is_passed=is_event_passed(concrete_date, event.end_time))
+
+def week_event_views(state, week, days=None):
+    """
+    Loader comune a calendario, display e API: EventView degli eventi di una
+    settimana (solo dei `days` indicati), ordinati per giorno e orario, e date dei giorni.
+    """
+    day_dates = compute_week_day_dates(state.setting('pool_start'), week)
+    views = [event_view(state, event, day_dates) for event in state.week_events(week)
+             if days is None or event.day in days]
+    return views, day_dates
+
+def group_by_day(views, days):
+    grid = {day: [] for day in days}
+    for view in views:
+        grid[view.day].append(view)
+    return grid
+
+def calendar_week_data(requested_week):
+    """
+    Parte condivisa del calendario: eventi della settimana con partecipanti,
+    date e stato "passato". Non contiene dati dell'utente corrente.
+    Letta dal read model; solo durante un sorteggio una query per le richieste per evento.
+    """
+    state = read_model.snapshot()
     
     # Ottieni settimana attiva
-    c.execute("SELECT value FROM settings WHERE key = 'active_week'")
-    active_week = int(c.fetchone()[0])
+    active_week = state.int_setting('active_week')
     
     # Determina quale settimana visualizzare
     # Se non specificata, mostra la settimana attiva
@@ -810,245 +1480,149 @@ def home():
         # Limita la navigazione: min 1, max active_week
         current_week = max(1, min(requested_week, active_week))
     
-    # Prendi solo eventi della settimana corrente (includi event_date)
-    c.execute("SELECT * FROM events WHERE week = ?", (current_week,))
-    events = c.fetchall()
+    # Organizza eventi per giorno (già ordinati per orario di inizio)
+    days = ['Lunedì', 'Martedì', 'Mercoledì', 'Giovedì', 'Venerdì']
+    views, day_dates = week_event_views(state, current_week, days)
+    calendar_grid = group_by_day(views, days)
+    
+    # Dati usati dal modale "Aggiungi al Calendario" (solo i campi necessari, niente partecipanti)
+    calendar_data = {
+        day: [{'id': ev.id, 'title': ev.title, 'description': ev.description, 'start_time': ev.start_time,
+               'end_time': ev.end_time, 'concrete_date': ev.concrete_date} for ev in ev_list]
+        for day, ev_list in calendar_grid.items()
+    }
     
-    # Prendi i partecipanti per ogni evento
-    events_with_participants = []
-    for event in events:
-        c.execute("SELECT participant_name, registration_date, attended FROM registrations WHERE event_id = ? ORDER BY registration_date", (event[0],))
-        participants_raw = c.fetchall()  # list of tuples (name, registration_date, attended)
-
-        # Build lists: all participant names and only the 'visible' ones (attended==1)
-        participants_all = [p[0] for p in participants_raw]
-        participants_visible = [p[0] for p in participants_raw if (p[2] == 1 or p[2] == '1' or p[2] is True)]
-
-        # compute visible registered count (only attended==1)
-        attended_count = len(participants_visible)
-
-        # determine if current session user is registered for this event (any registration regardless of attended)
-        is_user_reg = False
+    # Sorteggio aperto: chiusura e richieste per evento (la pagina cambia alla chiusura)
+    lottery = state.open_allocation(current_week)
+    if lottery:
+        note_page_valid_until(datetime.strptime(lottery['closes_at'], ALLOCATION_TIME_FORMAT))
+        conn = sqlite3.connect(DB_PATH)
         try:
-            current_login = session.get('user', {}).get('login')
-            if current_login and current_login in participants_all:
-                is_user_reg = True
-        except Exception:
-            is_user_reg = False
-
-        events_with_participants.append({
-            'id': event[0],
-            'title': event[1],
-            'description': event[2],
-            'day': event[3],
-            'event_date': event[10] if len(event) > 10 else None,
-            'start_time': event[4],
-            'end_time': event[5],
-            'max_slots': event[6],
-            'registered': attended_count,
-            'compensation': event[8] if len(event) > 8 else 0,
-            'week': event[9] if len(event) > 9 else 1,
-            # raw tuples for admin view
-            'participants_raw': participants_raw,
-            # convenience lists
-            'participants_all': participants_all,
-            'participants_visible': participants_visible,
-            'is_user_registered': is_user_reg
-        })
+            demand = dict(run(conn.cursor(), 'preferences_demand_week', (current_week,)).fetchall())
+        finally:
+            conn.close()
+        lottery = {'closes_at': lottery['closes_at'], 'demand': demand}
+    
+    return {
+        'calendar_grid': calendar_grid,
+        'calendar_data': calendar_data,
+        'lottery': lottery,
+        'days': days,
+        'active_week': active_week,
+        'current_week': current_week,
+        'day_dates': day_dates,
+        # Prossimo evento che diventa "passato" (vedi note_page_valid_until), anche per chi ha atteso
+        'valid_until': g.get('etag_valid_until')
+    }
+
+def display_state(state):
+    """
+    Settimana attiva e settimana del display, date dei giorni e snapshot degli eventi
+    della settimana del display, dal read model
+    """
+    active_week = state.int_setting('active_week')
     
-    # Load pool start from settings and compute day dates for the current week
-    c = sqlite3.connect(DB_PATH).cursor()
-    # reopen a connection to read settings
-    conn2 = sqlite3.connect(DB_PATH)
-    c2 = conn2.cursor()
-    c2.execute("SELECT value FROM settings WHERE key = 'pool_start'")
-    pool_start_row = c2.fetchone()
-    pool_start = pool_start_row[0] if pool_start_row else None
-    # Compute day dates for the week being viewed
-    day_dates = compute_week_day_dates(pool_start, current_week)
-    conn2.close()
-    conn.close()
+    # Settimana da mostrare nel display (aggiornata automaticamente)
+    display_week = state.int_setting('display_week', active_week)
     
-    # Organizza eventi per giorno e ordina per orario
-    days = ['Lunedì', 'Martedì', 'Mercoledì', 'Giovedì', 'Venerdì']
-    calendar_grid = {day: [] for day in days}
+    events = [state.snapshot(event_id) for event_id in sorted(e.id for e in state.week_events(display_week))]
     
-    for event in events_with_participants:
-        if event['day'] in calendar_grid:
-            calendar_grid[event['day']].append(event)
+    return {
+        'active_week': active_week,
+        'display_week': display_week,
+        'day_dates': compute_week_day_dates(state.setting('pool_start'), display_week),
+        'events': events
+    }
 
-    # Calcola per ogni evento la data concreta (event_date o derivata dal pool) e se l'evento è passato
-    for day, ev_list in calendar_grid.items():
-        for ev in ev_list:
-            concrete_date = ev.get('event_date')
-            if not concrete_date:
-                concrete_date = day_dates.get(ev.get('day'))
-            ev['concrete_date'] = concrete_date
-            ev['is_passed'] = is_event_passed(concrete_date, ev.get('end_time'))
-    
-    # Ordina gli eventi per orario di inizio (formato 24h)
-    for day in days:
-        calendar_grid[day].sort(key=lambda x: x['start_time'])
-    
-    return render_template("calendar.html", calendar_grid=calendar_grid, days=days, active_week=active_week, current_week=current_week, day_dates=day_dates)
+# Settimana del display per versione delle impostazioni: permette di calcolare
+# la chiave ETag di /display (settimana mostrata) senza leggere il database
+display_week_by_version = {}
+
+def display_page_key():
+    """Chiave ETag del display: impostazioni ed eventi della sola settimana mostrata"""
+    kiosk = request.path == '/display/kiosk'
+    week = display_week_by_version.get(data_versions.version('setting'))
+    if week is None:
+        return page_key(realtime=kiosk)
+    return page_key('setting', 'weeks', f'week:{week}', realtime=kiosk)
 
 @app.route('/display')
+@app.route('/display/kiosk', endpoint='display_kiosk')
+@etag_cached(display_page_key)
 def display_calendar():
     """
     Pagina di visualizzazione pubblica per proiezione su schermo.
     Mostra la settimana configurata per il display (che può essere diversa dalla settimana attiva).
     Accessibile senza autenticazione.
+    
+    Con /display/kiosk la pagina viene caricata una sola volta: gli aggiornamenti arrivano
+    via Socket.IO e la rotazione con la pagina di monitoring avviene nel browser.
     """
+    settings_version = data_versions.version('setting')
+    
     # Prima aggiorna automaticamente display_week se necessario
     auto_update_display_week()
     
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    
-    # Ottieni settimana attiva (per le registrazioni)
-    c.execute("SELECT value FROM settings WHERE key = 'active_week'")
-    active_week = int(c.fetchone()[0])
-    
-    # Ottieni settimana da mostrare nel display (ora aggiornata automaticamente)
-    c.execute("SELECT value FROM settings WHERE key = 'display_week'")
-    display_week_row = c.fetchone()
-    display_week = int(display_week_row[0]) if display_week_row else active_week
-    
-    # Prendi solo eventi della settimana da visualizzare
-    c.execute("SELECT * FROM events WHERE week = ?", (display_week,))
-    events = c.fetchall()
-    
-    # Prendi i partecipanti per ogni evento
-    events_with_participants = []
-    for event in events:
-        c.execute("SELECT participant_name, registration_date, attended FROM registrations WHERE event_id = ? ORDER BY registration_date", (event[0],))
-        participants_raw = c.fetchall()
-        
-        # Build lists: only visible participants (attended==1)
-        participants_visible = [p[0] for p in participants_raw if (p[2] == 1 or p[2] == '1' or p[2] is True)]
-        attended_count = len(participants_visible)
-
-        events_with_participants.append({
-            'id': event[0],
-            'title': event[1],
-            'description': event[2],
-            'day': event[3],
-            'event_date': event[10] if len(event) > 10 else None,
-            'start_time': event[4],
-            'end_time': event[5],
-            'max_slots': event[6],
-            'registered': attended_count,
-            'compensation': event[8] if len(event) > 8 else 0,
-            'week': event[9] if len(event) > 9 else 1,
-            'participants_visible': participants_visible
-        })
-    
-    # Load pool start and compute day dates
-    c.execute("SELECT value FROM settings WHERE key = 'pool_start'")
-    pool_start_row = c.fetchone()
-    pool_start = pool_start_row[0] if pool_start_row else None
-    day_dates = compute_week_day_dates(pool_start, display_week)
-    conn.close()
-    
-    # Organizza eventi per giorno e ordina per orario
+    state = read_model.snapshot()
+    active_week = state.int_setting('active_week')
+    display_week = state.int_setting('display_week', active_week)
+    display_week_by_version.clear()
+    display_week_by_version[settings_version] = display_week
+    # Organizza eventi per giorno (già ordinati per orario);
+    # registered e disponibilità contano solo i partecipanti presenti
     days = ['Lunedì', 'Martedì', 'Mercoledì', 'Giovedì', 'Venerdì']
-    calendar_grid = {day: [] for day in days}
-    
-    for event in events_with_participants:
-        if event['day'] in calendar_grid:
-            calendar_grid[event['day']].append(event)
-
-    # Calcola per ogni evento se è passato
-    for day, ev_list in calendar_grid.items():
-        for ev in ev_list:
-            concrete_date = ev.get('event_date')
-            if not concrete_date:
-                concrete_date = day_dates.get(ev.get('day'))
-            ev['concrete_date'] = concrete_date
-            ev['is_passed'] = is_event_passed(concrete_date, ev.get('end_time'))
-            # Calcola disponibilità
-            ev['available_slots'] = ev['max_slots'] - ev['registered']
-            ev['is_available'] = ev['available_slots'] > 0 and not ev['is_passed']
-    
-    # Ordina gli eventi per orario di inizio
-    for day in days:
-        calendar_grid[day].sort(key=lambda x: x['start_time'])
+    views, day_dates = week_event_views(state, display_week, days)
+    calendar_grid = group_by_day(views, days)
     
+    kiosk = request.path == '/display/kiosk'
     return render_template("display.html", calendar_grid=calendar_grid, days=days, 
-                         display_week=display_week, active_week=active_week, day_dates=day_dates)
+                         display_week=display_week, active_week=active_week, day_dates=day_dates,
+                         kiosk=kiosk, kiosk_state=display_state(state) if kiosk else None,
+                         rotate_url=DISPLAY_ROTATE_URL, rotate_seconds=DISPLAY_ROTATE_SECONDS)
+
+@app.route('/display/data')
+def display_data():
+    """Stato del display in JSON: il kiosk lo ricarica solo dopo un resync o un cambio di settimana"""
+    auto_update_display_week()
+    
+    return jsonify(display_state(read_model.snapshot()))
 
 @app.route('/admin')
 @admin_required
+@etag_cached(lambda: page_key(realtime=True))
 def admin_panel():
     # Pagina admin per aggiungere eventi - mostra settimana selezionata
     week = request.args.get('week', type=int)
     
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
+    # Eventi, partecipanti, whitelist e impostazioni dal read model
+    state = read_model.snapshot()
     
     # Ottieni settimana attiva
-    c.execute("SELECT value FROM settings WHERE key = 'active_week'")
-    active_week = int(c.fetchone()[0])
+    active_week = state.int_setting('active_week')
     
     # Ottieni settimana display
-    c.execute("SELECT value FROM settings WHERE key = 'display_week'")
-    display_week_row = c.fetchone()
-    display_week = int(display_week_row[0]) if display_week_row else active_week
+    display_week = state.int_setting('display_week', active_week)
     
     # Ottieni numero massimo di eventi per utente
-    c.execute("SELECT value FROM settings WHERE key = 'max_events_per_user'")
-    max_events_result = c.fetchone()
-    max_events_per_user = int(max_events_result[0]) if max_events_result else 0
+    max_events_per_user = state.int_setting('max_events_per_user')
     
     # Se non specificata, mostra settimana attiva
     if week is None:
         week = active_week
     
-    c.execute("""SELECT * FROM events WHERE week = ? ORDER BY CASE day 
-        WHEN 'Lunedì' THEN 1 
-        WHEN 'Martedì' THEN 2 
-        WHEN 'Mercoledì' THEN 3 
-        WHEN 'Giovedì' THEN 4 
-        WHEN 'Venerdì' THEN 5 
-        END, start_time""", (week,))
-    events = c.fetchall()
-    
-    # Prendi i partecipanti per ogni evento CON stato di presenza
-    events_with_participants = []
-    for event in events:
-        c.execute("SELECT participant_name, registration_date, attended FROM registrations WHERE event_id = ? ORDER BY registration_date", (event[0],))
-        participants_raw = c.fetchall()
-        participants_all = [p[0] for p in participants_raw]
-        participants_visible = [p[0] for p in participants_raw if (p[2] == 1 or p[2] == '1' or p[2] is True)]
-
-        # registered (admin view uses stored registered, but keep attended-based count as well)
-        attended_count = len(participants_visible)
-
-        events_with_participants.append({
-            'id': event[0],
-            'title': event[1],
-            'description': event[2],
-            'day': event[3],
-            'event_date': event[10] if len(event) > 10 else None,
-            'start_time': event[4],
-            'end_time': event[5],
-            'max_slots': event[6],
-            'registered': event[7],
-            'registered_visible': attended_count,
-            'compensation': event[8] if len(event) > 8 else 0,
-            'week': event[9] if len(event) > 9 else 1,
-            'participants_raw': participants_raw,
-            'participants_all': participants_all,
-            'participants_visible': participants_visible
-        })
+    # Prendi i partecipanti per ogni evento CON stato di presenza (ordinati per giorno e orario)
+    events_with_participants = [EventView(event, state.event_registrations(event.id)) for event in state.week_events(week)]
     
     # Organizza eventi per giorno
     days = ['Lunedì', 'Martedì', 'Mercoledì', 'Giovedì', 'Venerdì', 'Sabato', 'Domenica']
     events_by_day = {day: [] for day in days}
     
     for event in events_with_participants:
-        if event['day'] in events_by_day:
-            events_by_day[event['day']].append(event)
+        if event.day in events_by_day:
+            events_by_day[event.day].append(event)
+    
+    conn = sqlite3.connect(DB_PATH)
+    c = conn.cursor()
     
     # Carica i template di settimana
     c.execute("""
@@ -1071,22 +1645,34 @@ def admin_panel():
             'event_count': t[5]
         })
     
-    # Carica whitelist baywatcher
-    c.execute("SELECT id, intra_login, added_at FROM baywatcher_whitelist ORDER BY intra_login")
-    whitelist_raw = c.fetchall()
-    whitelist = [{'id': w[0], 'login': w[1], 'added_at': w[2]} for w in whitelist_raw]
+    # Whitelist baywatcher
+    whitelist = state.whitelist
     
     # Load pool start for admin view to show dates
-    c.execute("SELECT value FROM settings WHERE key = 'pool_start'")
-    pool_start_row = c.fetchone()
-    pool_start = pool_start_row[0] if pool_start_row else None
-    c.execute("SELECT value FROM settings WHERE key = 'pool_end'")
-    pool_end_row = c.fetchone()
-    pool_end = pool_end_row[0] if pool_end_row else None
+    pool_start = state.setting('pool_start')
+    pool_end = state.setting('pool_end')
     day_dates = compute_week_day_dates(pool_start, week)
 
+    # Ultime campagne broadcast
+    c.execute("""
+        SELECT id, title, audience, status, total, sent, failed, pruned, created_at
+        FROM broadcast_campaigns
+        ORDER BY id DESC
+        LIMIT 5
+    """)
+    broadcasts = [
+        {'id': b[0], 'title': b[1], 'audience': b[2], 'status': b[3], 'total': b[4],
+         'sent': b[5], 'failed': b[6], 'pruned': b[7], 'created_at': b[8]}
+        for b in c.fetchall()
+    ]
+
+    # Sorteggio della settimana: finestra e richieste per evento
+    allocation = state.allocations.get(week)
+    if allocation:
+        allocation = dict(allocation, demand=dict(run(c, 'preferences_demand_week', (week,)).fetchall()))
+
     conn.close()
-    return render_template("admin.html", events=events_with_participants, events_by_day=events_by_day, current_week=week, active_week=active_week, display_week=display_week, max_events_per_user=max_events_per_user, templates=templates, whitelist=whitelist, day_dates=day_dates, pool_start=pool_start, pool_end=pool_end)
+    return render_template("admin.html", events=events_with_participants, events_by_day=events_by_day, current_week=week, active_week=active_week, display_week=display_week, max_events_per_user=max_events_per_user, templates=templates, whitelist=whitelist, day_dates=day_dates, pool_start=pool_start, pool_end=pool_end, broadcasts=broadcasts, allocation=allocation, push_enabled=notification_manager is not None)
 
 
 @app.route('/admin/set_pool_dates', methods=['POST'])
@@ -1105,9 +1691,15 @@ def set_pool_dates():
         conn = sqlite3.connect(DB_PATH)
         c = conn.cursor()
         if pool_start:
-            c.execute("INSERT OR REPLACE INTO settings (key, value) VALUES ('pool_start', ?)", (pool_start,))
+            run(c, 'setting_put', ('pool_start', pool_start))
         if pool_end:
-            c.execute("INSERT OR REPLACE INTO settings (key, value) VALUES ('pool_end', ?)", (pool_end,))
+            run(c, 'setting_put', ('pool_end', pool_end))
+    
+        # Change feed
+        if pool_start:
+            record_setting_change(c, 'pool_start', pool_start)
+        if pool_end:
+            record_setting_change(c, 'pool_end', pool_end)
     
         log_id = log_action(
             user_id=session['user']['id'],
@@ -1123,7 +1715,9 @@ def set_pool_dates():
     finally:
         if conn:
             conn.close()
-            
+    
+    # Le date dei giorni cambiano per tutte le settimane
+    emit_week_changed()
     flash('Date pool salvate con successo', 'success')
     return redirect(url_for('admin_panel'))
 
@@ -1133,8 +1727,22 @@ def set_active_week(week):
     if 1 <= week <= 4:
         conn = sqlite3.connect(DB_PATH)
         c = conn.cursor()
-        c.execute("UPDATE settings SET value = ? WHERE key = 'active_week'", (str(week),))
+        run(c, 'setting_set', (str(week), 'active_week'))
+
+        # Notifica push opzionale ai baywatcher in whitelist
+        campaign_id = None
+        if notification_manager and request.form.get('notify_push') == '1':
+            campaign_id = notification_manager.create_broadcast(
+                c,
+                title=f"📅 Week {week} aperta!",
+                body=f"Le iscrizioni per la Week {week} sono aperte, prenota i tuoi turni.",
+                url='/calendar',
+                audience='whitelist',
+                created_by=session['user']['login']
+            )
 
+        # Change feed
+        record_setting_change(c, 'active_week', str(week))
         # Log action
         log_id = log_action(
             user_id=session['user']['id'],
@@ -1149,14 +1757,342 @@ def set_active_week(week):
 
         if log_id:
             emit_log_update(log_id)
+        if campaign_id:
+            start_broadcast(campaign_id)
 
         # Notifica tutti i client del cambio di settimana attiva
-        socketio.emit('week_activated', {
+        live_updates.emit('week_activated', {
             'week': week,
             'message': f'Week {week} è stata attivata!'
         })
     return redirect(url_for('admin_panel'))
 
+@app.route('/admin/broadcast', methods=['POST'])
+@admin_required
+def admin_broadcast():
+    """Invia un annuncio push a tutti gli iscritti (o solo ai baywatcher in whitelist)"""
+    if not notification_manager:
+        flash('Notifiche push non configurate', 'danger')
+        return redirect(url_for('admin_panel'))
+
+    title = request.form.get('title', '').strip()
+    body = request.form.get('body', '').strip()
+    url = request.form.get('url', '').strip() or '/'
+    audience = request.form.get('audience', 'all')
+
+    if not title or not body:
+        flash('Titolo e messaggio sono obbligatori', 'danger')
+        return redirect(url_for('admin_panel'))
+    if audience not in ('all', 'whitelist'):
+        flash('Destinatari non validi', 'danger')
+        return redirect(url_for('admin_panel'))
+
+    conn = sqlite3.connect(DB_PATH)
+    c = conn.cursor()
+    campaign_id = notification_manager.create_broadcast(
+        c, title=title, body=body, url=url, audience=audience,
+        created_by=session['user']['login']
+    )
+
+    # Log action
+    log_id = log_action(
+        user_id=session['user']['id'],
+        username=session['user']['login'],
+        action_type='BROADCAST',
+        description=f"Broadcast push '{title}' ({'whitelist' if audience == 'whitelist' else 'tutti'})",
+        resource_type='broadcast',
+        resource_id=str(campaign_id),
+        cursor=c
+    )
+    conn.commit()
+    conn.close()
+
+    if log_id:
+        emit_log_update(log_id)
+    start_broadcast(campaign_id)
+
+    flash('📣 Broadcast avviato', 'success')
+    return redirect(url_for('admin_panel'))
+
+@app.route('/admin/broadcast/<int:campaign_id>')
+@admin_required
+def admin_broadcast_status(campaign_id):
+    """Avanzamento di una campagna broadcast (JSON, usato dal pannello admin)"""
+    conn = sqlite3.connect(DB_PATH)
+    conn.row_factory = sqlite3.Row
+    c = conn.cursor()
+    c.execute("""
+        SELECT id, title, audience, status, total, sent, failed, pruned, error_message,
+               created_by, created_at, started_at, finished_at
+        FROM broadcast_campaigns WHERE id = ?
+    """, (campaign_id,))
+    campaign = c.fetchone()
+    if not campaign:
+        conn.close()
+        return jsonify({'error': 'Campaign not found'}), 404
+
+    c.execute("""
+        SELECT status_code, COUNT(*) AS count
+        FROM broadcast_failures
+        WHERE campaign_id = ?
+        GROUP BY status_code
+    """, (campaign_id,))
+    failures = {str(row['status_code'] or 'error'): row['count'] for row in c.fetchall()}
+    conn.close()
+
+    return jsonify({**dict(campaign), 'failures_by_status': failures})
+
+# -------------------------------
+# Sorteggio (settimane a lotteria)
+# -------------------------------
+# Ogni quanti secondi il loop in background chiude le finestre scadute
+ALLOCATION_CHECK_SECONDS = int(os.getenv('ALLOCATION_CHECK_SECONDS', '15'))
+ALLOCATION_TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+def run_allocation(week, actor=None):
+    """
+    Chiude la finestra di sorteggio di una settimana e trasforma le preferenze in
+    iscrizioni (vedi allocation.allocate) in un'unica transazione. La chiusura è
+    un claim sulla riga di week_allocations: con più processi avviene una volta sola.
+    actor: utente della sessione (None = chiusura automatica allo scadere).
+    
+    Restituisce il numero di iscrizioni assegnate, o None se la finestra non era aperta.
+    """
+    actor = actor or {'id': 0, 'login': 'system'}
+    seed = random.randrange(2 ** 31)
+    conn = sqlite3.connect(DB_PATH, timeout=30)
+    c = conn.cursor()
+    try:
+        c.execute('BEGIN IMMEDIATE')
+        if run(c, 'allocation_close', (datetime.now(), seed, week)).rowcount == 0:
+            conn.rollback()
+            return None
+
+        # Posti liberi degli eventi non ancora passati
+        pool_row = run(c, 'setting_get', ('pool_start',)).fetchone()
+        day_dates = compute_week_day_dates(pool_row[0] if pool_row else None, week)
+        events = {}
+        for event in run(c, 'events_by_week', (week,)).fetchall():
+            event_date = event.concrete_date(day_dates)
+            if not is_event_passed(event_date, event.end_time):
+                events[event.id] = (event, event_date)
+        capacity = {event_id: max(0, event.max_slots - event.registered) for event_id, (event, _) in events.items()}
+
+        preferences, existing = {}, {}
+        for event_id, login in run(c, 'preferences_by_week', (week,)).fetchall():
+            preferences.setdefault(login, []).append(event_id)
+        for event_id, login in run(c, 'registrations_by_week', (week,)).fetchall():
+            existing.setdefault(login, set()).add(event_id)
+        max_events_result = run(c, 'setting_get', ('max_events_per_user',)).fetchone()
+        max_events_per_user = int(max_events_result[0]) if max_events_result else 0
+
+        assignments = allocate(preferences, capacity, limit=max_events_per_user, existing=existing, seed=seed)
+        registrations = []
+        for event_id, login in assignments:
+            run(c, 'registration_insert', (event_id, login, 1))
+            registrations.append((event_id, login, c.lastrowid))
+        run_many(c, 'event_registered_add', [(count, event_id) for event_id, count in Counter(e for e, _ in assignments).items()])
+        run(c, 'preferences_delete_week', (week,))
+
+        # Change feed: gli eventi della settimana cambiano tutti insieme
+        record_week_change(c, week)
+        record_allocation_change(c, week)
+
+        # Esito a tutti con un solo broadcast, invece di una notifica per iscrizione
+        campaign_id = None
+        if notification_manager and assignments:
+            campaign_id = notification_manager.create_broadcast(
+                c,
+                title=f"🎲 Sorteggio Week {week} concluso",
+                body="I posti sono stati assegnati: apri il calendario per vedere i tuoi turni.",
+                url='/calendar',
+                audience='whitelist',
+                created_by=actor['login']
+            )
+
+        # Log action
+        log_id = log_action(
+            user_id=actor['id'],
+            username=actor['login'],
+            action_type='ALLOCATE_WEEK',
+            description=(f"Sorteggio Week {week}: {len(assignments)} iscrizioni assegnate a "
+                         f"{len({login for _, login in assignments})} di {len(preferences)} richiedenti (seed {seed})"),
+            resource_type='allocation',
+            resource_id=str(week),
+            cursor=c
+        )
+        conn.commit()
+    finally:
+        conn.close()
+
+    # Promemoria delle nuove iscrizioni, programmati in blocco
+    if notification_manager and registrations:
+        try:
+            users = read_model.snapshot().users
+            scheduled = []
+            for event_id, login, registration_id in registrations:
+                event, event_date = events[event_id]
+                if login in users and event_date:
+                    event_datetime = datetime.strptime(f"{event_date} {event.start_time}", '%Y-%m-%d %H:%M')
+                    scheduled.append((users[login].intra_id, event_id, registration_id, event_datetime))
+            notification_manager.schedule_registrations(scheduled)
+        except Exception as e:
+            app.logger.error(f"❌ Failed to schedule allocation notifications: {e}")
+
+    if log_id:
+        emit_log_update(log_id)
+    if campaign_id:
+        start_broadcast(campaign_id)
+
+    if not has_request_context():
+        # Chiusura automatica: nessuna fine richiesta che aggiorni read model e versioni
+        read_model.sync()
+        data_versions.bump(change_scopes('week', week) + change_scopes('allocation', week))
+    emit_week_changed(week)
+    app.logger.info(f"🎲 Sorteggio Week {week}: {len(assignments)} iscrizioni assegnate (seed {seed})")
+    return len(assignments)
+
+def allocation_loop():
+    """Chiude le finestre di sorteggio scadute (ogni processo controlla, uno solo assegna)"""
+    while True:
+        socketio.sleep(ALLOCATION_CHECK_SECONDS)
+        try:
+            conn = sqlite3.connect(DB_PATH)
+            try:
+                due = [row[0] for row in run(conn.cursor(), 'allocations_due', (datetime.now().strftime(ALLOCATION_TIME_FORMAT),)).fetchall()]
+            finally:
+                conn.close()
+            for week in due:
+                run_allocation(week)
+        except Exception as e:
+            app.logger.error(f"❌ Sorteggio automatico fallito: {e}")
+
+socketio.start_background_task(allocation_loop)
+
+@app.route('/admin/allocation/<int:week>', methods=['POST'])
+@admin_required
+def open_allocation(week):
+    """Apre (o sposta la chiusura di) la finestra di sorteggio di una settimana"""
+    try:
+        closes_at = datetime.strptime(request.form.get('closes_at', ''), '%Y-%m-%dT%H:%M')
+    except ValueError:
+        flash('Data di chiusura del sorteggio non valida', 'danger')
+        return redirect(url_for('admin_panel'))
+    if not 1 <= week <= 4 or closes_at <= datetime.now():
+        flash('La chiusura del sorteggio deve essere nel futuro', 'danger')
+        return redirect(url_for('admin_panel'))
+
+    conn = sqlite3.connect(DB_PATH)
+    c = conn.cursor()
+    window = run(c, 'allocation_window', (week,)).fetchone()
+    if window and window[1] != 'open':
+        conn.close()
+        flash(f'Il sorteggio della Week {week} è già stato eseguito', 'warning')
+        return redirect(url_for('admin_panel'))
+
+    run(c, 'allocation_open', (week, closes_at.strftime(ALLOCATION_TIME_FORMAT), session['user']['login'], datetime.now()))
+    # Change feed
+    record_allocation_change(c, week)
+    # Log action
+    log_id = log_action(
+        user_id=session['user']['id'],
+        username=session['user']['login'],
+        action_type='OPEN_ALLOCATION',
+        description=f"Sorteggio Week {week} aperto fino al {closes_at.strftime('%d/%m/%Y %H:%M')}",
+        resource_type='allocation',
+        resource_id=str(week),
+        cursor=c
+    )
+    conn.commit()
+    conn.close()
+
+    if log_id:
+        emit_log_update(log_id)
+    emit_week_changed(week)
+    flash(f"🎲 Sorteggio Week {week} aperto fino al {closes_at.strftime('%d/%m/%Y %H:%M')}", 'success')
+    return redirect(url_for('admin_panel'))
+
+@app.route('/admin/allocation/<int:week>/run', methods=['POST'])
+@admin_required
+def run_allocation_now(week):
+    """Chiude subito la finestra di sorteggio e assegna i posti"""
+    assigned = run_allocation(week, actor=session['user'])
+    if assigned is None:
+        flash(f'Nessun sorteggio aperto per la Week {week}', 'warning')
+    else:
+        flash(f'🎲 Sorteggio Week {week} concluso: {assigned} iscrizioni assegnate', 'success')
+    return redirect(url_for('admin_panel'))
+
+@app.route('/admin/allocation/<int:week>/cancel', methods=['POST'])
+@admin_required
+def cancel_allocation(week):
+    """Annulla il sorteggio aperto: le richieste vengono scartate e le iscrizioni tornano in ordine di arrivo"""
+    conn = sqlite3.connect(DB_PATH)
+    c = conn.cursor()
+    window = run(c, 'allocation_window', (week,)).fetchone()
+    if not window or window[1] != 'open':
+        conn.close()
+        flash(f'Nessun sorteggio aperto per la Week {week}', 'warning')
+        return redirect(url_for('admin_panel'))
+
+    requests_count = run(c, 'preferences_delete_week', (week,)).rowcount
+    run(c, 'allocation_delete', (week,))
+    # Change feed
+    record_allocation_change(c, week)
+    # Log action
+    log_id = log_action(
+        user_id=session['user']['id'],
+        username=session['user']['login'],
+        action_type='CANCEL_ALLOCATION',
+        description=f"Sorteggio Week {week} annullato ({requests_count} richieste scartate)",
+        resource_type='allocation',
+        resource_id=str(week),
+        cursor=c
+    )
+    conn.commit()
+    conn.close()
+
+    if log_id:
+        emit_log_update(log_id)
+    emit_week_changed(week)
+    flash(f'Sorteggio Week {week} annullato', 'success')
+    return redirect(url_for('admin_panel'))
+
+@app.route('/admin/retention')
+@admin_required
+def admin_retention():
+    """Contatori del motore di retention (JSON). Con ?pending=1 conta anche le righe ancora da pulire"""
+    if not notification_manager:
+        return jsonify({'error': 'Notification system not configured'}), 503
+
+    retention = notification_manager.retention
+    result = {'policies': retention.stats()}
+    if request.args.get('pending') == '1':
+        result['pending'] = retention.pending_counts()
+    return jsonify(result)
+
+@app.route('/admin/live')
+@admin_required
+def admin_live():
+    """
+    Metriche degli aggiornamenti real-time (JSON): client connessi, code in uscita, messaggi scartati, 304,
+    stato del read model e della sala d'attesa. Con ?check=1 confronta subito il read model con il database.
+    """
+    result = dict(live_updates.stats(), http_cache={
+        'data_version': data_versions.version(),
+        'not_modified': etag_store.hits,
+        'rendered': etag_store.misses,
+        'coalesced': calendar_flights.coalesced
+    })
+    if request.args.get('check') == '1':
+        differences = read_model.check()
+        if differences:
+            data_versions.bump(READ_MODEL_SCOPES)
+        result['read_model_differences'] = differences
+    result['read_model'] = read_model.stats()
+    result['admission'] = admission.stats()
+    return jsonify(result)
+
 @app.route('/set_max_events_per_user', methods=['POST'])
 @admin_required
 def set_max_events_per_user():
@@ -1164,7 +2100,9 @@ def set_max_events_per_user():
     if max_events >= 0:  # 0 = illimitato
         conn = sqlite3.connect(DB_PATH)
         c = conn.cursor()
-        c.execute("UPDATE settings SET value = ? WHERE key = 'max_events_per_user'", (str(max_events),))
+        run(c, 'setting_set', (str(max_events), 'max_events_per_user'))
+        # Change feed
+        record_setting_change(c, 'max_events_per_user', str(max_events))
 
         # Log action
         log_id = log_action(
@@ -1183,6 +2121,7 @@ def set_max_events_per_user():
     return redirect(url_for('admin_panel'))
 
 @app.route('/add_event', methods=['POST'])
+@admin_required
 def add_event():
     event_type = request.form['event_type']
     day = request.form['day']
@@ -1235,6 +2174,8 @@ def add_event():
     )
     event_id = c.lastrowid
 
+    # Change feed
+    record_event_change(c, event_id)
     # Log action
     log_id = log_action(
         user_id=session['user']['id'],
@@ -1257,96 +2198,212 @@ def add_event():
     
     return redirect(url_for('admin_panel', week=week))
 
-@app.route('/register/<int:event_id>', methods=['POST'])
-@login_required
-def register(event_id):
-    # Utente si iscrive a un evento con il proprio login 42
-    participant_name = session['user']['login']
+# Esiti delle iscrizioni rifiutate: messaggio per l'utente e status HTTP delle API
+REGISTRATION_ERRORS = {
+    'not_whitelisted': ('⚠️ Non sei autorizzato a iscriverti agli eventi Baywatcher! Contatta lo staff per maggiori informazioni.', 403),
+    'not_found': ('Evento non trovato', 404),
+    'passed': ('⏰ Non puoi iscriverti a un evento già passato!', 409),
+    'unregister_passed': ('⏰ Non puoi disiscriverti da un evento già passato!', 409),
+    'limit_reached': ('Hai raggiunto il limite massimo di {limit} eventi per questa settimana!', 409),
+    'already_registered': ('Sei già iscritto a questo evento', 409),
+    'full': ('Evento al completo', 409),
+    'not_registered': ('Non sei iscritto a questo evento', 409),
+    'already_requested': ('Hai già chiesto di partecipare al sorteggio di questo evento', 409),
+    'allocation_pending': ('🎲 Sorteggio in corso: riprova tra qualche secondo', 409),
+    'not_full': ('Ci sono ancora posti liberi: iscriviti direttamente', 409),
+    'already_waitlisted': ('Sei già in lista d\'attesa per questo evento', 409),
+    'not_waitlisted': ('Non sei in lista d\'attesa per questo evento', 409),
+    'waitlist_closed': ('🎲 Durante il sorteggio non ci sono liste d\'attesa: partecipa al sorteggio', 409),
+}
+
+# Esiti riusciti: iscrizione e disiscrizione, o richiesta e ritiro durante un sorteggio
+REGISTRATION_SUCCESS = ('registered', 'unregistered', 'requested', 'request_withdrawn', 'waitlisted', 'left_waitlist')
+
+def registration_error(code, **kwargs):
+    """Messaggio e status HTTP di un esito di iscrizione rifiutata"""
+    message, status = REGISTRATION_ERRORS[code]
+    return message.format(**kwargs), status
+
+def wants_json():
+    """Richiesta fatta con fetch (Accept: application/json) invece che da un form HTML"""
+    return request.accept_mimetypes.best == 'application/json'
+
+def allocation_status(window, now=None):
+    """Stato di una finestra di sorteggio (riga closes_at, status): None, 'open' o 'closing' (scaduta, da assegnare)"""
+    if not window or window[1] != 'open':
+        return None
+    now = now or datetime.now()
+    return 'open' if now.strftime(ALLOCATION_TIME_FORMAT) < window[0] else 'closing'
+
+def promote_waitlist(c, event_id):
+    """
+    Iscrive i primi della lista d'attesa finché l'evento ha posti liberi, nella
+    transazione del chiamante (NON esegue il commit). Ogni promozione legge la
+    testa della coda dall'indice (event_id, id) e la rimuove; chi nel frattempo
+    non può più iscriversi (fuori whitelist, già iscritto, limite settimanale)
+    esce dalla lista. Niente promozioni per eventi passati o con il sorteggio
+    aperto: lì i posti liberi vanno al sorteggio.
+    
+    Restituisce le promozioni da completare dopo il commit con finish_promotions.
+    """
+    event = run(c, 'event_by_id', (event_id,)).fetchone()
+    if not event or event.registered >= event.max_slots:
+        return []
+    pool_row = run(c, 'setting_get', ('pool_start',)).fetchone()
+    event_date = event.concrete_date(compute_week_day_dates(pool_row[0] if pool_row else None, event.week))
+    if is_event_passed(event_date, event.end_time) or allocation_status(run(c, 'allocation_window', (event.week,)).fetchone()):
+        return []
+    max_events_result = run(c, 'setting_get', ('max_events_per_user',)).fetchone()
+    max_events_per_user = int(max_events_result[0]) if max_events_result else 0
+    users = read_model.snapshot().users
+    
+    promotions = []
+    while event.registered + len(promotions) < event.max_slots:
+        head = run(c, 'waitlist_head', (event_id,)).fetchone()
+        if head is None:
+            break
+        entry_id, login = head
+        run(c, 'waitlist_pop', (entry_id,))
+        if (run(c, 'whitelist_contains', (login,)).fetchone()[0] == 0
+                or run(c, 'registration_exists', (event_id, login)).fetchone()[0] > 0
+                or (max_events_per_user > 0 and
+                    run(c, 'registrations_count_user_week', (login, event.week)).fetchone()[0] >= max_events_per_user)):
+            continue
+        
+        run(c, 'registration_insert', (event_id, login, 1))
+        registration_id = c.lastrowid
+        user_id = users[login].intra_id if login in users else None
+        
+        # Push nella stessa transazione: parte solo se la promozione viene salvata
+        push_queued = False
+        if notification_manager and user_id:
+            push_queued = notification_manager.enqueue_push(
+                c, user_id,
+                title="🎉 Si è liberato un posto!",
+                body=f"Sei stato iscritto a {event.title} ({event.day}, {event.start_time}-{event.end_time}).",
+                url='/calendar',
+                tag=f'waitlist-{event_id}'
+            )
+        # Log action
+        log_id = log_action(
+            user_id=user_id or 0,
+            username=login,
+            action_type='WAITLIST_PROMOTE',
+            description=f"Utente '{login}' promosso dalla lista d'attesa all'evento '{event.title}' ({event.day}, {event.start_time}-{event.end_time}, ID: {event_id}).",
+            resource_id=str(event_id),
+            cursor=c
+        )
+        promotions.append({'event': event, 'event_date': event_date, 'login': login, 'user_id': user_id,
+                           'registration_id': registration_id, 'log_id': log_id, 'push_queued': push_queued})
+    
+    if promotions:
+        run(c, 'event_registered_add', (len(promotions), event_id))
+    return promotions
+
+def finish_promotions(promotions):
+    """Dopo il commit: promemoria, log live e avviso al solo utente promosso (Socket.IO e push)"""
+    if not promotions:
+        return
+    if notification_manager:
+        try:
+            notification_manager.schedule_registrations([
+                (p['user_id'], p['event'].id, p['registration_id'],
+                 datetime.strptime(f"{p['event_date']} {p['event'].start_time}", '%Y-%m-%d %H:%M'))
+                for p in promotions if p['user_id'] and p['event_date']
+            ])
+        except Exception as e:
+            app.logger.error(f"❌ Failed to schedule notifications: {e}")
+    
+    for p in promotions:
+        event = p['event']
+        if p['log_id']:
+            emit_log_update(p['log_id'])
+        live_updates.emit('waitlist_promoted', {
+            'event_id': event.id, 'week': event.week, 'title': event.title,
+            'day': event.day, 'start_time': event.start_time, 'end_time': event.end_time
+        }, room=user_room(p['login']))
+        # Senza job queue il push parte da qui, in background
+        if notification_manager and p['user_id'] and not p['push_queued']:
+            socketio.start_background_task(
+                notification_manager.send_push_notification, p['user_id'],
+                "🎉 Si è liberato un posto!",
+                f"Sei stato iscritto a {event.title} ({event.day}, {event.start_time}-{event.end_time}).",
+                url='/calendar', tag=f'waitlist-{event.id}'
+            )
+        app.logger.info(f"🎉 {p['login']} promosso dalla lista d'attesa dell'evento {event.id}")
+
+def register_user(event_id, user):
+    """
+    Iscrive l'utente della sessione a un evento: whitelist, evento passato,
+    limite settimanale, posti. Restituisce (esito, limite eventi per utente):
+    'registered' oppure il codice di REGISTRATION_ERRORS.
+    Nelle settimane a sorteggio, finché la finestra è aperta, salva solo la
+    preferenza ('requested'): niente limite, posti, log né notifiche.
+    """
+    participant_name = user['login']
     
     conn = sqlite3.connect(DB_PATH)
     c = conn.cursor()
-    
-    # CONTROLLO WHITELIST: verifica se l'utente è autorizzato
-    c.execute("SELECT COUNT(*) FROM baywatcher_whitelist WHERE intra_login = ?", (participant_name,))
-    is_whitelisted = c.fetchone()[0] > 0
-    
-    if not is_whitelisted:
-        conn.close()
-        flash('⚠️ Non sei autorizzato a iscriverti agli eventi Baywatcher! Contatta lo staff per maggiori informazioni.', 'danger')
-        return redirect(url_for('home'))
-    
-    # CONTROLLO ORARIO: verifica se l'evento è già passato
-    c.execute("SELECT title, day, start_time, end_time, week, event_date FROM events WHERE id = ?", (event_id,))
-    event_time = c.fetchone()
-    if event_time:
-        event_title, event_day, start_time, end_time, event_week, event_date_db = event_time
-
+    try:
+        # CONTROLLO WHITELIST: verifica se l'utente è autorizzato
+        if run(c, 'whitelist_contains', (participant_name,)).fetchone()[0] == 0:
+            return 'not_whitelisted', None
+        
+        event = run(c, 'event_by_id', (event_id,)).fetchone()
+        if not event:
+            return 'not_found', None
+        
+        # CONTROLLO ORARIO: verifica se l'evento è già passato
         # If no per-event date, compute from global pool_start and week mapping
-        if not event_date_db:
-            c2 = sqlite3.connect(DB_PATH).cursor()
-            conn2 = sqlite3.connect(DB_PATH)
-            c2 = conn2.cursor()
-            c2.execute("SELECT value FROM settings WHERE key = 'pool_start'")
-            pool_row = c2.fetchone()
-            pool_start = pool_row[0] if pool_row else None
-            conn2.close()
-            computed_dates = compute_week_day_dates(pool_start, event_week)
-            event_date_db = computed_dates.get(event_day)
-
-        if is_event_passed(event_date_db, end_time):
-            conn.close()
-            flash('⏰ Non puoi iscriverti a un evento già passato!', 'danger')
-            return redirect(url_for('home'))
-    
-    # Ottieni il limite massimo di eventi per utente
-    c.execute("SELECT value FROM settings WHERE key = 'max_events_per_user'")
-    max_events_result = c.fetchone()
-    max_events_per_user = int(max_events_result[0]) if max_events_result else 0
-    
-    # Controlla quanti eventi l'utente ha già prenotato nella settimana corrente
-    if max_events_per_user > 0:  # 0 = illimitato
-        # Ottieni la settimana dell'evento
-        c.execute("SELECT week FROM events WHERE id = ?", (event_id,))
-        event_week_result = c.fetchone()
-        if event_week_result:
-            event_week = event_week_result[0]
-            
-            # Conta quanti eventi l'utente ha già nella stessa settimana
-            c.execute("""
-                SELECT COUNT(*) FROM registrations r
-                JOIN events e ON r.event_id = e.id
-                WHERE r.participant_name = ? AND e.week = ?
-            """, (participant_name, event_week))
-            current_events_count = c.fetchone()[0]
-            
+        pool_row = run(c, 'setting_get', ('pool_start',)).fetchone()
+        pool_start = pool_row[0] if pool_row else None
+        event_date_db = event.concrete_date(compute_week_day_dates(pool_start, event.week))
+        if is_event_passed(event_date_db, event.end_time):
+            return 'passed', None
+        
+        # SETTIMANA A SORTEGGIO: solo una preferenza, i posti vengono assegnati alla chiusura
+        lottery = allocation_status(run(c, 'allocation_window', (event.week,)).fetchone())
+        if lottery == 'closing':
+            return 'allocation_pending', None
+        if lottery == 'open':
+            if run(c, 'registration_exists', (event_id, participant_name)).fetchone()[0] > 0:
+                return 'already_registered', None
+            if run(c, 'preference_insert', (event.week, event_id, participant_name, datetime.now())).rowcount == 0:
+                return 'already_requested', None
+            record_allocation_change(c, event.week)
+            conn.commit()
+            return 'requested', None
+        
+        # Ottieni il limite massimo di eventi per utente
+        max_events_result = run(c, 'setting_get', ('max_events_per_user',)).fetchone()
+        max_events_per_user = int(max_events_result[0]) if max_events_result else 0
+        
+        # Controlla quanti eventi l'utente ha già prenotato nella settimana dell'evento (0 = illimitato)
+        if max_events_per_user > 0:
+            current_events_count = run(c, 'registrations_count_user_week', (participant_name, event.week)).fetchone()[0]
             if current_events_count >= max_events_per_user:
-                conn.close()
-                # Usa flash message per notificare l'utente
-                flash(f'Hai raggiunto il limite massimo di {max_events_per_user} eventi per questa settimana!', 'danger')
-                return redirect(url_for('home'))
-    
-    # Controlla se ci sono posti disponibili
-    c.execute("SELECT registered, max_slots FROM events WHERE id = ?", (event_id,))
-    result = c.fetchone()
-    
-    # Controlla se l'utente è già iscritto
-    c.execute("SELECT COUNT(*) FROM registrations WHERE event_id = ? AND participant_name = ?", 
-              (event_id, participant_name))
-    already_registered = c.fetchone()[0] > 0
-    
-    if result and result[0] < result[1] and not already_registered:
-        # Aggiungi registrazione
-        c.execute("INSERT INTO registrations (event_id, participant_name) VALUES (?, ?)", 
-                  (event_id, participant_name))
+                return 'limit_reached', max_events_per_user
+        
+        # Controlla se l'utente è già iscritto e se ci sono posti disponibili
+        if run(c, 'registration_exists', (event_id, participant_name)).fetchone()[0] > 0:
+            return 'already_registered', max_events_per_user
+        if event.registered >= event.max_slots:
+            return 'full', max_events_per_user
+        
+        # Aggiungi registrazione (ed esci dalla lista d'attesa, se c'eri)
+        run(c, 'registration_insert', (event_id, participant_name, 1))
         registration_id = c.lastrowid
+        run(c, 'waitlist_leave', (event_id, participant_name))
         
         # Aggiorna contatore
-        c.execute("UPDATE events SET registered = registered + 1 WHERE id = ?", (event_id,))
+        run(c, 'event_registered_increment', (event_id,))
         
-        log_description = f"Utente '{participant_name}' registrato all'evento '{event_title}' ({event_day}, {start_time}-{end_time}, ID: {event_id})."
+        log_description = f"Utente '{participant_name}' registrato all'evento '{event.title}' ({event.day}, {event.start_time}-{event.end_time}, ID: {event_id})."
+        # Change feed
+        record_event_change(c, event_id)
         # Log action
         log_id = log_action(
-            user_id=session['user']['id'],
+            user_id=user['id'],
             username=participant_name,
             action_type='REGISTER_EVENT',
             description=log_description,
@@ -1354,85 +2411,84 @@ def register(event_id):
             cursor=c
         )
         conn.commit()
+    finally:
+        conn.close()
 
-        # Schedule push notifications for this registration
-        if notification_manager and event_date_db:
-            try:
-                # Parse event date and time to create full datetime
-                event_date_obj = datetime.strptime(event_date_db, '%Y-%m-%d')
-                start_h, start_m = map(int, start_time.split(':'))
-                event_datetime = event_date_obj.replace(hour=start_h, minute=start_m)
-                
-                notification_manager.schedule_event_notifications(
-                    user_id=session['user']['id'],
-                    event_id=event_id,
-                    registration_id=registration_id,
-                    event_datetime=event_datetime
-                )
-                app.logger.info(f"📅 Scheduled notifications for user {session['user']['id']}, event {event_id}")
-            except Exception as e:
-                app.logger.error(f"❌ Failed to schedule notifications: {e}")
+    # Schedule push notifications for this registration
+    if notification_manager and event_date_db:
+        try:
+            # Parse event date and time to create full datetime
+            event_date_obj = datetime.strptime(event_date_db, '%Y-%m-%d')
+            start_h, start_m = map(int, event.start_time.split(':'))
+            event_datetime = event_date_obj.replace(hour=start_h, minute=start_m)
+            
+            notification_manager.schedule_event_notifications(
+                user_id=user['id'],
+                event_id=event_id,
+                registration_id=registration_id,
+                event_datetime=event_datetime
+            )
+            app.logger.info(f"📅 Scheduled notifications for user {user['id']}, event {event_id}")
+        except Exception as e:
+            app.logger.error(f"❌ Failed to schedule notifications: {e}")
 
-        if log_id:
-            emit_log_update(log_id)
+    if log_id:
+        emit_log_update(log_id)
 
-        # Emetti aggiornamento live
-        emit_event_update(event_id, 'update')
-    
-    conn.close()
-    return redirect(url_for('home', registered_event_id=event_id))
+    # Emetti aggiornamento live
+    emit_event_update(event_id, 'update')
+    return 'registered', max_events_per_user
 
-@app.route('/unregister/<int:event_id>', methods=['POST'])
-@login_required
-def unregister(event_id):
-    # Utente si disiscreve dal proprio evento
-    participant_name = session['user']['login']
+def unregister_user(event_id, user):
+    """
+    Disiscrive l'utente della sessione da un evento (gli admin anche da eventi passati).
+    Restituisce 'unregistered' oppure il codice di REGISTRATION_ERRORS.
+    """
+    participant_name = user['login']
     
     conn = sqlite3.connect(DB_PATH)
     c = conn.cursor()
-    # Controllo: se l'evento è già passato, impedisci la disiscrizione per utenti non-admin
-    c.execute("SELECT title, day, start_time, end_time, week, event_date FROM events WHERE id = ?", (event_id,))
-    evt = c.fetchone()
-    if evt:
-        event_title, event_day, start_time, end_time, event_week, event_date_db = evt
-
-        # If no per-event date, compute from global pool_start and week mapping
-        if not event_date_db:
-            conn2 = sqlite3.connect(DB_PATH)
-            c2 = conn2.cursor()
-            c2.execute("SELECT value FROM settings WHERE key = 'pool_start'")
-            pool_row = c2.fetchone()
-            pool_start = pool_row[0] if pool_row else None
-            conn2.close()
-            computed_dates = compute_week_day_dates(pool_start, event_week)
-            event_date_db = computed_dates.get(event_day)
-
-        # Se l'evento è passato e l'utente non è admin, blocca la cancellazione
-        if is_event_passed(event_date_db, end_time) and not session.get('user', {}).get('is_admin', False):
-            conn.close()
-            flash('⏰ Non puoi disiscriverti da un evento già passato!', 'danger')
-            return redirect(url_for('home'))
-    
-    # Trova e rimuovi solo la propria registrazione (usando ROWID per rimuovere solo una)
-    c.execute("SELECT id FROM registrations WHERE event_id = ? AND participant_name = ? LIMIT 1", 
-              (event_id, participant_name))
-    reg_row = c.fetchone()
-    registration_id = reg_row[0] if reg_row else None
-    
-    c.execute("""DELETE FROM registrations WHERE rowid = (
-        SELECT rowid FROM registrations 
-        WHERE event_id = ? AND participant_name = ? 
-        LIMIT 1
-    )""", (event_id, participant_name))
-    
-    if c.rowcount > 0:
+    try:
+        event = run(c, 'event_by_id', (event_id,)).fetchone()
+        if not event:
+            return 'not_found'
+        
+        # If no per-event date, compute from global pool_start and week mapping
+        pool_row = run(c, 'setting_get', ('pool_start',)).fetchone()
+        pool_start = pool_row[0] if pool_row else None
+        event_date_db = event.concrete_date(compute_week_day_dates(pool_start, event.week))
+        
+        # Se l'evento è passato e l'utente non è admin, blocca la cancellazione
+        if is_event_passed(event_date_db, event.end_time) and not user.get('is_admin', False):
+            return 'unregister_passed'
+        
+        # SETTIMANA A SORTEGGIO: ritira la preferenza (se non c'è, disiscrizione normale)
+        if allocation_status(run(c, 'allocation_window', (event.week,)).fetchone()) == 'open':
+            if run(c, 'preference_delete', (event_id, participant_name)).rowcount:
+                record_allocation_change(c, event.week)
+                conn.commit()
+                return 'request_withdrawn'
+        
+        # Trova e rimuovi solo la propria registrazione (usando ROWID per rimuovere solo una)
+        reg_row = run(c, 'registration_id', (event_id, participant_name)).fetchone()
+        registration_id = reg_row[0] if reg_row else None
+        
+        run(c, 'registration_delete_one', (event_id, participant_name))
+        if c.rowcount == 0:
+            return 'not_registered'
+        
         # Aggiorna contatore solo se è stata rimossa una registrazione
-        c.execute("UPDATE events SET registered = registered - 1 WHERE id = ? AND registered > 0", (event_id,))
+        run(c, 'event_registered_decrement', (event_id,))
+        
+        # Il posto liberato va al primo della lista d'attesa
+        promotions = promote_waitlist(c, event_id)
         
-        log_description = f"Utente '{participant_name}' disiscritto dall'evento '{event_title}' ({event_day}, {start_time}-{end_time}, ID: {event_id})."
+        log_description = f"Utente '{participant_name}' disiscritto dall'evento '{event.title}' ({event.day}, {event.start_time}-{event.end_time}, ID: {event_id})."
+        # Change feed
+        record_event_change(c, event_id)
         # Log action
         log_id = log_action(
-            user_id=session['user']['id'],
+            user_id=user['id'],
             username=participant_name,
             action_type='UNREGISTER_EVENT',
             description=log_description,
@@ -1440,25 +2496,165 @@ def unregister(event_id):
             cursor=c
         )
         conn.commit()
+    finally:
+        conn.close()
 
-        # Cancel scheduled notifications for this registration
-        if notification_manager and registration_id:
-            try:
-                notification_manager.cancel_event_notifications(registration_id)
-                app.logger.info(f"🗑️ Cancelled notifications for registration {registration_id}")
-            except Exception as e:
-                app.logger.error(f"❌ Failed to cancel notifications: {e}")
+    # Cancel scheduled notifications for this registration
+    if notification_manager and registration_id:
+        try:
+            notification_manager.cancel_event_notifications(registration_id)
+            app.logger.info(f"🗑️ Cancelled notifications for registration {registration_id}")
+        except Exception as e:
+            app.logger.error(f"❌ Failed to cancel notifications: {e}")
 
-        if log_id:
-            emit_log_update(log_id)
+    if log_id:
+        emit_log_update(log_id)
+    finish_promotions(promotions)
 
-        # Emetti aggiornamento live
-        emit_event_update(event_id, 'update')
+    # Emetti aggiornamento live
+    emit_event_update(event_id, 'update')
+    return 'unregistered'
+
+def record_waitlist_change(c, event_id):
+    """Registra nel change feed la lunghezza della lista d'attesa di un evento"""
+    waiting = run(c, 'waitlist_size', (event_id,)).fetchone()[0]
+    return record_change(c, 'waitlist', 'upsert', event_id, {'event_id': event_id, 'waiting': waiting})
+
+def join_waitlist(event_id, user):
+    """
+    Mette l'utente della sessione in coda a un evento pieno: al primo posto che
+    si libera viene iscritto automaticamente (vedi promote_waitlist), senza dover
+    ricaricare il calendario. Restituisce (esito, posizione in coda): 'waitlisted'
+    oppure il codice di REGISTRATION_ERRORS.
+    """
+    participant_name = user['login']
     
-    conn.close()
+    conn = sqlite3.connect(DB_PATH)
+    c = conn.cursor()
+    try:
+        if run(c, 'whitelist_contains', (participant_name,)).fetchone()[0] == 0:
+            return 'not_whitelisted', None
+        
+        event = run(c, 'event_by_id', (event_id,)).fetchone()
+        if not event:
+            return 'not_found', None
+        
+        pool_row = run(c, 'setting_get', ('pool_start',)).fetchone()
+        event_date_db = event.concrete_date(compute_week_day_dates(pool_row[0] if pool_row else None, event.week))
+        if is_event_passed(event_date_db, event.end_time):
+            return 'passed', None
+        if allocation_status(run(c, 'allocation_window', (event.week,)).fetchone()):
+            return 'waitlist_closed', None
+        if run(c, 'registration_exists', (event_id, participant_name)).fetchone()[0] > 0:
+            return 'already_registered', None
+        if event.registered < event.max_slots:
+            return 'not_full', None
+        
+        if run(c, 'waitlist_join', (event_id, participant_name, datetime.now())).rowcount == 0:
+            return 'already_waitlisted', None
+        position = run(c, 'waitlist_position', (event_id, event_id, participant_name)).fetchone()[0]
+        # Change feed
+        record_waitlist_change(c, event_id)
+        conn.commit()
+    finally:
+        conn.close()
+    return 'waitlisted', position
+
+def leave_waitlist(event_id, user):
+    """Toglie l'utente della sessione dalla lista d'attesa di un evento: 'left_waitlist' o 'not_waitlisted'"""
+    conn = sqlite3.connect(DB_PATH)
+    c = conn.cursor()
+    try:
+        if run(c, 'waitlist_leave', (event_id, user['login'])).rowcount == 0:
+            return 'not_waitlisted'
+        # Change feed
+        record_waitlist_change(c, event_id)
+        conn.commit()
+    finally:
+        conn.close()
+    return 'left_waitlist'
+
+@app.route('/waiting-room/status')
+@login_required
+def waiting_room_status():
+    """Posizione in coda (solo memoria, nessuna query). admitted=true: è il turno, ripetere la richiesta"""
+    decision = admission.status(session.get('admission_ticket'))
+    if decision.entered:
+        if 'admission_ticket' in session:
+            session.pop('admission_ticket')
+        if decision.pass_token:
+            session['admission_pass'] = decision.pass_token
+        response = jsonify({'admitted': True})
+    else:
+        session['admission_ticket'] = decision.ticket
+        response = jsonify({'admitted': False, 'position': decision.position, 'eta_seconds': decision.eta_seconds})
+    response.headers['Cache-Control'] = 'no-store'
+    return response
+
+@app.route('/register/<int:event_id>', methods=['POST'])
+@login_required
+@admission_controlled
+@idempotent
+def register(event_id):
+    # Utente si iscrive a un evento con il proprio login 42
+    outcome, max_events_per_user = register_user(event_id, session['user'])
+    if wants_json():
+        # Dal calendario via fetch: stato aggiornato dell'evento invece del redirect
+        return registration_json(event_id, outcome, max_events_per_user)
+    if outcome == 'requested':
+        flash('🎲 Richiesta registrata: i posti di questa settimana vengono assegnati a sorteggio alla chiusura', 'info')
+        return redirect(url_for('home'))
+    if outcome != 'registered':
+        flash(registration_error(outcome, limit=max_events_per_user)[0], 'danger')
+        return redirect(url_for('home'))
+    return redirect(url_for('home', registered_event_id=event_id))
+
+@app.route('/unregister/<int:event_id>', methods=['POST'])
+@login_required
+@admission_controlled
+@idempotent
+def unregister(event_id):
+    # Utente si disiscreve dal proprio evento
+    outcome = unregister_user(event_id, session['user'])
+    if wants_json():
+        return registration_json(event_id, outcome)
+    if outcome == 'request_withdrawn':
+        flash('Richiesta di sorteggio ritirata', 'info')
+    elif outcome != 'unregistered':
+        flash(registration_error(outcome)[0], 'danger')
+    return redirect(url_for('home'))
+
+@app.route('/waitlist/<int:event_id>', methods=['POST'])
+@login_required
+@admission_controlled
+@idempotent
+def waitlist_join(event_id):
+    # Utente entra nella lista d'attesa di un evento pieno
+    outcome, position = join_waitlist(event_id, session['user'])
+    if wants_json():
+        return registration_json(event_id, outcome, waitlist_position=position)
+    if outcome == 'waitlisted':
+        flash(f'⏳ Sei in lista d\'attesa (posizione {position}): al primo posto libero verrai iscritto automaticamente', 'info')
+    else:
+        flash(registration_error(outcome)[0], 'danger')
+    return redirect(url_for('home'))
+
+@app.route('/waitlist/<int:event_id>/leave', methods=['POST'])
+@login_required
+@idempotent
+def waitlist_leave(event_id):
+    # Utente esce dalla lista d'attesa
+    outcome = leave_waitlist(event_id, session['user'])
+    if wants_json():
+        return registration_json(event_id, outcome)
+    if outcome == 'left_waitlist':
+        flash('Sei uscito dalla lista d\'attesa', 'info')
+    else:
+        flash(registration_error(outcome)[0], 'danger')
     return redirect(url_for('home'))
 
 @app.route('/delete_event/<int:event_id>', methods=['POST'])
+@admin_required
 def delete_event(event_id):
     # Admin elimina un evento
     try:
@@ -1466,19 +2662,21 @@ def delete_event(event_id):
         c = conn.cursor()
         
         # Ottieni info per il log prima di cancellare
-        c.execute("SELECT title, week FROM events WHERE id = ?", (event_id,))
-        event_info = c.fetchone()
+        event_info = run(c, 'event_by_id', (event_id,)).fetchone()
         
-        # Elimina prima le registrazioni associate
-        c.execute("DELETE FROM registrations WHERE event_id = ?", (event_id,))
+        # Elimina prima le registrazioni e le notifiche programmate associate
+        run(c, 'registrations_delete_by_event', (event_id,))
+        run(c, 'notifications_delete_by_event', (event_id,))
         # Poi elimina l'evento
         c.execute("DELETE FROM events WHERE id = ?", (event_id,))
 
+        # Change feed
+        record_change(c, 'event', 'delete', event_id)
         log_id = log_action(
             user_id=session['user']['id'],
             username=session['user']['login'],
             action_type='DELETE_EVENT',
-            description=f"Eliminato evento '{event_info[0]}' (ID: {event_id}) dalla settimana {event_info[1]}.",
+            description=f"Eliminato evento '{event_info.title}' (ID: {event_id}) dalla settimana {event_info.week}.",
             resource_id=str(event_id),
             cursor=c
         )
@@ -1491,7 +2689,7 @@ def delete_event(event_id):
             conn.close()
             
     # Emetti aggiornamento live (delete)
-    socketio.emit('event_update', {'id': event_id, 'action': 'delete'})
+    live_updates.emit('event_update', {'id': event_id, 'action': 'delete'})
     
     return redirect(url_for('admin_panel'))
 
@@ -1534,8 +2732,7 @@ def edit_event(event_id):
     c = conn.cursor()
     
     # Log action
-    c.execute("SELECT * FROM events WHERE id = ?", (event_id,))
-    old_event_data = c.fetchone()
+    old_event = run(c, 'event_by_id', (event_id,)).fetchone()
     log_id = log_action(
         user_id=session['user']['id'],
         username=session['user']['login'],
@@ -1543,7 +2740,7 @@ def edit_event(event_id):
         description=f"Aggiornato evento '{title}' (ID: {event_id}).",
         resource_id=str(event_id),
         resource_type='event',
-        old_value=str(old_event_data),
+        old_value=str(old_event.to_dict() if old_event else None),
         new_value=str(request.form.to_dict()),
         cursor=c
     )
@@ -1555,10 +2752,19 @@ def edit_event(event_id):
         WHERE id = ?
     """, (capitalize_event_title(title), capitalize_event_title(description), day, start_time, end_time, max_slots, compensation, event_id))
     
+    # Più posti: vanno ai primi della lista d'attesa
+    promotions = []
+    if old_event and max_slots and max_slots.isdigit() and int(max_slots) > old_event.max_slots:
+        promotions = promote_waitlist(c, event_id)
+    
+    # Change feed
+    record_event_change(c, event_id)
+    
     conn.commit()
     if log_id:
         emit_log_update(log_id)
     conn.close()
+    finish_promotions(promotions)
     
     # Emetti aggiornamento live
     emit_event_update(event_id, 'update')
@@ -1629,6 +2835,8 @@ def save_template():
             event.get('compensation', 0)
         ))
     
+    # Change feed
+    record_change(c, 'template', 'upsert', template_id, {'name': template_name, 'target_week': target_week})
     # Log action e commit
     log_id = log_action(
         user_id=session['user']['id'],
@@ -1649,6 +2857,7 @@ def save_template():
 
 @app.route('/apply_template/<int:template_id>', methods=['POST'])
 @admin_required
+@idempotent
 def apply_template(template_id):
     # Applica un template alla settimana target creando tutti gli eventi
     overwrite = request.form.get('overwrite', 'false') == 'true'
@@ -1672,11 +2881,9 @@ def apply_template(template_id):
     
     if existing_events_count > 0 and overwrite:
         # Elimina tutti gli eventi esistenti nella settimana (con registrazioni)
-        c.execute("SELECT id FROM events WHERE week = ?", (target_week,))
-        event_ids = [row[0] for row in c.fetchall()]
-        
-        for event_id in event_ids:
-            c.execute("DELETE FROM registrations WHERE event_id = ?", (event_id,))
+        event_ids = [(row[0],) for row in run(c, 'event_ids_by_week', (target_week,)).fetchall()]
+        run_many(c, 'registrations_delete_by_event', event_ids)
+        run_many(c, 'notifications_delete_by_event', event_ids)
         
         c.execute("DELETE FROM events WHERE week = ?", (target_week,))
     elif existing_events_count > 0 and not overwrite:
@@ -1706,6 +2913,8 @@ def apply_template(template_id):
         """, (capitalize_event_title(title), capitalize_event_title(description), day, start_time, end_time, max_slots, compensation, target_week))
         created_count += 1
 
+    # Change feed
+    record_week_change(c, target_week)
     # Log action
     log_id = log_action(
         user_id=session['user']['id'],
@@ -1720,6 +2929,7 @@ def apply_template(template_id):
     if log_id:
         emit_log_update(log_id)
     conn.close()
+    emit_week_changed(target_week)
     
     if overwrite and existing_events_count > 0:
         flash(f'Template "{template_name}" applicato! Eliminati {existing_events_count} eventi esistenti e creati {created_count} nuovi eventi nella Week {target_week}', 'success')
@@ -1741,6 +2951,8 @@ def delete_template(template_id):
     
     c.execute("DELETE FROM week_templates WHERE id = ?", (template_id,))
 
+    # Change feed
+    record_change(c, 'template', 'delete', template_id)
     # Log action
     log_id = log_action(
         user_id=session['user']['id'],
@@ -1893,6 +3105,7 @@ def import_csv_templates():
             """, (template_name, template_description, week))
             
             template_id = c.lastrowid
+            record_change(c, 'template', 'upsert', template_id, {'name': template_name, 'target_week': week})
             
             # Aggiungi tutti gli eventi al template
             for event in events:
@@ -1938,27 +3151,28 @@ def import_csv_templates():
         return redirect(url_for('admin_panel'))
 
 @app.route('/admin_unregister/<int:event_id>/<participant_name>', methods=['POST'])
+@admin_required
 def admin_unregister(event_id, participant_name):
     # Admin disiscreve un partecipante
     conn = sqlite3.connect(DB_PATH)
     c = conn.cursor()
     
     # Ottieni dettagli evento per il log
-    c.execute("SELECT title, day, start_time, end_time FROM events WHERE id = ?", (event_id,))
-    event_info = c.fetchone()
+    event_info = run(c, 'event_by_id', (event_id,)).fetchone()
     
     # Rimuovi la registrazione (usando ROWID per rimuovere solo una)
-    c.execute("""DELETE FROM registrations WHERE rowid = (
-        SELECT rowid FROM registrations 
-        WHERE event_id = ? AND participant_name = ? 
-        LIMIT 1
-    )""", (event_id, participant_name))
+    run(c, 'registration_delete_one', (event_id, participant_name))
     
     if c.rowcount > 0:
         # Aggiorna contatore
-        c.execute("UPDATE events SET registered = registered - 1 WHERE id = ? AND registered > 0", (event_id,))
+        run(c, 'event_registered_decrement', (event_id,))
+        
+        # Il posto liberato va al primo della lista d'attesa
+        promotions = promote_waitlist(c, event_id)
         
-        log_description = f"Admin ha disiscritto '{participant_name}' dall'evento '{event_info[0]}' ({event_info[1]}, {event_info[2]}-{event_info[3]}, ID: {event_id})."
+        log_description = f"Admin ha disiscritto '{participant_name}' dall'evento '{event_info.title}' ({event_info.day}, {event_info.start_time}-{event_info.end_time}, ID: {event_id})."
+        # Change feed
+        record_event_change(c, event_id)
         # Log action
         log_id = log_action(
             user_id=session['user']['id'],
@@ -1972,6 +3186,7 @@ def admin_unregister(event_id, participant_name):
 
         if log_id:
             emit_log_update(log_id)
+        finish_promotions(promotions)
 
         # Emetti aggiornamento live
         emit_event_update(event_id, 'update')
@@ -1981,6 +3196,7 @@ def admin_unregister(event_id, participant_name):
 
 @app.route('/admin/add_participant/<int:event_id>', methods=['POST'])
 @admin_required
+@idempotent
 def admin_add_participant(event_id):
     """Admin aggiunge manualmente un partecipante tramite login intra (BYPASS limite posti)"""
     intra_login = request.form.get('intra_login', '').strip().lower()
@@ -1992,32 +3208,30 @@ def admin_add_participant(event_id):
     c = conn.cursor()
     
     # Ottieni dettagli evento per il log e per il redirect
-    c.execute("SELECT title, day, start_time, end_time, week FROM events WHERE id = ?", (event_id,))
-    event = c.fetchone()
+    event = run(c, 'event_by_id', (event_id,)).fetchone()
     
     if not event:
         conn.close()
         return redirect(url_for('admin_panel'))
     
-    event_title, event_day, start_time, end_time, week = event
+    week = event.week
     
     # Controlla se l'utente è già iscritto
-    c.execute("SELECT COUNT(*) FROM registrations WHERE event_id = ? AND participant_name = ?", 
-              (event_id, intra_login))
-    if c.fetchone()[0] > 0:
+    if run(c, 'registration_exists', (event_id, intra_login)).fetchone()[0] > 0:
         # Già iscritto
         conn.close()
         flash(f'{intra_login} è già iscritto a questo evento', 'warning')
         return redirect(url_for('admin_panel', week=week))
     
     # ADMIN BYPASS: Aggiungi l'utente anche se l'evento è pieno
-    c.execute("INSERT INTO registrations (event_id, participant_name, attended) VALUES (?, ?, 1)",
-              (event_id, intra_login))
+    run(c, 'registration_insert', (event_id, intra_login, 1))
     
     # Aggiorna il contatore
-    c.execute("UPDATE events SET registered = registered + 1 WHERE id = ?", (event_id,))
+    run(c, 'event_registered_increment', (event_id,))
     
-    log_description = f"Admin ha aggiunto '{intra_login}' all'evento '{event_title}' ({event_day}, {start_time}-{end_time}, ID: {event_id})."
+    log_description = f"Admin ha aggiunto '{intra_login}' all'evento '{event.title}' ({event.day}, {event.start_time}-{event.end_time}, ID: {event_id})."
+    # Change feed
+    record_event_change(c, event_id)
     # Log action
     log_id = log_action(
         user_id=session['user']['id'],
@@ -2041,23 +3255,21 @@ def admin_add_participant(event_id):
 
 @app.route('/admin/mark_absent/<int:event_id>/<participant_name>', methods=['POST'])
 @admin_required
+@idempotent
 def mark_absent(event_id, participant_name):
     """Admin segna un partecipante come assente (non partecipato)"""
     conn = sqlite3.connect(DB_PATH)
     c = conn.cursor()
     
     # Ottieni dettagli evento per il log
-    c.execute("SELECT title, day, start_time, end_time FROM events WHERE id = ?", (event_id,))
-    event_info = c.fetchone()
+    event_info = run(c, 'event_by_id', (event_id,)).fetchone()
     
     # Aggiorna lo stato di presenza
-    c.execute("""
-        UPDATE registrations 
-        SET attended = 0 
-        WHERE event_id = ? AND participant_name = ?
-    """, (event_id, participant_name))
+    run(c, 'registration_set_attended', (0, event_id, participant_name))
     
-    log_description = f"Segnato '{participant_name}' come assente per l'evento '{event_info[0]}' ({event_info[1]}, {event_info[2]}-{event_info[3]}, ID: {event_id})."
+    log_description = f"Segnato '{participant_name}' come assente per l'evento '{event_info.title}' ({event_info.day}, {event_info.start_time}-{event_info.end_time}, ID: {event_id})."
+    # Change feed
+    record_event_change(c, event_id)
     # Log action
     log_id = log_action(
         user_id=session['user']['id'],
@@ -2082,23 +3294,21 @@ def mark_absent(event_id, participant_name):
 
 @app.route('/admin/mark_present/<int:event_id>/<participant_name>', methods=['POST'])
 @admin_required
+@idempotent
 def mark_present(event_id, participant_name):
     """Admin segna un partecipante come presente"""
     conn = sqlite3.connect(DB_PATH)
     c = conn.cursor()
     
     # Ottieni dettagli evento per il log
-    c.execute("SELECT title, day, start_time, end_time FROM events WHERE id = ?", (event_id,))
-    event_info = c.fetchone()
+    event_info = run(c, 'event_by_id', (event_id,)).fetchone()
     
     # Aggiorna lo stato di presenza
-    c.execute("""
-        UPDATE registrations 
-        SET attended = 1 
-        WHERE event_id = ? AND participant_name = ?
-    """, (event_id, participant_name))
+    run(c, 'registration_set_attended', (1, event_id, participant_name))
     
-    log_description = f"Segnato '{participant_name}' come presente per l'evento '{event_info[0]}' ({event_info[1]}, {event_info[2]}-{event_info[3]}, ID: {event_id})."
+    log_description = f"Segnato '{participant_name}' come presente per l'evento '{event_info.title}' ({event_info.day}, {event_info.start_time}-{event_info.end_time}, ID: {event_id})."
+    # Change feed
+    record_event_change(c, event_id)
     # Log action
     log_id = log_action(
         user_id=session['user']['id'],
@@ -2130,16 +3340,18 @@ def delete_day_events(week, day):
         c = conn.cursor()
         
         # Ottieni tutti gli ID degli eventi del giorno
-        c.execute("SELECT id FROM events WHERE week = ? AND day = ?", (week, day))
-        event_ids = [row[0] for row in c.fetchall()]
+        event_ids = [row[0] for row in run(c, 'event_ids_by_week_day', (week, day)).fetchall()]
         
-        # Elimina tutte le registrazioni associate agli eventi del giorno
+        # Elimina tutte le registrazioni e le notifiche associate agli eventi del giorno
         if event_ids:
             c.execute(f"DELETE FROM registrations WHERE event_id IN ({','.join('?' for _ in event_ids)})", event_ids)
+            c.execute(f"DELETE FROM scheduled_notifications WHERE event_id IN ({','.join('?' for _ in event_ids)})", event_ids)
         
         # Elimina tutti gli eventi del giorno
         c.execute("DELETE FROM events WHERE week = ? AND day = ?", (week, day))
 
+        # Change feed
+        record_week_change(c, week)
         log_id = log_action(
             user_id=session['user']['id'],
             username=session['user']['login'],
@@ -2155,7 +3367,8 @@ def delete_day_events(week, day):
     finally:
         if conn:
             conn.close()
-            
+    
+    emit_week_changed(week)
     return redirect(url_for('admin_panel', week=week))
 
 @app.route('/admin/delete_week_events/<int:week>', methods=['POST'])
@@ -2167,16 +3380,18 @@ def delete_week_events(week):
         c = conn.cursor()
         
         # Ottieni tutti gli ID degli eventi della settimana
-        c.execute("SELECT id FROM events WHERE week = ?", (week,))
-        event_ids = [row[0] for row in c.fetchall()]
+        event_ids = [row[0] for row in run(c, 'event_ids_by_week', (week,)).fetchall()]
         
-        # Elimina tutte le registrazioni associate agli eventi della settimana
+        # Elimina tutte le registrazioni e le notifiche associate agli eventi della settimana
         if event_ids:
             c.execute(f"DELETE FROM registrations WHERE event_id IN ({','.join('?' for _ in event_ids)})", event_ids)
+            c.execute(f"DELETE FROM scheduled_notifications WHERE event_id IN ({','.join('?' for _ in event_ids)})", event_ids)
         
         # Elimina tutti gli eventi della settimana
         c.execute("DELETE FROM events WHERE week = ?", (week,))
 
+        # Change feed
+        record_week_change(c, week)
         log_id = log_action(
             user_id=session['user']['id'],
             username=session['user']['login'],
@@ -2192,7 +3407,8 @@ def delete_week_events(week):
     finally:
         if conn:
             conn.close()
-            
+    
+    emit_week_changed(week)
     return redirect(url_for('admin_panel', week=week))
 
 @app.route('/admin/delete_all_events', methods=['POST'])
@@ -2203,12 +3419,15 @@ def delete_all_events():
         conn = sqlite3.connect(DB_PATH)
         c = conn.cursor()
         
-        # Elimina tutte le registrazioni
+        # Elimina tutte le registrazioni e le notifiche programmate
         c.execute("DELETE FROM registrations")
+        c.execute("DELETE FROM scheduled_notifications")
         
         # Elimina tutti gli eventi
         c.execute("DELETE FROM events")
 
+        # Change feed
+        record_change(c, 'event', 'delete_all')
         log_id = log_action(
             user_id=session['user']['id'],
             username=session['user']['login'],
@@ -2223,85 +3442,44 @@ def delete_all_events():
     finally:
         if conn:
             conn.close()
-            
+    
+    emit_week_changed()
     return redirect(url_for('admin_panel'))
 
 @app.route('/admin/participants_summary')
 @admin_required
 def participants_summary():
-    # Riepilogo completo di tutti i partecipanti con statistiche
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    
-    # Ottieni tutti i partecipanti unici
-    c.execute("SELECT DISTINCT participant_name FROM registrations ORDER BY participant_name")
-    participants = [p[0] for p in c.fetchall()]
+    # Riepilogo completo di tutti i partecipanti con statistiche (dal read model)
+    state = read_model.snapshot()
+    pool_start = state.setting('pool_start')
     
     participants_stats = []
-    for participant in participants:
-        # Conta solo gli eventi a cui ha effettivamente partecipato (attended = 1)
-        c.execute("SELECT COUNT(*) FROM registrations WHERE participant_name = ? AND attended = 1", (participant,))
-        num_events = c.fetchone()[0]
+    for participant in state.participants():
+        # Eventi con stato presenza; la data concreta è calcolata da pool_start se event_date manca
+        events = [
+            ParticipantEvent(e, r, e.concrete_date(compute_week_day_dates(pool_start, e.week)))
+            for e, r in state.participant_events(participant)
+        ]
 
-        # Ottieni dettagli eventi con orari e compensi (includi stato presenza)
-        # Also select event.week so we can compute concrete dates from pool_start when event_date is missing
-        c.execute("""
-            SELECT e.title, e.day, e.start_time, e.end_time, e.compensation, r.registration_date, r.attended, e.event_date, e.week
-            FROM registrations r
-            JOIN events e ON r.event_id = e.id
-            WHERE r.participant_name = ?
-            ORDER BY CASE e.day 
-                WHEN 'Lunedì' THEN 1 
-                WHEN 'Martedì' THEN 2 
-                WHEN 'Mercoledì' THEN 3 
-                WHEN 'Giovedì' THEN 4 
-                WHEN 'Venerdì' THEN 5 
-            END, e.start_time
-        """, (participant,))
-        events = c.fetchall()
+        # Conta solo gli eventi a cui ha effettivamente partecipato (attended = 1)
+        num_events = sum(1 for event in events if event.attended == 1)
 
         # Calcola ore totali e compenso totale (solo eventi partecipati)
         total_hours = 0
         total_compensation = 0
         events_by_week = {}
-        # Load global pool_start once
-        c.execute("SELECT value FROM settings WHERE key = 'pool_start'")
-        pool_row = c.fetchone()
-        pool_start = pool_row[0] if pool_row else None
 
         for event in events:
-            title, day, start_time, end_time, compensation, reg_date, attended, event_date, event_week = event
-            # Calcola durata in ore
             # Skip events with missing times
-            if not start_time or not end_time or ':' not in start_time or ':' not in end_time:
+            if event.duration is None:
                 continue
-            start_h, start_m = map(int, start_time.split(':'))
-            end_h, end_m = map(int, end_time.split(':'))
-            duration = (end_h * 60 + end_m - start_h * 60 - start_m) / 60
 
             # Conta solo se ha partecipato
-            if attended == 1:
-                total_hours += duration
-                total_compensation += compensation if compensation else 0
+            if event.attended == 1:
+                total_hours += event.duration
+                total_compensation += event.compensation or 0
 
-            # If event_date not set, compute from pool_start / week mapping
-            if not event_date:
-                computed = compute_week_day_dates(pool_start, event_week)
-                event_date = computed.get(day)
-
-            if event_week not in events_by_week:
-                events_by_week[event_week] = []
-            events_by_week[event_week].append({
-                'title': title,
-                'day': day,
-                'event_date': event_date,
-                'start_time': start_time,
-                'end_time': end_time,
-                'duration': duration,
-                'compensation': compensation if compensation else 0,
-                'registration_date': reg_date,
-                'attended': attended
-            })
+            events_by_week.setdefault(event.week, []).append(event)
 
         participants_stats.append({
             'name': participant,
@@ -2311,19 +3489,16 @@ def participants_summary():
             'events_by_week': events_by_week
         })
     
-    conn.close()
     return render_template("participants_summary.html", participants_stats=participants_stats)
 
 @app.route('/admin/download_all_participants_csv')
 @admin_required
 def download_all_participants_csv():
     """Download CSV sintetico di tutti i partecipanti"""
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
+    state = read_model.snapshot()
     
     # Ottieni tutti i partecipanti unici
-    c.execute("SELECT DISTINCT participant_name FROM registrations ORDER BY participant_name")
-    participants = [p[0] for p in c.fetchall()]
+    participants = state.participants()
     
     # Crea CSV in memoria
     output = io.StringIO()
@@ -2334,33 +3509,21 @@ def download_all_participants_csv():
     
     # Dati
     for participant in participants:
-        # Conta solo gli eventi effettivamente partecipati
-        c.execute("SELECT COUNT(*) FROM registrations WHERE participant_name = ? AND attended = 1", (participant,))
-        num_events = c.fetchone()[0]
+        events = state.participant_events(participant)
         
-        c.execute("""
-            SELECT e.start_time, e.end_time, e.compensation, r.attended
-            FROM registrations r
-            JOIN events e ON r.event_id = e.id
-            WHERE r.participant_name = ?
-        """, (participant,))
-        events = c.fetchall()
+        # Conta solo gli eventi effettivamente partecipati
+        num_events = sum(1 for event, registration in events if registration.attended == 1)
         
         total_hours = 0
         total_compensation = 0
-        for start_time, end_time, compensation, attended in events:
-            start_h, start_m = map(int, start_time.split(':'))
-            end_h, end_m = map(int, end_time.split(':'))
-            duration = (end_h * 60 + end_m - start_h * 60 - start_m) / 60
-            
+        for event, registration in events:
             # Conta solo se ha partecipato
-            if attended == 1:
-                total_hours += duration
-                total_compensation += compensation if compensation else 0
+            if registration.attended == 1:
+                total_hours += event.duration
+                total_compensation += event.compensation or 0
         
         writer.writerow([participant, num_events, round(total_hours, 2), total_compensation])
     
-    conn.close()
     
     # Crea response
     output.seek(0)
@@ -2373,12 +3536,13 @@ def download_all_participants_csv():
 @admin_required
 def download_all_participants_detailed_csv():
     """Download CSV dettagliato di tutti i partecipanti (una riga per partecipante con eventi raggruppati)"""
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
+    state = read_model.snapshot()
     
     # Ottieni tutti i partecipanti unici
-    c.execute("SELECT DISTINCT participant_name FROM registrations ORDER BY participant_name")
-    participants = [p[0] for p in c.fetchall()]
+    participants = state.participants()
+    
+    # Global pool_start to compute derived dates
+    pool_start = state.setting('pool_start')
     
     # Crea CSV in memoria
     output = io.StringIO()
@@ -2396,81 +3560,45 @@ def download_all_participants_detailed_csv():
     # Per ogni partecipante
     for participant_name in participants:
         # Ottieni tutti gli eventi del partecipante (con stato presenza)
-        # Also fetch event_date and week so we can compute/format concrete dates
-        c.execute("""
-            SELECT e.title, e.day, e.start_time, e.end_time, e.compensation, r.attended, e.event_date, e.week
-            FROM registrations r
-            JOIN events e ON r.event_id = e.id
-            WHERE r.participant_name = ?
-            ORDER BY CASE e.day 
-                WHEN 'Lunedì' THEN 1 
-                WHEN 'Martedì' THEN 2 
-                WHEN 'Mercoledì' THEN 3 
-                WHEN 'Giovedì' THEN 4 
-                WHEN 'Venerdì' THEN 5 
-            END, e.start_time
-        """, (participant_name,))
-        events = c.fetchall()
+        # La data concreta è calcolata da pool_start se event_date manca
+        events = [
+            ParticipantEvent(e, r, e.concrete_date(compute_week_day_dates(pool_start, e.week)))
+            for e, r in state.participant_events(participant_name)
+        ]
         
         # Calcola totali e crea lista eventi (conta solo se attended = 1)
         total_hours = 0
         total_compensation = 0
         events_list = []
-        
-        # Load global pool_start once for this participant to compute derived dates
-        c.execute("SELECT value FROM settings WHERE key = 'pool_start'")
-        pool_row = c.fetchone()
-        pool_start = pool_row[0] if pool_row else None
 
         for event in events:
-            title, day, start_time, end_time, compensation, attended, event_date, event_week = event
-            
-            # Calcola durata evento
-            start_h, start_m = map(int, start_time.split(':'))
-            end_h, end_m = map(int, end_time.split(':'))
-            duration = round((end_h * 60 + end_m - start_h * 60 - start_m) / 60, 2)
+            duration = round(event.duration, 2)
+            compensation = event.compensation or 0
+
+            # Format date as DD/MM/YYYY for CSV
+            event_date = event.concrete_date
+            if event_date:
+                try:
+                    date_formatted = f"{event_date[8:10]}/{event_date[5:7]}/{event_date[0:4]}"
+                except Exception:
+                    date_formatted = event_date
+            else:
+                date_formatted = ''
             
             # Conta ore e compenso solo se ha partecipato
-            if attended == 1:
+            if event.attended == 1:
                 total_hours += duration
-                total_compensation += compensation if compensation else 0
-                # If event_date not set, compute from pool_start / week mapping
-                if not event_date:
-                    computed = compute_week_day_dates(pool_start, event_week)
-                    event_date = computed.get(day)
-
-                # Format date as DD/MM/YYYY for CSV
-                if event_date:
-                    try:
-                        date_formatted = f"{event_date[8:10]}/{event_date[5:7]}/{event_date[0:4]}"
-                    except Exception:
-                        date_formatted = event_date
-                else:
-                    date_formatted = ''
-
-                events_list.append(f"{title} ({day} {date_formatted}, {duration}h, {compensation if compensation else 0}₳)")
+                total_compensation += compensation
+                events_list.append(f"{event.title} ({event.day} {date_formatted}, {duration}h, {compensation}₳)")
             else:
                 # Aggiungi con indicazione "NON PARTECIPATO"
-                # If event_date not set, compute from pool_start / week mapping
-                if not event_date:
-                    computed = compute_week_day_dates(pool_start, event_week)
-                    event_date = computed.get(day)
-
-                if event_date:
-                    try:
-                        date_formatted = f"{event_date[8:10]}/{event_date[5:7]}/{event_date[0:4]}"
-                    except Exception:
-                        date_formatted = event_date
-                else:
-                    date_formatted = ''
-
-                events_list.append(f"{title} ({day} {date_formatted}, {duration}h, NON PARTECIPATO)")
+                events_list.append(f"{event.title} ({event.day} {date_formatted}, {duration}h, NON PARTECIPATO)")
         
         # Unisci tutti gli eventi con " | " come separatore
         events_string = " | ".join(events_list)
         
         # Conta solo gli eventi effettivamente partecipati per il CSV
-        participated_count = sum(1 for ev in events if ev[5] == 1)
+        participated_count = sum(1 for ev in events if ev.attended == 1)
 
         # Scrivi la riga per il partecipante (numero eventi = eventi partecipati)
         writer.writerow([
@@ -2481,7 +3609,6 @@ def download_all_participants_detailed_csv():
             total_compensation
         ])
     
-    conn.close()
     
     # Crea response
     output.seek(0)
@@ -2494,24 +3621,8 @@ def download_all_participants_detailed_csv():
 @admin_required
 def download_participant_csv(participant_name):
     """Download CSV di un singolo partecipante"""
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    
-    # Ottieni dettagli eventi (con stato presenza)
-    c.execute("""
-        SELECT e.title, e.day, e.start_time, e.end_time, e.compensation, r.registration_date, r.attended
-        FROM registrations r
-        JOIN events e ON r.event_id = e.id
-        WHERE r.participant_name = ?
-        ORDER BY CASE e.day 
-            WHEN 'Lunedì' THEN 1 
-            WHEN 'Martedì' THEN 2 
-            WHEN 'Mercoledì' THEN 3 
-            WHEN 'Giovedì' THEN 4 
-            WHEN 'Venerdì' THEN 5 
-        END, e.start_time
-    """, (participant_name,))
-    events = c.fetchall()
+    # Ottieni dettagli eventi (con stato presenza) dal read model
+    events = [ParticipantEvent(e, r) for e, r in read_model.snapshot().participant_events(participant_name)]
     
     # Crea CSV in memoria
     output = io.StringIO()
@@ -2522,18 +3633,14 @@ def download_participant_csv(participant_name):
     
     # Dati
     for event in events:
-        title, day, start_time, end_time, compensation, reg_date, attended = event
-        start_h, start_m = map(int, start_time.split(':'))
-        end_h, end_m = map(int, end_time.split(':'))
-        duration = round((end_h * 60 + end_m - start_h * 60 - start_m) / 60, 2)
+        duration = round(event.duration, 2)
         
         # Altarian conta solo se ha partecipato
-        altarian = (compensation if compensation else 0) if attended == 1 else 0
-        stato = "PARTECIPATO" if attended == 1 else "NON PARTECIPATO"
+        altarian = (event.compensation or 0) if event.attended == 1 else 0
+        stato = "PARTECIPATO" if event.attended == 1 else "NON PARTECIPATO"
         
-        writer.writerow([title, day, start_time, end_time, duration, altarian, stato, reg_date])
+        writer.writerow([event.title, event.day, event.start_time, event.end_time, duration, altarian, stato, event.registration_date])
     
-    conn.close()
     
     # Crea response
     output.seek(0)
@@ -2543,113 +3650,48 @@ def download_participant_csv(participant_name):
     return response
 
 @app.route('/participants/<int:event_id>')
+@etag_cached(lambda event_id: page_key(f'event:{event_id}', 'weeks'))
 def participants(event_id):
     # Mostra chi si è iscritto a un evento
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
+    state = read_model.snapshot()
     
-    # Prendi info evento
-    c.execute("SELECT title, day, start_time, end_time FROM events WHERE id = ?", (event_id,))
-    event = c.fetchone()
+    # Prendi info evento e lista partecipanti
+    event = state.events.get(event_id)
+    participants_list = state.event_registrations(event_id)
     
-    # Prendi lista partecipanti
-    c.execute("SELECT participant_name, registration_date FROM registrations WHERE event_id = ? ORDER BY registration_date", 
-              (event_id,))
-    participants_list = c.fetchall()
-    
-    conn.close()
     return render_template("participants.html", event=event, participants=participants_list, event_id=event_id)
 
 @app.route('/user/profile')
 @login_required
+@etag_cached(lambda: page_key())
 def user_profile():
     """Ottieni riepilogo completo dell'utente"""
     user_login = session['user']['login']
+    state = read_model.snapshot()
     
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    
-    # Ottieni info utente dal database
-    c.execute("SELECT wallet FROM users WHERE login = ?", (user_login,))
-    user_data = c.fetchone()
-    current_wallet = user_data[0] if user_data else 0
+    # Wallet dell'utente
+    user = state.users.get(user_login)
+    current_wallet = user.wallet if user else 0
     
-    # Ottieni tutti gli eventi a cui l'utente è iscritto (con stato presenza)
-    c.execute("""
-        SELECT e.id, e.title, e.day, e.start_time, e.end_time, e.compensation, e.week, r.attended, e.event_date
-        FROM events e
-        JOIN registrations r ON e.id = r.event_id
-        WHERE r.participant_name = ?
-        ORDER BY e.week, 
-                 CASE e.day
-                     WHEN 'Lunedì' THEN 1
-                     WHEN 'Martedì' THEN 2
-                     WHEN 'Mercoledì' THEN 3
-                     WHEN 'Giovedì' THEN 4
-                     WHEN 'Venerdì' THEN 5
-                 END,
-                 e.start_time
-    """, (user_login,))
-    
-    user_events = c.fetchall()
-    conn.close()
+    # Tutti gli eventi a cui l'utente è iscritto (con stato presenza), per settimana, giorno e orario
+    pool_start = state.setting('pool_start')
+    user_events = [
+        ParticipantEvent(event, registration, event.concrete_date(compute_week_day_dates(pool_start, event.week)))
+        for event, registration in sorted(state.participant_events(user_login), key=lambda item: item[0].week)
+    ]
     
     # Calcola statistiche (conta solo eventi con attended = 1)
     total_events = len(user_events)
-    total_points_earned = sum(event[5] for event in user_events if event[7] == 1)  # compensation solo se attended
+    total_points_earned = sum(event.compensation for event in user_events if event.attended == 1)  # compensation solo se attended
     
-    # Calcola ore totali effettuate (solo eventi partecipati)
-    total_hours = 0
-    for event in user_events:
-        # Salta eventi non partecipati
-        if event[7] == 0:
-            continue
-            
-        start_time = event[3]  # start_time formato "HH:MM"
-        end_time = event[4]    # end_time formato "HH:MM"
-        
-        # Skip events with missing times
-        if not start_time or not end_time or ':' not in start_time or ':' not in end_time:
-            continue
-            
-        start_h, start_m = map(int, start_time.split(':'))
-        end_h, end_m = map(int, end_time.split(':'))
-        
-        duration_minutes = (end_h * 60 + end_m) - (start_h * 60 + start_m)
-        total_hours += duration_minutes / 60
+    # Calcola ore totali effettuate (solo eventi partecipati, salta orari mancanti)
+    total_hours = sum(event.duration for event in user_events
+                      if event.attended != 0 and event.duration is not None)
     
     # Organizza eventi per settimana (includi stato attended)
     events_by_week = {}
-    # Load global pool_start for computing missing dates
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute("SELECT value FROM settings WHERE key = 'pool_start'")
-    pool_row = c.fetchone()
-    pool_start = pool_row[0] if pool_row else None
-    conn.close()
-
     for event in user_events:
-        week = event[6]
-        if week not in events_by_week:
-            events_by_week[week] = []
-
-        # event_date might be at index 8
-        event_date = event[8] if len(event) > 8 else None
-        if not event_date:
-            computed = compute_week_day_dates(pool_start, week)
-            event_date = computed.get(event[2])
-
-        events_by_week[week].append({
-            'id': event[0],
-            'title': event[1],
-            'day': event[2],
-            'event_date': event_date,
-            'start_time': event[3],
-            'end_time': event[4],
-            'compensation': event[5],
-            'attended': event[7],
-            'concrete_date': event_date  # Aggiungi concrete_date
-        })
+        events_by_week.setdefault(event.week, []).append(event)
     
     return render_template('user_profile.html',
                          total_events=total_events,
@@ -2662,17 +3704,7 @@ def user_profile():
 @admin_required
 def manage_whitelist():
     """Pagina per gestire la whitelist baywatcher"""
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    
-    # Ottieni tutti gli utenti nella whitelist
-    c.execute("SELECT id, intra_login, added_at FROM baywatcher_whitelist ORDER BY intra_login")
-    whitelist = c.fetchall()
-    
-    conn.close()
-    
-    whitelist_data = [{'id': w[0], 'login': w[1], 'added_at': w[2]} for w in whitelist]
-    return render_template('whitelist.html', whitelist=whitelist_data)
+    return render_template('whitelist.html', whitelist=read_model.snapshot().whitelist)
 
 @app.route('/admin/whitelist/add', methods=['POST'])
 @admin_required
@@ -2702,6 +3734,8 @@ def add_to_whitelist():
         try:
             c.execute("INSERT INTO baywatcher_whitelist (intra_login) VALUES (?)", (login,))
             added.append(login)
+            # Change feed
+            record_change(c, 'whitelist', 'upsert', login, {'login': login})
             log_id = log_action(
                 user_id=session['user']['id'],
                 username=session['user']['login'],
@@ -2745,6 +3779,8 @@ def remove_from_whitelist(whitelist_id):
         # Esegui la cancellazione
         c.execute("DELETE FROM baywatcher_whitelist WHERE id = ?", (whitelist_id,))
         
+        # Change feed
+        record_change(c, 'whitelist', 'delete', user_to_remove[0] if user_to_remove else None)
         # Log action (usa la stessa connessione)
         log_id = log_action(
             user_id=session['user']['id'],
@@ -2779,53 +3815,36 @@ def view_logs():
     per_page = 50
     
     conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
     c = conn.cursor()
     
-    # Query base per i log
-    query = "SELECT * FROM action_logs WHERE 1=1"
+    # Applica filtri (stesse condizioni per i log e per il conteggio totale)
+    conditions = []
     params = []
-    
-    # Query base per il conteggio totale (senza LIMIT/OFFSET)
-    count_query = "SELECT COUNT(*) FROM action_logs WHERE 1=1"
-    count_params = []
-    
-    # Applica filtri
     if date_filter:
-        query += " AND DATE(timestamp) = ?"
-        count_query += " AND DATE(timestamp) = ?"
+        conditions.append("DATE(timestamp) = ?")
         params.append(date_filter)
-        count_params.append(date_filter)
-    
     if user_filter:
-        query += " AND username = ?"
-        count_query += " AND username = ?"
+        conditions.append("username = ?")
         params.append(user_filter)
-        count_params.append(user_filter)
-    
     if action_filter:
-        query += " AND action_type = ?"
-        count_query += " AND action_type = ?"
+        conditions.append("action_type = ?")
         params.append(action_filter)
-        count_params.append(action_filter)
+    where = " AND ".join(conditions) or None
     
     # Ordina per data decrescente e applica paginazione
-    query += " ORDER BY timestamp DESC LIMIT ? OFFSET ?"
-    params.extend([per_page, (page - 1) * per_page])
-    
-    c.execute(query, params)
-    logs = [dict(row) for row in c.fetchall()]
+    logs = fetch_all(c, LogEntry, where, params + [per_page, (page - 1) * per_page],
+                     order_by="timestamp DESC", limit=True)
     
     # Conta totale per paginazione
-    c.execute(count_query, count_params)
+    c.execute("SELECT COUNT(*) FROM action_logs" + (f" WHERE {where}" if where else ""), params)
     total_logs = c.fetchone()[0]
     
     # Ottieni utenti e azioni unici per i filtri dropdown
     c.execute("SELECT DISTINCT username FROM action_logs ORDER BY username")
-    all_users = [row['username'] for row in c.fetchall()]
+    all_users = [row[0] for row in c.fetchall()]
     
     c.execute("SELECT DISTINCT action_type FROM action_logs ORDER BY action_type")
-    all_actions = [row['action_type'] for row in c.fetchall()]
+    all_actions = [row[0] for row in c.fetchall()]
     
     conn.close()
     
@@ -2852,35 +3871,30 @@ def download_logs_csv():
     action_filter = request.args.get('action')
 
     conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
     c = conn.cursor()
 
-    query = "SELECT id, timestamp, user_id, username, action_type, action_description, ip_address, user_agent, resource_id, resource_type, old_value, new_value FROM action_logs WHERE 1=1"
+    conditions = []
     params = []
-
     if date_filter:
-        query += " AND DATE(timestamp) = ?"
+        conditions.append("DATE(timestamp) = ?")
         params.append(date_filter)
     if user_filter:
-        query += " AND username = ?"
+        conditions.append("username = ?")
         params.append(user_filter)
     if action_filter:
-        query += " AND action_type = ?"
+        conditions.append("action_type = ?")
         params.append(action_filter)
 
-    query += " ORDER BY timestamp DESC"
-    
-    c.execute(query, params)
-    logs = c.fetchall()
+    logs = fetch_all(c, LogEntry, " AND ".join(conditions) or None, params, order_by="timestamp DESC")
     conn.close()
 
     output = io.StringIO()
     writer = csv.writer(output)
 
     if logs:
-        writer.writerow(logs[0].keys())
+        writer.writerow(LogEntry.COLUMNS)
         for log in logs:
-            writer.writerow(log)
+            writer.writerow(log.values())
 
     response = make_response(output.getvalue())
     response.headers["Content-Disposition"] = "attachment; filename=action_logs.csv"
@@ -2930,23 +3944,18 @@ def download_ics(event_id):
     c = conn.cursor()
 
     # Ottieni dettagli evento
-    c.execute("SELECT title, description, day, start_time, end_time, week, event_date FROM events WHERE id = ?", (event_id,))
-    event_data = c.fetchone()
+    event_data = run(c, 'event_by_id', (event_id,)).fetchone()
 
     if not event_data:
         conn.close()
         return "Evento non trovato", 404
 
-    title, description, day, start_time, end_time, week, event_date = event_data
+    title, description = event_data.title, event_data.description
 
     # Calcola la data concreta dell'evento
-    concrete_date_str = event_date
-    if not concrete_date_str:
-        c.execute("SELECT value FROM settings WHERE key = 'pool_start'")
-        pool_start_row = c.fetchone()
-        pool_start = pool_start_row[0] if pool_start_row else None
-        day_dates = compute_week_day_dates(pool_start, week)
-        concrete_date_str = day_dates.get(day)
+    pool_start_row = run(c, 'setting_get', ('pool_start',)).fetchone()
+    pool_start = pool_start_row[0] if pool_start_row else None
+    concrete_date_str = event_data.concrete_date(compute_week_day_dates(pool_start, event_data.week))
 
     conn.close()
 
@@ -2956,8 +3965,8 @@ def download_ics(event_id):
     try:
         # Crea oggetti datetime per inizio e fine
         event_dt_obj = datetime.strptime(concrete_date_str, '%Y-%m-%d')
-        start_h, start_m = map(int, start_time.split(':'))
-        end_h, end_m = map(int, end_time.split(':'))
+        start_h, start_m = map(int, event_data.start_time.split(':'))
+        end_h, end_m = map(int, event_data.end_time.split(':'))
 
         start_datetime = event_dt_obj.replace(hour=start_h, minute=start_m)
         end_datetime = event_dt_obj.replace(hour=end_h, minute=end_m)
@@ -3010,6 +4019,300 @@ def download_ics(event_id):
         app.logger.error(f"Errore durante la creazione del file ICS: {e}")
         return "Errore interno del server", 500
 
+# -------------------------------
+# Change Feed
+# -------------------------------
+
+CHANGES_PAGE_LIMIT = 500
+
+@app.route('/api/changes')
+@login_required
+def api_changes():
+    """
+    Restituisce le modifiche con seq > since, in ordine.
+    Senza `since` restituisce solo l'ultimo seq (punto di partenza dopo un caricamento completo).
+    Se `reset` è true il client è rimasto indietro oltre la compattazione e deve ricaricare tutto.
+    """
+    limit = min(max(request.args.get('limit', CHANGES_PAGE_LIMIT, type=int), 1), CHANGES_PAGE_LIMIT)
+    since = request.args.get('since', type=int)
+
+    conn = sqlite3.connect(DB_PATH)
+    c = conn.cursor()
+    head = run(c, 'changes_head').fetchone()[0]
+    row = run(c, 'setting_get', ('changes_floor',)).fetchone()
+    floor = int(row[0]) if row else 0
+    # Tabella svuotata dalla compattazione: l'head non può scendere sotto il floor
+    head = max(head, floor)
+
+    if since is None or since < floor or since > head:
+        conn.close()
+        return jsonify({'changes': [], 'last_seq': head, 'has_more': False, 'reset': since is not None})
+
+    # La whitelist contiene i login degli studenti: solo per admin
+    page_query = 'changes_page' if session['user'].get('is_admin') else 'changes_page_public'
+    rows = run(c, page_query, (since, limit + 1)).fetchall()
+    conn.close()
+
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    changes = [
+        {'seq': seq, 'entity': entity, 'id': entity_id, 'op': op,
+         'data': json.loads(data) if data else None, 'at': created_at}
+        for seq, entity, entity_id, op, data, created_at in rows
+    ]
+    # Con il filtro alcune voci vengono saltate: a fine feed last_seq avanza comunque fino all'head
+    last_seq = changes[-1]['seq'] if has_more else max([head] + [ch['seq'] for ch in changes[-1:]])
+    return jsonify({'changes': changes, 'last_seq': last_seq, 'has_more': has_more, 'reset': False})
+
+# -------------------------------
+# API v1 (JSON)
+# -------------------------------
+
+# Massimo numero di id per GET /api/v1/events?ids=
+API_BATCH_LIMIT = 100
+
+# Campi di un evento nelle risposte (selezionabili con ?fields=id,title,...)
+API_EVENT_FIELDS = ('id', 'week', 'day', 'date', 'start_time', 'end_time', 'title', 'description',
+                    'compensation', 'max_slots', 'registered', 'available_slots', 'is_passed',
+                    'participants', 'is_registered')
+# Solo per admin: iscrizioni con data e presenza
+API_ADMIN_FIELDS = ('registrations',)
+
+def api_error(message, status, code=None, **extra):
+    return jsonify({'error': message, 'code': code, **extra}), status
+
+def api_login_required(f):
+    """Come login_required, ma risponde 401 in JSON invece di reindirizzare al login"""
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if 'user' not in session:
+            return api_error('Login richiesto', 401, 'unauthorized')
+        return f(*args, **kwargs)
+    return decorated_function
+
+def api_fields():
+    """Campi richiesti con ?fields= (None = tutti). ValueError se uno non esiste"""
+    raw = request.args.get('fields')
+    if not raw:
+        return None
+    allowed = API_EVENT_FIELDS + (API_ADMIN_FIELDS if session['user'].get('is_admin') else ())
+    fields = [field.strip() for field in raw.split(',') if field.strip()]
+    unknown = [field for field in fields if field not in allowed]
+    if unknown:
+        raise ValueError(f"Campi sconosciuti: {', '.join(unknown)}")
+    return fields
+
+def api_week_visible(state, week):
+    """Gli studenti vedono solo le settimane fino a quella attiva (come nel calendario)"""
+    return session['user'].get('is_admin') or 1 <= week <= state.int_setting('active_week')
+
+def event_json(view, fields=None):
+    """Rappresentazione JSON compatta di un EventView per l'utente della sessione"""
+    user = session['user']
+    data = {
+        'id': view.id,
+        'week': view.week,
+        'day': view.day,
+        'date': view.concrete_date,
+        'start_time': view.start_time,
+        'end_time': view.end_time,
+        'title': view.title,
+        'description': view.description,
+        'compensation': view.compensation,
+        'max_slots': view.max_slots,
+        'registered': view.registered,
+        'available_slots': view.available_slots,
+        'is_passed': view.is_passed,
+        'participants': view.participants_visible,
+        'is_registered': user['login'] in view.participants_all,
+    }
+    if user.get('is_admin'):
+        data['registrations'] = [
+            {'name': r.participant_name, 'registered_at': r.registration_date, 'attended': r.attended}
+            for r in view.registrations
+        ]
+    if fields:
+        data = {field: data[field] for field in fields}
+    return data
+
+def api_event_view(state, event_id):
+    """EventView di un evento visibile all'utente, o None"""
+    event = state.events.get(event_id)
+    if event is None or not api_week_visible(state, event.week):
+        return None
+    return event_view(state, event, compute_week_day_dates(state.setting('pool_start'), event.week))
+
+@app.route('/api/v1/weeks/<int:week>/events')
+@api_login_required
+@etag_cached(lambda week: page_key('setting', 'weeks', f'week:{week}'))
+def api_week_events(week):
+    """Eventi di una settimana, ordinati per giorno e orario, con le date dei giorni"""
+    try:
+        fields = api_fields()
+    except ValueError as e:
+        return api_error(str(e), 400, 'invalid_fields')
+
+    state = read_model.snapshot()
+    if not api_week_visible(state, week):
+        return api_error('Settimana non disponibile', 404, 'not_found')
+
+    views, day_dates = week_event_views(state, week)
+    return jsonify({
+        'week': week,
+        'active_week': state.int_setting('active_week'),
+        'day_dates': day_dates,
+        'events': [event_json(view, fields) for view in views]
+    })
+
+@app.route('/api/v1/events/<int:event_id>')
+@api_login_required
+@etag_cached(lambda event_id: page_key(f'event:{event_id}', 'weeks', 'setting'))
+def api_event(event_id):
+    try:
+        fields = api_fields()
+    except ValueError as e:
+        return api_error(str(e), 400, 'invalid_fields')
+
+    view = api_event_view(read_model.snapshot(), event_id)
+    if view is None:
+        return api_error('Evento non trovato', 404, 'not_found')
+    return jsonify(event_json(view, fields))
+
+@app.route('/api/v1/events')
+@api_login_required
+@etag_cached(lambda: page_key('event', 'weeks', 'setting'))
+def api_events_batch():
+    """Più eventi in una richiesta: ?ids=1,2,3 (gli id non visibili sono elencati in `missing`)"""
+    try:
+        fields = api_fields()
+        event_ids = list(dict.fromkeys(int(i) for i in request.args.get('ids', '').split(',') if i.strip()))
+    except ValueError as e:
+        return api_error(str(e), 400, 'invalid_request')
+    if not event_ids:
+        return api_error('Parametro ids richiesto', 400, 'invalid_request')
+    if len(event_ids) > API_BATCH_LIMIT:
+        return api_error(f'Massimo {API_BATCH_LIMIT} eventi per richiesta', 400, 'invalid_request')
+
+    state = read_model.snapshot()
+    events, missing = [], []
+    for event_id in event_ids:
+        view = api_event_view(state, event_id)
+        if view is None:
+            missing.append(event_id)
+        else:
+            events.append(event_json(view, fields))
+    return jsonify({'events': events, 'missing': missing})
+
+@app.route('/api/v1/me/registrations')
+@api_login_required
+@etag_cached(lambda: page_key('event', 'weeks', 'setting'))
+def api_my_registrations():
+    """Iscrizioni dell'utente (opzionale ?week=), con data di iscrizione e presenza"""
+    try:
+        fields = api_fields()
+    except ValueError as e:
+        return api_error(str(e), 400, 'invalid_fields')
+    week = request.args.get('week', type=int)
+
+    state = read_model.snapshot()
+    pool_start = state.setting('pool_start')
+    registrations = []
+    for event, registration in state.participant_events(session['user']['login']):
+        if week is not None and event.week != week:
+            continue
+        view = event_view(state, event, compute_week_day_dates(pool_start, event.week))
+        registrations.append({
+            'event': event_json(view, fields),
+            'registered_at': registration.registration_date,
+            'attended': registration.attended
+        })
+    return jsonify({
+        'registrations': registrations,
+        'max_events_per_user': state.int_setting('max_events_per_user')
+    })
+
+def api_registration_state(event_id):
+    """Stato aggiornato dopo un'iscrizione o disiscrizione: evento e iscrizioni della sua settimana"""
+    # Il read model viene aggiornato a fine richiesta: qui serve già lo stato nuovo
+    read_model.sync()
+    state = read_model.snapshot()
+    view = api_event_view(state, event_id)
+    if view is None:
+        return {}
+    login = session['user']['login']
+    return {
+        'event': event_json(view),
+        'week_registrations': sum(1 for event, _ in state.participant_events(login) if event.week == view.week),
+        'max_events_per_user': state.int_setting('max_events_per_user')
+    }
+
+def registration_json(event_id, outcome, max_events_per_user=None, **extra):
+    """Risposta JSON di un'iscrizione o disiscrizione (API e /register, /unregister via fetch)"""
+    if outcome not in REGISTRATION_SUCCESS:
+        message, status = registration_error(outcome, limit=max_events_per_user)
+        return api_error(message, status, outcome, **api_registration_state(event_id))
+    return jsonify({'outcome': outcome, **extra, **api_registration_state(event_id)})
+
+@app.route('/api/v1/events/<int:event_id>/registration', methods=['POST', 'DELETE'])
+@api_login_required
+@admission_controlled
+@idempotent
+def api_registration(event_id):
+    """POST iscrive, DELETE disiscrive l'utente della sessione; risponde con lo stato aggiornato"""
+    if request.method == 'POST':
+        return registration_json(event_id, *register_user(event_id, session['user']))
+    return registration_json(event_id, unregister_user(event_id, session['user']))
+
+@app.route('/api/v1/events/<int:event_id>/waitlist', methods=['POST', 'DELETE'])
+@api_login_required
+@admission_controlled
+@idempotent
+def api_waitlist(event_id):
+    """POST mette in lista d'attesa (con la posizione), DELETE toglie l'utente della sessione"""
+    if request.method == 'POST':
+        outcome, position = join_waitlist(event_id, session['user'])
+        return registration_json(event_id, outcome, waitlist_position=position)
+    return registration_json(event_id, leave_waitlist(event_id, session['user']))
+
+# -------------------------------
+# Socket.IO
+# -------------------------------
+
+@socketio.on('connect')
+def on_connect():
+    """Formato completo finché il client non ne chiede un altro; gli admin ricevono anche i log"""
+    join_room(FULL_ROOM)
+    if session.get('user'):
+        join_room(user_room(session['user']['login']))
+    if session.get('user', {}).get('is_admin'):
+        join_room(ADMIN_ROOM)
+
+@socketio.on('resume')
+def on_resume(data):
+    """
+    Il client (ri)connesso invia {epoch, seq, format, channels} dell'ultimo messaggio visto.
+    Con format 'compact' riceve chiavi brevi e diff dei partecipanti.
+    Riceve solo i messaggi persi, oppure 'resync' se vanno ricaricati i dati.
+    """
+    data = data if isinstance(data, dict) else {}
+    if data.get('format') == 'compact':
+        leave_room(FULL_ROOM)
+        join_room(COMPACT_ROOM)
+    # Canali pubblici aggiuntivi (la room admin si ottiene solo dalla sessione)
+    if 'display' in (data.get('channels') or []):
+        join_room(DISPLAY_ROOM)
+    seq = data.get('seq')
+    missed = live_updates.missed(data.get('epoch'), seq if isinstance(seq, int) else None, rooms(), request.sid)
+    if missed is None:
+        emit('resync', live_updates.head())
+        return
+    for event, message in missed:
+        emit(event, message)
+
+@socketio.on('disconnect')
+def on_disconnect(*args):
+    live_updates.forget(request.sid)
+
 # -------------------------------
 # Push Notification Routes
 # -------------------------------
@@ -3041,27 +4344,46 @@ def push_subscribe():
             return jsonify({'error': 'Missing encryption keys'}), 400
         
         user_id = session['user']['id']
+        user_agent = request.headers.get('User-Agent', '')[:255]
+        previous_endpoint = subscription.get('previous_endpoint')
         
         conn = sqlite3.connect(DB_PATH)
         c = conn.cursor()
         
+        # Il browser ha ruotato l'endpoint: la vecchia sottoscrizione non riceverà più nulla
+        if previous_endpoint and previous_endpoint != endpoint:
+            c.execute("DELETE FROM push_subscriptions WHERE endpoint = ? AND user_id = ?",
+                      (previous_endpoint, user_id))
+        
         # Check if subscription already exists
         c.execute("SELECT id FROM push_subscriptions WHERE endpoint = ?", (endpoint,))
         existing = c.fetchone()
         
         if existing:
-            # Update existing subscription
+            # Update existing subscription (il browser l'ha appena confermata: azzera i fallimenti)
             c.execute("""
                 UPDATE push_subscriptions 
-                SET p256dh = ?, auth = ?
+                SET user_id = ?, p256dh = ?, auth = ?, user_agent = ?, failure_count = 0
                 WHERE endpoint = ?
-            """, (p256dh, auth, endpoint))
+            """, (user_id, p256dh, auth, user_agent, endpoint))
         else:
             # Insert new subscription
             c.execute("""
-                INSERT INTO push_subscriptions (user_id, endpoint, p256dh, auth)
-                VALUES (?, ?, ?, ?)
-            """, (user_id, endpoint, p256dh, auth))
+                INSERT INTO push_subscriptions (user_id, endpoint, p256dh, auth, user_agent)
+                VALUES (?, ?, ?, ?, ?)
+            """, (user_id, endpoint, p256dh, auth, user_agent))
+        
+        # Limite di dispositivi per utente: elimina quelli che non ricevono da più tempo
+        c.execute("""
+            DELETE FROM push_subscriptions WHERE id IN (
+                SELECT id FROM push_subscriptions
+                WHERE user_id = ? AND endpoint != ?
+                ORDER BY COALESCE(last_success_at, created_at) DESC, id DESC
+                LIMIT -1 OFFSET ?
+            )
+        """, (user_id, endpoint, max(0, PUSH_MAX_SUBSCRIPTIONS_PER_USER - 1)))
+        if c.rowcount > 0:
+            app.logger.info(f"🗑️ Evicted {c.rowcount} old push subscription(s) for user {user_id}")
         
         conn.commit()
         conn.close()
@@ -3073,6 +4395,39 @@ def push_subscribe():
         app.logger.error(f"❌ Error subscribing to push: {e}")
         return jsonify({'error': "Internal Server Error"}), 500
 
+@app.route('/api/push/subscriptions')
+@login_required
+def push_subscriptions_list():
+    """List the current user's subscribed devices."""
+    conn = sqlite3.connect(DB_PATH)
+    conn.row_factory = sqlite3.Row
+    c = conn.cursor()
+    c.execute("""
+        SELECT id, endpoint, user_agent, created_at, last_success_at, failure_count
+        FROM push_subscriptions
+        WHERE user_id = ?
+        ORDER BY COALESCE(last_success_at, created_at) DESC
+    """, (session['user']['id'],))
+    devices = [dict(row) for row in c.fetchall()]
+    conn.close()
+    return jsonify({'devices': devices, 'max_devices': PUSH_MAX_SUBSCRIPTIONS_PER_USER})
+
+@app.route('/api/push/subscriptions/<int:subscription_id>', methods=['DELETE'])
+@login_required
+def push_subscription_delete(subscription_id):
+    """Remove one of the current user's devices."""
+    conn = sqlite3.connect(DB_PATH)
+    c = conn.cursor()
+    c.execute("DELETE FROM push_subscriptions WHERE id = ? AND user_id = ?",
+              (subscription_id, session['user']['id']))
+    deleted = c.rowcount
+    conn.commit()
+    conn.close()
+    
+    if not deleted:
+        return jsonify({'error': 'Subscription not found'}), 404
+    return jsonify({'success': True})
+
 @app.route('/api/push/unsubscribe', methods=['POST'])
 @login_required
 def push_unsubscribe():
@@ -3101,7 +4456,13 @@ def push_unsubscribe():
 @app.route('/api/notifications/preferences', methods=['GET', 'POST'])
 @login_required
 def notification_preferences():
-    """Get or update user notification preferences."""
+    """
+    Get or update user notification preferences.
+    
+    'offsets' is a list of reminder lead times, either in minutes or as
+    strings like '2d', '3h', '15m'. Clients that only send the legacy
+    notify_24h_before / notify_1h_before flags keep working.
+    """
     user_id = session['user']['id']
     conn = sqlite3.connect(DB_PATH)
     c = conn.cursor()
@@ -3111,8 +4472,23 @@ def notification_preferences():
         try:
             data = request.json
             notifications_enabled = data.get('notifications_enabled', True)
-            notify_24h = data.get('notify_24h_before', True)
-            notify_1h = data.get('notify_1h_before', True)
+            
+            if 'offsets' in data:
+                try:
+                    offsets = sorted({parse_reminder_offset(v) for v in data.get('offsets') or []}, reverse=True)
+                except ValueError as e:
+                    conn.close()
+                    return jsonify({'error': str(e)}), 400
+            else:
+                offsets = []
+                if data.get('notify_24h_before', True):
+                    offsets.append(24 * 60)
+                if data.get('notify_1h_before', True):
+                    offsets.append(60)
+            
+            if len(offsets) > MAX_REMINDER_OFFSETS:
+                conn.close()
+                return jsonify({'error': f'Puoi impostare al massimo {MAX_REMINDER_OFFSETS} promemoria'}), 400
             
             c.execute("""
                 INSERT INTO user_notification_preferences (user_id, notifications_enabled, notify_24h_before, notify_1h_before)
@@ -3121,13 +4497,19 @@ def notification_preferences():
                     notifications_enabled = excluded.notifications_enabled,
                     notify_24h_before = excluded.notify_24h_before,
                     notify_1h_before = excluded.notify_1h_before
-            """, (user_id, notifications_enabled, notify_24h, notify_1h))
+            """, (user_id, notifications_enabled, 24 * 60 in offsets, 60 in offsets))
+            
+            c.execute("DELETE FROM user_notification_offsets WHERE user_id = ?", (user_id,))
+            c.executemany("""
+                INSERT INTO user_notification_offsets (user_id, offset_minutes)
+                VALUES (?, ?)
+            """, [(user_id, offset) for offset in offsets])
             
             conn.commit()
             conn.close()
             
             app.logger.info(f"✅ Updated notification preferences for user {user_id}")
-            return jsonify({'success': True})
+            return jsonify({'success': True, 'offsets': offsets})
             
         except Exception as e:
             conn.close()
@@ -3136,28 +4518,15 @@ def notification_preferences():
     
     else:
         # Get preferences
-        c.execute("""
-            SELECT notifications_enabled, notify_24h_before, notify_1h_before
-            FROM user_notification_preferences
-            WHERE user_id = ?
-        """, (user_id,))
-        
-        result = c.fetchone()
+        prefs = load_user_preferences(c, user_id)
         conn.close()
         
-        if result:
-            return jsonify({
-                'notifications_enabled': bool(result[0]),
-                'notify_24h_before': bool(result[1]),
-                'notify_1h_before': bool(result[2])
-            })
-        else:
-            # Return defaults
-            return jsonify({
-                'notifications_enabled': True,
-                'notify_24h_before': True,
-                'notify_1h_before': True
-            })
+        return jsonify({
+            'notifications_enabled': prefs['enabled'],
+            'offsets': prefs['offsets'],
+            'notify_24h_before': 24 * 60 in prefs['offsets'],
+            'notify_1h_before': 60 in prefs['offsets']
+        })
 
 # -------------------------------
 # Service Worker Route
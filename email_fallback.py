@@ -0,0 +1,142 @@
+"""
+Email fallback channel for reminders that could not be delivered as push.
+Messages are sent in batches over a single persistent SMTP connection.
+"""
+
+import os
+import time
+import smtplib
+import logging
+from email.message import EmailMessage
+
+logger = logging.getLogger(__name__)
+
+
+class EmailFallback:
+    """
+    Thin wrapper around one reusable SMTP connection.
+
+    The connection is opened lazily, checked with NOOP before reuse and
+    reopened after `idle_timeout` seconds, so a batch of messages costs a
+    single connect/STARTTLS/AUTH handshake.
+    """
+
+    def __init__(self, host, port=25, sender='noreply@localhost', username=None, password=None,
+                 starttls=False, timeout=10, idle_timeout=60, batch_size=50):
+        """
+        Initialize the email channel.
+
+        Args:
+            host: SMTP server host
+            port: SMTP server port
+            sender: From address of the reminders
+            username: Optional SMTP username (AUTH is skipped without it)
+            password: Optional SMTP password
+            starttls: Upgrade the connection with STARTTLS
+            timeout: Socket timeout in seconds
+            idle_timeout: Reopen the connection if it was idle longer than this
+            batch_size: Maximum number of users emailed per batch
+        """
+        self.host = host
+        self.port = port
+        self.sender = sender
+        self.username = username
+        self.password = password
+        self.starttls = starttls
+        self.timeout = timeout
+        self.idle_timeout = idle_timeout
+        self.batch_size = batch_size
+        self._smtp = None
+        self._last_used = 0
+
+    def _connection(self):
+        if self._smtp is not None:
+            if time.monotonic() - self._last_used < self.idle_timeout:
+                try:
+                    if self._smtp.noop()[0] == 250:
+                        return self._smtp
+                except (smtplib.SMTPException, OSError):
+                    pass
+            self.close()
+
+        smtp = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+        smtp.ehlo()
+        if self.starttls:
+            smtp.starttls()
+            smtp.ehlo()
+        if self.username:
+            smtp.login(self.username, self.password or '')
+        self._smtp = smtp
+        logger.info(f"📧 SMTP connection opened to {self.host}:{self.port}")
+        return smtp
+
+    def build_message(self, to, subject, body):
+        """Build a plain text EmailMessage from the configured sender."""
+        msg = EmailMessage()
+        msg['From'] = self.sender
+        msg['To'] = to
+        msg['Subject'] = subject
+        msg.set_content(body)
+        return msg
+
+    def send_batch(self, messages):
+        """
+        Send messages over the persistent connection.
+
+        Returns one entry per attempted message: None on success or the error
+        string if the server rejected it. If the connection drops, the batch
+        stops and the returned list is shorter than `messages`; the remaining
+        messages were not attempted and can be retried later.
+        """
+        results = []
+        try:
+            smtp = self._connection()
+        except (smtplib.SMTPException, OSError) as e:
+            logger.error(f"❌ SMTP connection to {self.host}:{self.port} failed: {e}")
+            return results
+
+        for msg in messages:
+            try:
+                smtp.send_message(msg)
+                results.append(None)
+            except (smtplib.SMTPRecipientsRefused, smtplib.SMTPSenderRefused, smtplib.SMTPDataError) as e:
+                # Rejected by the server, the session is still usable
+                results.append(str(e)[:500])
+                try:
+                    smtp.rset()
+                except (smtplib.SMTPException, OSError):
+                    self.close()
+                    break
+            except (smtplib.SMTPException, OSError) as e:
+                logger.error(f"❌ SMTP connection lost after {len(results)} message(s): {e}")
+                self.close()
+                break
+
+        self._last_used = time.monotonic()
+        return results
+
+    def close(self):
+        """Close the SMTP connection if open."""
+        if self._smtp is None:
+            return
+        try:
+            self._smtp.quit()
+        except (smtplib.SMTPException, OSError):
+            pass
+        self._smtp = None
+
+
+def email_fallback_from_env():
+    """Build an EmailFallback from SMTP_* environment variables, or None if SMTP_HOST is unset."""
+    host = os.getenv('SMTP_HOST')
+    if not host:
+        return None
+    return EmailFallback(
+        host=host,
+        port=int(os.getenv('SMTP_PORT', '25')),
+        sender=os.getenv('EMAIL_FROM', 'noreply@localhost'),
+        username=os.getenv('SMTP_USERNAME') or None,
+        password=os.getenv('SMTP_PASSWORD') or None,
+        starttls=os.getenv('SMTP_STARTTLS', 'false').lower() == 'true',
+        batch_size=int(os.getenv('EMAIL_FALLBACK_BATCH_SIZE', '50'))
+    )
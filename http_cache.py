@@ -0,0 +1,135 @@
+"""
+Data versions and strong ETags for rendered pages.
+Write routes bump in-memory version counters; GETs whose versions did not
+change are answered with 304 without touching the database. Identical
+concurrent computations are coalesced with SingleFlight.
+"""
+
+import uuid
+import hashlib
+import threading
+from collections import OrderedDict
+from datetime import datetime
+
+
+class DataVersions:
+    """
+    In-process version counters.
+
+    `global` increases on every write. Scoped counters (e.g. 'week:2',
+    'event:15', 'setting') record the global version of their last change,
+    so a page depending on some scopes only changes ETag when one of them
+    is written. Counters restart with the process; `epoch` tells versions
+    of different processes apart.
+    """
+
+    def __init__(self):
+        self.epoch = uuid.uuid4().hex[:12]
+        self._global = 0
+        self._scopes = {}
+        self._lock = threading.Lock()
+
+    def bump(self, scopes=()):
+        """Increase the global version and mark `scopes` as changed by it."""
+        with self._lock:
+            self._global += 1
+            for scope in scopes:
+                self._scopes[scope] = self._global
+            return self._global
+
+    def version(self, *scopes):
+        """Return the global version, or the versions of `scopes` if given."""
+        with self._lock:
+            if not scopes:
+                return self._global
+            return tuple(self._scopes.get(scope, 0) for scope in scopes)
+
+
+class ETagStore:
+    """
+    Maps a cache key (versions, user, role, URL) to the ETag of the page last
+    rendered for it and the moment it stops being valid (e.g. the next event
+    that ends and turns into "passed"). Bounded LRU.
+    """
+
+    def __init__(self, max_entries=10000):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, key):
+        """Return the ETag still valid for `key`, or None."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or (entry[1] is not None and datetime.now() >= entry[1]):
+                return None
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def store(self, key, valid_until=None):
+        """Compute and remember the ETag of a page rendered for `key`."""
+        etag = hashlib.sha1(repr((key, valid_until)).encode()).hexdigest()[:32]
+        with self._lock:
+            self._entries[key] = (etag, valid_until)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return etag
+
+    def record(self, not_modified):
+        """Count a conditional response (304) or a full render."""
+        with self._lock:
+            if not_modified:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+
+class SingleFlight:
+    """
+    Runs a function once for concurrent callers with the same key.
+
+    The first caller computes, the others wait and receive the same result
+    object (which must be treated as read-only). Nothing is kept after the
+    call completes; include a data version in the key so that callers
+    arriving after a write start a new computation.
+    """
+
+    class _Call:
+        def __init__(self):
+            self.done = threading.Event()
+            self.result = None
+            self.error = None
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+        self.coalesced = 0
+
+    def do(self, key, fn):
+        """Return fn(), shared with the concurrent callers of `key`."""
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = self._Call()
+            else:
+                self.coalesced += 1
+
+        if leader:
+            try:
+                call.result = fn()
+            except Exception as e:
+                call.error = e
+            finally:
+                with self._lock:
+                    del self._calls[key]
+                call.done.set()
+        else:
+            call.done.wait()
+
+        if call.error is not None:
+            raise call.error
+        return call.result
@@ -0,0 +1,93 @@
+"""
+Idempotency keys for mutating POST routes.
+The first request with a key runs and its outcome (status, redirect, flash
+messages, JSON body) is stored for a short time; a retry or double click
+with the same key gets the stored outcome back without running the route.
+Keys live in SQLite, so they are shared by all the processes.
+"""
+
+import json
+import sqlite3
+import hashlib
+from datetime import datetime, timedelta
+from queries import run
+
+# Outcome of `claim` while the first request with the key is still running
+PENDING = object()
+
+
+class IdempotencyStore:
+    """
+    Stores the outcome of keyed requests for `ttl_seconds`.
+
+    `claim(key)` returns None if the caller is the first with this key (it
+    must then call `complete` or `release`), the stored outcome if the key
+    was already used, or PENDING if the first request has not finished yet.
+
+    A claim without outcome is a lease of `lease_seconds`: if the process
+    dies before completing, a retry after the lease claims the key again
+    instead of getting PENDING for the whole replay TTL.
+    """
+
+    def __init__(self, db_path, ttl_seconds=600, lease_seconds=30):
+        """
+        Initialize the store.
+
+        Args:
+            db_path: Path to SQLite database
+            ttl_seconds: How long an outcome is replayed
+            lease_seconds: How long a claim without outcome blocks retries
+        """
+        self.db_path = db_path
+        self.ttl = timedelta(seconds=ttl_seconds)
+        self.lease = timedelta(seconds=lease_seconds)
+        self.replays = 0
+
+    @staticmethod
+    def scoped_key(user_id, method, path, client_key, payload=()):
+        """
+        Key of a request: the same client key with another user, route or
+        form payload (e.g. a corrected login in the same form) is a different key.
+        """
+        raw = json.dumps([user_id, method, path, client_key, sorted(payload)])
+        return hashlib.sha256(raw.encode()).hexdigest()
+
+    def _connect(self):
+        return sqlite3.connect(self.db_path, timeout=30)
+
+    def claim(self, key):
+        now = datetime.now()
+        conn = self._connect()
+        try:
+            c = conn.cursor()
+            run(c, 'idempotency_delete_expired', (key, now))
+            if run(c, 'idempotency_claim', (key, now, now + self.lease)).rowcount:
+                conn.commit()
+                return None
+            conn.commit()
+            row = run(c, 'idempotency_get', (key,)).fetchone()
+        finally:
+            conn.close()
+        # Still running, or released in the meantime (the next claim can take it)
+        if row is None or row[0] is None:
+            return PENDING
+        self.replays += 1
+        return json.loads(row[0])
+
+    def complete(self, key, outcome):
+        """Store the outcome (a JSON-serializable dict) of the request that claimed `key`, replayed for the TTL"""
+        conn = self._connect()
+        try:
+            run(conn.cursor(), 'idempotency_complete', (json.dumps(outcome), datetime.now() + self.ttl, key))
+            conn.commit()
+        finally:
+            conn.close()
+
+    def release(self, key):
+        """Forget a claimed key (the request failed): a retry runs again"""
+        conn = self._connect()
+        try:
+            run(conn.cursor(), 'idempotency_release', (key,))
+            conn.commit()
+        finally:
+            conn.close()
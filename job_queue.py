@@ -0,0 +1,207 @@
+"""
+Durable SQLite-backed job queue.
+Web workers enqueue jobs, out-of-process workers claim them with a lease and ack them when done.
+"""
+
+import json
+import sqlite3
+import logging
+from datetime import datetime, timedelta
+
+logger = logging.getLogger(__name__)
+
+
+class JobQueue:
+    """
+    Small job queue stored in the `job_queue` table.
+
+    Lifecycle of a job:
+    - pending: waiting for `available_at`
+    - running: claimed by a worker until `lease_until`; an expired lease makes it claimable again
+    - done: acked by the worker
+    - failed: gave up after `max_attempts`
+    """
+
+    def __init__(self, db_path, lease_seconds=60, retry_delay_seconds=30):
+        """
+        Initialize the job queue.
+
+        Args:
+            db_path: Path to SQLite database
+            lease_seconds: How long a claimed job stays reserved for its worker
+            retry_delay_seconds: Base delay before retrying a failed job (doubles every attempt)
+        """
+        self.db_path = db_path
+        self.lease = timedelta(seconds=lease_seconds)
+        self.retry_delay_seconds = retry_delay_seconds
+
+    def _connect(self):
+        # Autocommit mode so claims can run inside an explicit BEGIN IMMEDIATE
+        conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+        return conn
+
+    def enqueue(self, kind, payload=None, run_at=None, max_attempts=5, cursor=None):
+        """
+        Add a job to the queue.
+
+        Args:
+            kind: Job type, used by the worker to pick a handler
+            payload: JSON-serializable dict passed to the handler
+            run_at: Optional datetime before which the job is not claimed
+            max_attempts: Attempts before the job is marked as failed
+            cursor: Optional cursor to enqueue inside the caller's transaction (no commit)
+
+        Returns the job ID.
+        """
+        params = (kind, json.dumps(payload or {}), run_at or datetime.now(), max_attempts, datetime.now())
+        query = """
+            INSERT INTO job_queue (kind, payload, available_at, max_attempts, created_at)
+            VALUES (?, ?, ?, ?, ?)
+        """
+
+        if cursor:
+            cursor.execute(query, params)
+            return cursor.lastrowid
+
+        conn = self._connect()
+        try:
+            c = conn.cursor()
+            c.execute(query, params)
+            return c.lastrowid
+        finally:
+            conn.close()
+
+    def claim(self, worker_id, limit=10):
+        """
+        Atomically claim up to `limit` jobs for a worker.
+
+        Pending jobs whose `available_at` has passed and running jobs whose
+        lease expired are both claimable. Returns a list of job dicts.
+        """
+        now = datetime.now()
+        conn = self._connect()
+        try:
+            c = conn.cursor()
+            c.execute("BEGIN IMMEDIATE")
+            c.execute("""
+                UPDATE job_queue
+                SET status = 'running', locked_by = ?, lease_until = ?, attempts = attempts + 1
+                WHERE id IN (
+                    SELECT id FROM job_queue
+                    WHERE status = 'pending' AND available_at <= ?
+                    UNION ALL
+                    SELECT id FROM job_queue
+                    WHERE status = 'running' AND lease_until < ?
+                    LIMIT ?
+                )
+                RETURNING id, kind, payload, attempts, max_attempts
+            """, (worker_id, now + self.lease, now, now, limit))
+            rows = c.fetchall()
+            c.execute("COMMIT")
+        except Exception:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            raise
+        finally:
+            conn.close()
+
+        return [
+            {
+                'id': job_id,
+                'kind': kind,
+                'payload': json.loads(payload),
+                'attempts': attempts,
+                'max_attempts': max_attempts
+            }
+            for job_id, kind, payload, attempts, max_attempts in rows
+        ]
+
+    def extend(self, job_id, worker_id):
+        """Renew the lease of a running job. Returns False if the worker lost it."""
+        conn = self._connect()
+        try:
+            c = conn.cursor()
+            c.execute("""
+                UPDATE job_queue SET lease_until = ?
+                WHERE id = ? AND status = 'running' AND locked_by = ?
+            """, (datetime.now() + self.lease, job_id, worker_id))
+            return c.rowcount > 0
+        finally:
+            conn.close()
+
+    def ack(self, job_id, worker_id):
+        """Mark a job as done. Returns False if the worker no longer owned it."""
+        conn = self._connect()
+        try:
+            c = conn.cursor()
+            c.execute("""
+                UPDATE job_queue
+                SET status = 'done', finished_at = ?, lease_until = NULL, last_error = NULL
+                WHERE id = ? AND status = 'running' AND locked_by = ?
+            """, (datetime.now(), job_id, worker_id))
+            return c.rowcount > 0
+        finally:
+            conn.close()
+
+    def fail(self, job_id, worker_id, error):
+        """
+        Record a failed attempt.
+        The job goes back to pending with exponential backoff, or to failed
+        once it has used all its attempts.
+        """
+        now = datetime.now()
+        conn = self._connect()
+        try:
+            c = conn.cursor()
+            c.execute("SELECT attempts, max_attempts FROM job_queue WHERE id = ? AND locked_by = ?",
+                      (job_id, worker_id))
+            row = c.fetchone()
+            if not row:
+                return
+            attempts, max_attempts = row
+
+            if attempts >= max_attempts:
+                c.execute("""
+                    UPDATE job_queue
+                    SET status = 'failed', finished_at = ?, lease_until = NULL, last_error = ?
+                    WHERE id = ? AND locked_by = ?
+                """, (now, str(error), job_id, worker_id))
+                logger.error(f"❌ Job {job_id} failed permanently after {attempts} attempt(s): {error}")
+            else:
+                retry_at = now + timedelta(seconds=self.retry_delay_seconds * 2 ** (attempts - 1))
+                c.execute("""
+                    UPDATE job_queue
+                    SET status = 'pending', available_at = ?, lease_until = NULL, last_error = ?
+                    WHERE id = ? AND locked_by = ?
+                """, (retry_at, str(error), job_id, worker_id))
+                logger.warning(f"⚠️ Job {job_id} failed (attempt {attempts}/{max_attempts}), retry at {retry_at}: {error}")
+        finally:
+            conn.close()
+
+    def stats(self):
+        """Return the number of jobs per status."""
+        conn = self._connect()
+        try:
+            c = conn.cursor()
+            c.execute("SELECT status, COUNT(*) FROM job_queue GROUP BY status")
+            return dict(c.fetchall())
+        finally:
+            conn.close()
+
+    def purge(self, older_than_days=7):
+        """Delete done and failed jobs finished more than `older_than_days` ago."""
+        cutoff = datetime.now() - timedelta(days=older_than_days)
+        conn = self._connect()
+        try:
+            c = conn.cursor()
+            c.execute("""
+                DELETE FROM job_queue
+                WHERE status IN ('done', 'failed') AND finished_at < ?
+            """, (cutoff,))
+            deleted = c.rowcount
+        finally:
+            conn.close()
+
+        if deleted > 0:
+            logger.info(f"🧹 Purged {deleted} finished job(s)")
+        return deleted
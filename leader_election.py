@@ -0,0 +1,116 @@
+"""
+Lease-based leader election backed by SQLite.
+Only the process holding the lease runs scheduled background jobs.
+"""
+
+import os
+import socket
+import sqlite3
+import logging
+from datetime import datetime, timedelta
+from functools import wraps
+
+logger = logging.getLogger(__name__)
+
+
+class LeaderElection:
+    """
+    Single-leader election using one row per lease name in `leader_leases`.
+
+    The leader renews its lease on every heartbeat. If it dies, the lease
+    expires and the first process to heartbeat afterwards takes over, so
+    failover happens within `lease_seconds + heartbeat_seconds`.
+    """
+
+    def __init__(self, db_path, name='scheduler', holder_id=None, lease_seconds=15, heartbeat_seconds=5):
+        """
+        Initialize the election.
+
+        Args:
+            db_path: Path to SQLite database
+            name: Lease name; processes competing for the same jobs use the same name
+            holder_id: Identifier of this process (default: hostname:pid)
+            lease_seconds: How long a lease is valid without a heartbeat
+            heartbeat_seconds: How often the lease is renewed or contended
+        """
+        self.db_path = db_path
+        self.name = name
+        self.holder_id = holder_id or f"{socket.gethostname()}:{os.getpid()}"
+        self.lease = timedelta(seconds=lease_seconds)
+        self.heartbeat_seconds = heartbeat_seconds
+        self._lease_until = None
+
+    @property
+    def is_leader(self):
+        """True while this process holds a lease that has not expired locally."""
+        return self._lease_until is not None and datetime.now() < self._lease_until
+
+    def heartbeat(self):
+        """
+        Acquire or renew the lease. Returns True if this process is the leader.
+
+        The upsert only overwrites the row if we already hold it or if the
+        current lease has expired, so at most one holder wins.
+        """
+        was_leader = self.is_leader
+        now = datetime.now()
+        lease_until = now + self.lease
+
+        try:
+            conn = sqlite3.connect(self.db_path, timeout=5)
+            c = conn.cursor()
+            c.execute("""
+                INSERT INTO leader_leases (name, holder, lease_until, heartbeat_at)
+                VALUES (?, ?, ?, ?)
+                ON CONFLICT(name) DO UPDATE SET
+                    holder = excluded.holder,
+                    lease_until = excluded.lease_until,
+                    heartbeat_at = excluded.heartbeat_at
+                WHERE leader_leases.holder = excluded.holder OR leader_leases.lease_until < ?
+            """, (self.name, self.holder_id, lease_until, now, now))
+            acquired = c.rowcount > 0
+            conn.commit()
+            conn.close()
+        except Exception as e:
+            logger.error(f"❌ Leader heartbeat failed for '{self.name}': {e}")
+            acquired = False
+
+        self._lease_until = lease_until if acquired else None
+
+        if acquired and not was_leader:
+            logger.info(f"👑 {self.holder_id} is now leader for '{self.name}'")
+        elif was_leader and not acquired:
+            logger.warning(f"⚠️ {self.holder_id} lost leadership for '{self.name}'")
+        return acquired
+
+    def release(self):
+        """Give up the lease so another process can take over immediately."""
+        if self._lease_until is None:
+            return
+        self._lease_until = None
+        try:
+            conn = sqlite3.connect(self.db_path, timeout=5)
+            conn.execute("DELETE FROM leader_leases WHERE name = ? AND holder = ?", (self.name, self.holder_id))
+            conn.commit()
+            conn.close()
+            logger.info(f"{self.holder_id} released leadership for '{self.name}'")
+        except Exception as e:
+            logger.error(f"❌ Failed to release leadership for '{self.name}': {e}")
+
+    def current_leader(self):
+        """Return (holder, lease_until) of the current lease, or None."""
+        conn = sqlite3.connect(self.db_path, timeout=5)
+        c = conn.cursor()
+        c.execute("SELECT holder, lease_until FROM leader_leases WHERE name = ?", (self.name,))
+        row = c.fetchone()
+        conn.close()
+        return row
+
+    def leader_only(self, func):
+        """Wrap a job so it only runs in the leader process."""
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if not self.is_leader:
+                return None
+            return func(*args, **kwargs)
+        return wrapper
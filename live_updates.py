@@ -0,0 +1,251 @@
+"""
+Sequenced Socket.IO broadcasts with a replay buffer.
+Reconnecting clients receive only the messages they missed.
+Clients can opt into a compact wire format with short keys and participant diffs.
+"""
+
+import uuid
+import threading
+import logging
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+# Rooms of the two wire formats; clients start in FULL_ROOM and switch on 'resume'
+FULL_ROOM = 'live:full'
+COMPACT_ROOM = 'live:compact'
+
+# Compact wire format: full key -> short key (keys not listed are sent as they are)
+COMPACT_KEYS = {
+    'seq': 's',
+    'id': 'i',
+    'action': 'a',
+    'title': 't',
+    'description': 'd',
+    'day': 'dy',
+    'event_date': 'dt',
+    'start_time': 'st',
+    'end_time': 'et',
+    'max_slots': 'm',
+    'registered': 'r',
+    'compensation': 'c',
+    'week': 'w',
+    'message': 'msg',
+    'participants': 'p',
+    'participants_added': 'p+',
+    'participants_removed': 'p-',
+    'absent': 'x',
+    'absent_added': 'x+',
+    'absent_removed': 'x-'
+}
+
+
+class CompactCodec:
+    """
+    Encodes messages for the compact format.
+
+    `event_update` carries the participant and absent lists as added/removed
+    diffs against the previous message for the same event. The first message
+    for an event after a restart carries the full lists. Messages are encoded
+    once, in seq order, so the diffs chain correctly for every client that
+    applied all previous messages (which the replay buffer guarantees).
+    """
+
+    LIST_KEYS = ('participants', 'absent')
+
+    def __init__(self):
+        self._lists = {}
+
+    def encode(self, event, data):
+        """Return the compact form of `data`."""
+        data = dict(data)
+        if event == 'event_update':
+            self._diff(data)
+        return {COMPACT_KEYS.get(key, key): value for key, value in data.items()}
+
+    def _diff(self, data):
+        event_id = data.get('id')
+        if data.get('action') == 'delete':
+            self._lists.pop(event_id, None)
+            return
+        if not all(key in data for key in self.LIST_KEYS):
+            return
+
+        previous = self._lists.get(event_id)
+        self._lists[event_id] = {key: list(data[key]) for key in self.LIST_KEYS}
+        if previous is None:
+            return
+
+        for key in self.LIST_KEYS:
+            current = data.pop(key)
+            before = set(previous[key])
+            after = set(current)
+            added = [name for name in current if name not in before]
+            removed = [name for name in previous[key] if name not in after]
+            if added:
+                data[f'{key}_added'] = added
+            if removed:
+                data[f'{key}_removed'] = removed
+
+
+class LiveUpdates:
+    """
+    Wraps `socketio.emit` for broadcasts.
+
+    Every message gets a `seq` from a global counter and is kept in a bounded
+    ring buffer. A client that reconnects sends the epoch and last seq it saw
+    and gets the missed messages back. If the server restarted (new epoch) or
+    the gap was evicted from the buffer, the client has to reload.
+
+    Broadcasts are encoded once per format and sent to FULL_ROOM and
+    COMPACT_ROOM. Messages for a specific room (e.g. admins only) are sent
+    in full format to that room alone and replayed only to its members.
+
+    Slow consumers: before each message the outbound Engine.IO queue of every
+    recipient is checked. A client with more than `max_queue` packets waiting
+    stops receiving messages; once its queue drains it gets a single
+    'resync' instead of the dropped deltas.
+    """
+
+    def __init__(self, socketio, buffer_size=1000, max_queue=100):
+        """
+        Initialize the broadcaster.
+
+        Args:
+            socketio: Flask-SocketIO instance
+            buffer_size: Number of recent messages kept for replay
+            max_queue: Outbound packets a client may have pending before it is
+                marked as lagging
+        """
+        self.socketio = socketio
+        self.epoch = uuid.uuid4().hex[:12]
+        self.seq = 0
+        self._buffer = deque(maxlen=buffer_size)
+        self._lock = threading.Lock()
+        self._codec = CompactCodec()
+        self.max_queue = max_queue
+        self._lagging = set()
+        self.dropped = 0
+        self.resyncs = 0
+
+    def head(self):
+        """Return {'epoch', 'seq'} of the last message sent."""
+        with self._lock:
+            return {'epoch': self.epoch, 'seq': self.seq}
+
+    def _participants(self, rooms):
+        return self.socketio.server.manager.get_participants('/', list(rooms))
+
+    def _queue_depth(self, eio_sid):
+        """Packets waiting in the Engine.IO outbound queue of a connection (0 if unknown)."""
+        socket = self.socketio.server.eio.sockets.get(eio_sid)
+        try:
+            return socket.queue.qsize()
+        except AttributeError:
+            return 0
+
+    def _skipped(self, rooms):
+        """
+        Return the sids that must not receive the current message: clients
+        over the queue bound, and lagging clients that just drained (they
+        get one 'resync' with the current head instead).
+        """
+        skip = []
+        for sid, eio_sid in self._participants(rooms):
+            depth = self._queue_depth(eio_sid)
+            if sid in self._lagging:
+                if depth <= self.max_queue // 4:
+                    self._lagging.discard(sid)
+                    self.resyncs += 1
+                    self.socketio.emit('resync', {'epoch': self.epoch, 'seq': self.seq}, to=sid)
+                else:
+                    self.dropped += 1
+                skip.append(sid)
+            elif depth > self.max_queue:
+                logger.warning(f"🐢 Slow Socket.IO client {sid} ({depth} packets queued): "
+                               f"dropping updates until it catches up")
+                self._lagging.add(sid)
+                self.dropped += 1
+                skip.append(sid)
+        return skip
+
+    def emit(self, event, data, room=None):
+        """
+        Send `data` with the next sequence number to every client,
+        or only to `room` (full format).
+        """
+        with self._lock:
+            self.seq += 1
+            message = dict(data, seq=self.seq)
+            compact = None if room else self._codec.encode(event, message)
+            self._buffer.append((self.seq, event, room, message, compact))
+
+            # Emit inside the lock so clients see messages in seq order
+            if room:
+                self.socketio.emit(event, message, to=room, skip_sid=self._skipped([room]))
+            else:
+                skip = self._skipped([FULL_ROOM, COMPACT_ROOM])
+                self.socketio.emit(event, message, to=FULL_ROOM, skip_sid=skip)
+                self.socketio.emit(event, compact, to=COMPACT_ROOM, skip_sid=skip)
+        return message['seq']
+
+    def missed(self, epoch, seq, rooms=(), sid=None):
+        """
+        Return [(event, message)] sent after `seq` to a client in `rooms`,
+        or None if the client must reload: different epoch, seq ahead of the
+        server, messages already evicted from the buffer, or messages dropped
+        because the client (`sid`) was lagging.
+        """
+        compact = COMPACT_ROOM in rooms
+        with self._lock:
+            if sid in self._lagging:
+                self._lagging.discard(sid)
+                self.resyncs += 1
+                return None
+            if epoch != self.epoch or seq is None or seq > self.seq:
+                return None
+            if seq == self.seq:
+                return []
+            if not self._buffer or self._buffer[0][0] > seq + 1:
+                return None
+            return [
+                (event, compact_message if compact and compact_message is not None else message)
+                for s, event, room, message, compact_message in self._buffer
+                if s > seq and (room is None or room in rooms)
+            ]
+
+    def forget(self, sid):
+        """Drop the state of a disconnected client."""
+        with self._lock:
+            self._lagging.discard(sid)
+
+    def _transport(self, eio_sid):
+        try:
+            return self.socketio.server.eio.transport(eio_sid)
+        except KeyError:
+            return 'unknown'
+
+    def stats(self):
+        """Return connection, transport and backpressure counters."""
+        with self._lock:
+            participants = list(self._participants([FULL_ROOM, COMPACT_ROOM]))
+            depths = [self._queue_depth(eio_sid) for _, eio_sid in participants]
+            transports = {'websocket': 0, 'polling': 0}
+            for _, eio_sid in participants:
+                transport = self._transport(eio_sid)
+                transports[transport] = transports.get(transport, 0) + 1
+            compact = sum(1 for _ in self._participants([COMPACT_ROOM]))
+            return {
+                'epoch': self.epoch,
+                'seq': self.seq,
+                'buffered': len(self._buffer),
+                'clients': len(depths),
+                'transports': transports,
+                'formats': {'full': len(depths) - compact, 'compact': compact},
+                'lagging': len(self._lagging),
+                'max_queue': self.max_queue,
+                'queue_depth_max': max(depths, default=0),
+                'queue_depth_total': sum(depths),
+                'dropped': self.dropped,
+                'resyncs': self.resyncs
+            }
@@ -0,0 +1,230 @@
+"""
+Row models for the main tables.
+Every model lists its columns explicitly, so queries never depend on
+SELECT * positions and a migration adding a column changes nothing here.
+Rows are built by a cursor row factory straight into slotted dataclasses.
+"""
+
+from dataclasses import dataclass, fields
+from typing import ClassVar, Optional
+
+# Values of registrations.attended (BOOLEAN columns come back as int or str)
+PRESENT = (1, '1', True)
+ABSENT = (0, '0', False)
+
+
+class Row:
+    """Base of the row models: column list, row factory and conversions."""
+
+    __slots__ = ()
+    TABLE: ClassVar[str] = ''
+    COLUMNS: ClassVar[tuple] = ()
+
+    @classmethod
+    def from_row(cls, cursor, row):
+        """sqlite3 row factory: columns in COLUMNS order"""
+        return cls(*row)
+
+    def values(self, columns=None):
+        """Column values in COLUMNS order (or in the order of `columns`)"""
+        return tuple(getattr(self, name) for name in columns or self.COLUMNS)
+
+    def to_dict(self):
+        return {name: getattr(self, name) for name in self.COLUMNS}
+
+
+def row_model(table):
+    """Class decorator: slotted dataclass mapped to `table`, COLUMNS taken from the fields"""
+    def decorator(cls):
+        cls = dataclass(slots=True)(cls)
+        cls.TABLE = table
+        cls.COLUMNS = tuple(field.name for field in fields(cls))
+        return cls
+    return decorator
+
+
+@row_model('events')
+class Event(Row):
+    id: int
+    title: str
+    description: Optional[str]
+    day: str
+    event_date: Optional[str]
+    start_time: str
+    end_time: str
+    max_slots: int
+    registered: int
+    compensation: Optional[int]
+    week: int
+
+    @property
+    def duration(self):
+        """Length in hours (None if the times are missing or malformed)"""
+        if not self.start_time or not self.end_time or ':' not in self.start_time or ':' not in self.end_time:
+            return None
+        start_h, start_m = map(int, self.start_time.split(':'))
+        end_h, end_m = map(int, self.end_time.split(':'))
+        return (end_h * 60 + end_m - start_h * 60 - start_m) / 60
+
+    def concrete_date(self, day_dates):
+        """event_date, or the date of its weekday in the pool week (`day_dates` of that week)"""
+        return self.event_date or day_dates.get(self.day)
+
+
+@row_model('registrations')
+class Registration(Row):
+    id: int
+    event_id: int
+    participant_name: str
+    registration_date: Optional[str]
+    attended: Optional[int]
+
+    @property
+    def is_present(self):
+        return self.attended in PRESENT
+
+    @property
+    def is_absent(self):
+        return self.attended in ABSENT
+
+
+@row_model('users')
+class User(Row):
+    id: int
+    intra_id: int
+    login: str
+    email: Optional[str]
+    display_name: Optional[str]
+    image_url: Optional[str]
+    wallet: int
+    is_admin: int
+    created_at: Optional[str]
+
+
+@row_model('action_logs')
+class LogEntry(Row):
+    id: int
+    timestamp: str
+    user_id: int
+    username: str
+    action_type: str
+    action_description: Optional[str]
+    ip_address: Optional[str]
+    user_agent: Optional[str]
+    resource_id: Optional[str]
+    resource_type: Optional[str]
+    old_value: Optional[str]
+    new_value: Optional[str]
+
+
+@row_model('scheduled_notifications')
+class ScheduledNotification(Row):
+    id: Optional[int] = None
+    user_id: Optional[int] = None
+    event_id: Optional[int] = None
+    registration_id: Optional[int] = None
+    notification_type: Optional[str] = None
+    offset_minutes: Optional[int] = None
+    scheduled_time: Optional[str] = None
+    sent: int = 0
+    sent_at: Optional[str] = None
+    error_message: Optional[str] = None
+    job_id: Optional[int] = None
+    email_status: Optional[str] = None
+
+
+def select_sql(model, where=None, order_by=None, limit=False):
+    """SELECT of all the columns of `model` (with LIMIT ? OFFSET ? placeholders if `limit`)"""
+    sql = f"SELECT {', '.join(model.COLUMNS)} FROM {model.TABLE}"
+    if where:
+        sql += f" WHERE {where}"
+    if order_by:
+        sql += f" ORDER BY {order_by}"
+    if limit:
+        sql += " LIMIT ? OFFSET ?"
+    return sql
+
+
+def _cursor(c, model):
+    # New cursor on the same connection: same transaction, own row factory
+    cursor = c.connection.cursor()
+    cursor.row_factory = model.from_row
+    return cursor
+
+
+def fetch_all(c, model, where=None, params=(), order_by=None, limit=False):
+    """Rows of `model`, read on the connection of cursor `c`"""
+    cursor = _cursor(c, model)
+    cursor.execute(select_sql(model, where, order_by, limit), params)
+    return cursor.fetchall()
+
+
+def fetch_one(c, model, where=None, params=()):
+    """First row of `model` matching `where`, or None"""
+    cursor = _cursor(c, model)
+    cursor.execute(select_sql(model, where), params)
+    return cursor.fetchone()
+
+
+class _EventProxy:
+    """Attributes not defined by a view are read from its `event`"""
+
+    __slots__ = ()
+
+    def __getattr__(self, name):
+        if name.startswith('_') or name == 'event':
+            raise AttributeError(name)
+        return getattr(self.event, name)
+
+
+@dataclass(slots=True)
+class EventView(_EventProxy):
+    """
+    An event with its registrations, as shown by the calendar, the display
+    and the admin panel. `registered` counts only the participants present.
+    """
+    event: Event
+    registrations: list
+    concrete_date: Optional[str] = None
+    is_passed: bool = False
+    is_user_registered: bool = False
+
+    @property
+    def participants_all(self):
+        return [r.participant_name for r in self.registrations]
+
+    @property
+    def participants_visible(self):
+        return [r.participant_name for r in self.registrations if r.is_present]
+
+    @property
+    def registered_visible(self):
+        return sum(1 for r in self.registrations if r.is_present)
+
+    @property
+    def registered(self):
+        return self.registered_visible
+
+    @property
+    def available_slots(self):
+        return self.event.max_slots - self.registered_visible
+
+    @property
+    def is_available(self):
+        return self.available_slots > 0 and not self.is_passed
+
+
+@dataclass(slots=True)
+class ParticipantEvent(_EventProxy):
+    """An event seen by one participant: their registration and the concrete date"""
+    event: Event
+    registration: Registration
+    concrete_date: Optional[str] = None
+
+    @property
+    def attended(self):
+        return self.registration.attended
+
+    @property
+    def registration_date(self):
+        return self.registration.registration_date
@@ -1,29 +1,176 @@
 """
 Notification Manager for Browser Push Notifications
 Handles scheduling and sending push notifications to users about upcoming events.
+
+Run `python -m notifications worker` to deliver notifications out of the web process.
 """
 
 import os
+import sys
+import time
+import signal
+import socket
 import sqlite3
 import json
 import logging
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
+import requests
+from requests.adapters import HTTPAdapter
+from py_vapid import Vapid
 from pywebpush import webpush, WebPushException
 from apscheduler.schedulers.background import BackgroundScheduler
 from apscheduler.triggers.date import DateTrigger
+from email_fallback import email_fallback_from_env
+from job_queue import JobQueue
+from leader_election import LeaderElection
+from retention import RetentionEngine, retention_from_env
+from models import ScheduledNotification
+from queries import run, run_many
 
 logger = logging.getLogger(__name__)
 
+# Reminder lead times, in minutes before the event start
+DEFAULT_REMINDER_OFFSETS = [24 * 60, 60]
+MAX_REMINDER_OFFSETS = 8
+MAX_REMINDER_OFFSET_MINUTES = 14 * 24 * 60
+
+# Subscriptions processed per broadcast batch (progress is committed after each one)
+BROADCAST_BATCH_SIZE = 500
+# Push services answer 404/410 for subscriptions that no longer exist
+GONE_STATUS_CODES = (404, 410)
+
+_OFFSET_UNITS = {'d': 24 * 60, 'h': 60, 'm': 1}
+
+
+def parse_reminder_offset(value):
+    """
+    Parse a reminder lead time into minutes.
+    
+    Accepts an int (minutes) or a string such as '2d', '3h', '15m' or '90'.
+    Raises ValueError if the value is malformed or out of range.
+    """
+    if isinstance(value, bool):
+        raise ValueError(f"Invalid reminder offset: {value!r}")
+    if isinstance(value, int):
+        minutes = value
+    else:
+        text = str(value).strip().lower()
+        unit = _OFFSET_UNITS.get(text[-1:]) if text else None
+        number = text[:-1] if unit else text
+        if not number.isdigit():
+            raise ValueError(f"Invalid reminder offset: {value!r}")
+        minutes = int(number) * (unit or 1)
+    
+    if not 1 <= minutes <= MAX_REMINDER_OFFSET_MINUTES:
+        raise ValueError(f"Reminder offset out of range: {value!r}")
+    return minutes
+
+
+def notification_type_for_offset(minutes):
+    """Return the notification_type label for an offset (e.g. 1440 -> '24h_before')."""
+    if minutes % 60 == 0:
+        return f"{minutes // 60}h_before"
+    return f"{minutes}m_before"
+
+
+def offset_for_notification_type(notif_type):
+    """Inverse of notification_type_for_offset, used for rows without offset_minutes."""
+    value = notif_type[:-len('_before')] if notif_type.endswith('_before') else notif_type
+    return parse_reminder_offset(value)
+
+
+def describe_offset(minutes):
+    """Human readable Italian description of a lead time (e.g. 'tra 3 ore')."""
+    if minutes == 24 * 60:
+        return "domani"
+    
+    days, rest = divmod(minutes, 24 * 60)
+    hours, mins = divmod(rest, 60)
+    parts = []
+    if days:
+        parts.append(f"{days} giorn{'o' if days == 1 else 'i'}")
+    if hours:
+        parts.append(f"{hours} or{'a' if hours == 1 else 'e'}")
+    if mins:
+        parts.append(f"{mins} minut{'o' if mins == 1 else 'i'}")
+    return "tra " + " e ".join(parts)
+
+
+def minutes_until_start(event, now):
+    """
+    Minutes from `now` to the start of an event dict with 'event_date' and
+    'start_time', rounded to the minute; None if the date is unknown.
+    """
+    try:
+        start = datetime.strptime(f"{event['event_date']} {event['start_time']}", '%Y-%m-%d %H:%M')
+    except (KeyError, TypeError, ValueError):
+        return None
+    return max(0, round((start - now).total_seconds() / 60))
+
+
+def describe_lead_time(event, offset_minutes, now):
+    """
+    Lead time of one event in a reminder: the real time left until it starts
+    (digested reminders can be sent before their own offset), or the reminder
+    offset when the event date is unknown.
+    """
+    minutes = minutes_until_start(event, now)
+    if minutes is None:
+        return describe_offset(offset_minutes)
+    if minutes == 0:
+        return "ora"
+    return describe_offset(minutes)
+
+
+def load_user_preferences(cursor, user_id):
+    """
+    Load notification preferences for a user using an existing cursor.
+    
+    Offsets come from user_notification_offsets; users that never saved a
+    custom list fall back to the legacy 24h/1h booleans.
+    """
+    result = run(cursor, 'notification_preferences', (user_id,)).fetchone()
+    offsets = [row[0] for row in run(cursor, 'notification_offsets', (user_id,)).fetchall()]
+    
+    if not result:
+        # Default preferences if not set
+        return {
+            'enabled': True,
+            'offsets': offsets or list(DEFAULT_REMINDER_OFFSETS)
+        }
+    
+    if not offsets:
+        if result[1]:
+            offsets.append(24 * 60)
+        if result[2]:
+            offsets.append(60)
+    
+    return {
+        'enabled': bool(result[0]),
+        'offsets': offsets
+    }
+
+
 class NotificationManager:
     """
     Manages browser push notifications for event reminders.
     Supports:
-    - 24 hour before event notifications
-    - 1 hour before event notifications
-    - Automatic cleanup of old notifications
+    - User-configurable reminder lead times (default 24 hours and 1 hour before)
+    - Digest pushes merging reminders of the same type for the same user
+    - Delivery inline (APScheduler in this process) or through a JobQueue
+    - Optional leader election so scheduled jobs run in one process only
+    - Broadcast campaigns fanned out to every subscription by a thread pool
+    - Optional batched email fallback for users without push subscriptions
+    - Incremental cleanup of old and orphaned rows through a RetentionEngine
     """
     
-    def __init__(self, db_path, vapid_private_key, vapid_public_key, vapid_claims):
+    def __init__(self, db_path, vapid_private_key, vapid_public_key, vapid_claims,
+                 digest_window_minutes=5, job_queue=None, start_scheduler=True,
+                 leader_election=None, broadcast_concurrency=32, email_fallback=None,
+                 retention=None):
         """
         Initialize the notification manager.
         
@@ -32,31 +179,87 @@ class NotificationManager:
             vapid_private_key: VAPID private key for web push
             vapid_public_key: VAPID public key for web push
             vapid_claims: Dict with 'sub' field (mailto:email@example.com)
+            digest_window_minutes: Reminders of the same type for the same user
+                scheduled within this many minutes are sent as one digest push;
+                the later ones are sent up to this many minutes early
+            job_queue: Optional JobQueue; when set, due digests are enqueued
+                as 'send_digest' jobs instead of being sent by the scheduler
+            start_scheduler: Start the periodic check and cleanup jobs. Web
+                processes that delegate delivery to a worker pass False and
+                only schedule/cancel notifications.
+            leader_election: Optional LeaderElection; when set, the periodic
+                check and the cleanup only run in the leader process
+            broadcast_concurrency: Size of the thread pool used to fan out
+                broadcast campaigns
+            email_fallback: Optional EmailFallback; reminders for users without
+                push subscriptions are then emailed by a separate periodic job
+            retention: RetentionEngine run by the periodic cleanup
+                (default: RetentionEngine with the default policies)
         """
         self.db_path = db_path
         self.vapid_private_key = vapid_private_key
         self.vapid_public_key = vapid_public_key
         self.vapid_claims = vapid_claims
+        self.digest_window = timedelta(minutes=max(0, digest_window_minutes))
+        self.job_queue = job_queue
+        self.leader_election = leader_election
+        self.broadcast_concurrency = max(1, broadcast_concurrency)
+        self.email_fallback = email_fallback
+        self.retention = retention or RetentionEngine(db_path)
         
         # Initialize APScheduler
         self.scheduler = BackgroundScheduler()
+        if start_scheduler:
+            self.start_scheduler()
+        else:
+            logger.info("✅ NotificationManager initialized (delivery delegated to the worker)")
+    
+    def start_scheduler(self):
+        """Start APScheduler with the periodic check and the daily cleanup."""
         self.scheduler.start()
         
+        check_job = self.check_and_send_pending_notifications
+        cleanup_job = self.cleanup_old_notifications
+        email_job = self.send_email_fallbacks
+        
+        if self.leader_election:
+            # Contend for the lease right away, then renew it periodically
+            self.scheduler.add_job(
+                func=self.leader_election.heartbeat,
+                trigger='interval',
+                seconds=self.leader_election.heartbeat_seconds,
+                next_run_time=datetime.now(),
+                id='leader_heartbeat',
+                replace_existing=True
+            )
+            check_job = self.leader_election.leader_only(check_job)
+            cleanup_job = self.leader_election.leader_only(cleanup_job)
+            email_job = self.leader_election.leader_only(email_job)
+        
         # Schedule periodic check for pending notifications (every 5 minutes)
         self.scheduler.add_job(
-            func=self.check_and_send_pending_notifications,
+            func=check_job,
             trigger='interval',
             minutes=5,
             id='check_notifications',
             replace_existing=True
         )
         
-        # Schedule cleanup of old notifications (daily at 3 AM)
+        # Email fallback runs on its own so SMTP never delays the push path
+        if self.email_fallback:
+            self.scheduler.add_job(
+                func=email_job,
+                trigger='interval',
+                minutes=5,
+                id='email_fallback',
+                replace_existing=True
+            )
+        
+        # Incremental retention cleanup (small batches every 15 minutes)
         self.scheduler.add_job(
-            func=self.cleanup_old_notifications,
-            trigger='cron',
-            hour=3,
-            minute=0,
+            func=cleanup_job,
+            trigger='interval',
+            minutes=15,
             id='cleanup_notifications',
             replace_existing=True
         )
@@ -67,33 +270,14 @@ class NotificationManager:
         """Get user notification preferences."""
         conn = sqlite3.connect(self.db_path)
         c = conn.cursor()
-        
-        c.execute("""
-            SELECT notifications_enabled, notify_24h_before, notify_1h_before
-            FROM user_notification_preferences
-            WHERE user_id = ?
-        """, (user_id,))
-        
-        result = c.fetchone()
+        prefs = load_user_preferences(c, user_id)
         conn.close()
-        
-        if result:
-            return {
-                'enabled': bool(result[0]),
-                'notify_24h': bool(result[1]),
-                'notify_1h': bool(result[2])
-            }
-        else:
-            # Default preferences if not set
-            return {
-                'enabled': True,
-                'notify_24h': True,
-                'notify_1h': True
-            }
+        return prefs
     
     def schedule_event_notifications(self, user_id, event_id, registration_id, event_datetime):
         """
         Schedule notifications for an event registration.
+        One row is inserted per reminder offset configured by the user.
         
         Args:
             user_id: User ID
@@ -101,42 +285,51 @@ class NotificationManager:
             registration_id: Registration ID
             event_datetime: DateTime object of the event
         """
-        # Get user preferences
-        prefs = self.get_user_preferences(user_id)
-        
-        if not prefs['enabled']:
-            logger.info(f"User {user_id} has notifications disabled, skipping")
-            return
+        self.schedule_registrations([(user_id, event_id, registration_id, event_datetime)])
+    
+    def schedule_registrations(self, registrations):
+        """
+        Schedule the notifications of many registrations at once (e.g. a lottery
+        allocation): preferences are read once per user and all the rows are
+        inserted in one transaction.
         
-        conn = sqlite3.connect(self.db_path)
-        c = conn.cursor()
+        Args:
+            registrations: List of (user_id, event_id, registration_id, event_datetime)
         
+        Returns the number of notifications scheduled.
+        """
         now = datetime.now()
+        columns = ('user_id', 'event_id', 'registration_id', 'notification_type', 'offset_minutes', 'scheduled_time')
+        conn = sqlite3.connect(self.db_path)
+        try:
+            c = conn.cursor()
+            prefs_by_user = {}
+            notifications = []
+            for user_id, event_id, registration_id, event_datetime in registrations:
+                if user_id not in prefs_by_user:
+                    prefs_by_user[user_id] = load_user_preferences(c, user_id)
+                prefs = prefs_by_user[user_id]
+                if not prefs['enabled']:
+                    logger.info(f"User {user_id} has notifications disabled, skipping")
+                    continue
+                for offset in prefs['offsets']:
+                    notify_time = event_datetime - timedelta(minutes=offset)
+                    if notify_time > now:
+                        notifications.append(ScheduledNotification(
+                            user_id=user_id, event_id=event_id, registration_id=registration_id,
+                            notification_type=notification_type_for_offset(offset),
+                            offset_minutes=offset, scheduled_time=notify_time
+                        ))
+            
+            if notifications:
+                run_many(c, 'notifications_insert', [n.values(columns) for n in notifications])
+                conn.commit()
+        finally:
+            conn.close()
         
-        # Schedule 24h notification
-        if prefs['notify_24h']:
-            notify_24h_time = event_datetime - timedelta(hours=24)
-            if notify_24h_time > now:
-                c.execute("""
-                    INSERT INTO scheduled_notifications 
-                    (user_id, event_id, registration_id, notification_type, scheduled_time)
-                    VALUES (?, ?, ?, ?, ?)
-                """, (user_id, event_id, registration_id, '24h_before', notify_24h_time))
-                logger.info(f"📅 Scheduled 24h notification for user {user_id}, event {event_id} at {notify_24h_time}")
-        
-        # Schedule 1h notification
-        if prefs['notify_1h']:
-            notify_1h_time = event_datetime - timedelta(hours=1)
-            if notify_1h_time > now:
-                c.execute("""
-                    INSERT INTO scheduled_notifications 
-                    (user_id, event_id, registration_id, notification_type, scheduled_time)
-                    VALUES (?, ?, ?, ?, ?)
-                """, (user_id, event_id, registration_id, '1h_before', notify_1h_time))
-                logger.info(f"⏰ Scheduled 1h notification for user {user_id}, event {event_id} at {notify_1h_time}")
-        
-        conn.commit()
-        conn.close()
+        for n in notifications:
+            logger.info(f"📅 Scheduled {n.notification_type} notification for user {n.user_id}, event {n.event_id} at {n.scheduled_time}")
+        return len(notifications)
     
     def cancel_event_notifications(self, registration_id):
         """
@@ -148,10 +341,7 @@ class NotificationManager:
         conn = sqlite3.connect(self.db_path)
         c = conn.cursor()
         
-        c.execute("""
-            DELETE FROM scheduled_notifications
-            WHERE registration_id = ? AND sent = 0
-        """, (registration_id,))
+        run(c, 'notifications_cancel_registration', (registration_id,))
         
         deleted_count = c.rowcount
         conn.commit()
@@ -160,7 +350,7 @@ class NotificationManager:
         if deleted_count > 0:
             logger.info(f"🗑️ Cancelled {deleted_count} notification(s) for registration {registration_id}")
     
-    def send_push_notification(self, user_id, title, body, icon=None, url=None):
+    def send_push_notification(self, user_id, title, body, icon=None, url=None, tag=None, data=None, cursor=None):
         """
         Send a push notification to all user's subscribed devices.
         
@@ -170,19 +360,17 @@ class NotificationManager:
             body: Notification body
             icon: Optional icon URL
             url: Optional URL to open when clicked
+            tag: Optional notification tag (same tag replaces the previous push)
+            data: Optional extra fields merged into the payload 'data' dict
+            cursor: Optional cursor of the caller's transaction; delivery stats
+                are written there (no commit) instead of on a new connection
         """
-        conn = sqlite3.connect(self.db_path)
-        c = conn.cursor()
-        
-        # Get all push subscriptions for user
-        c.execute("""
-            SELECT id, endpoint, p256dh, auth
-            FROM push_subscriptions
-            WHERE user_id = ?
-        """, (user_id,))
-        
-        subscriptions = c.fetchall()
-        conn.close()
+        if cursor is not None:
+            subscriptions = run(cursor, 'push_subscriptions_by_user', (user_id,)).fetchall()
+        else:
+            conn = sqlite3.connect(self.db_path)
+            subscriptions = run(conn.cursor(), 'push_subscriptions_by_user', (user_id,)).fetchall()
+            conn.close()
         
         if not subscriptions:
             logger.warning(f"No push subscriptions found for user {user_id}")
@@ -196,13 +384,16 @@ class NotificationManager:
             'badge': '/static/badge.png',
             'vibrate': [200, 100, 200],
             'requireInteraction': True,
-            'tag': f'event-notification',
+            'tag': tag or 'event-notification',
             'data': {
                 'url': url or '/'
             }
         }
+        if data:
+            payload['data'].update(data)
         
-        success_count = 0
+        succeeded = []
+        failed = []
         failed_subscriptions = []
         
         for sub_id, endpoint, p256dh, auth in subscriptions:
@@ -219,119 +410,817 @@ class NotificationManager:
                     subscription_info=subscription_info,
                     data=json.dumps(payload),
                     vapid_private_key=self.vapid_private_key,
-                    vapid_claims=self.vapid_claims
+                    # webpush() writes 'aud'/'exp' into the claims, never share them across endpoints
+                    vapid_claims=dict(self.vapid_claims)
                 )
-                success_count += 1
+                succeeded.append(sub_id)
                 logger.info(f"✅ Push notification sent to subscription {sub_id}")
             except WebPushException as e:
                 logger.error(f"❌ Failed to send push notification to subscription {sub_id}: {e}")
                 # If subscription is invalid (410 Gone), mark for deletion
-                if e.response and e.response.status_code == 410:
+                if e.response is not None and e.response.status_code in GONE_STATUS_CODES:
                     failed_subscriptions.append(sub_id)
+                else:
+                    failed.append(sub_id)
         
-        # Remove invalid subscriptions
+        # Track delivery health and remove invalid subscriptions
+        conn = sqlite3.connect(self.db_path) if cursor is None else None
+        c = cursor if conn is None else conn.cursor()
+        self._record_delivery(c, succeeded, failed, datetime.now())
         if failed_subscriptions:
-            conn = sqlite3.connect(self.db_path)
-            c = conn.cursor()
-            for sub_id in failed_subscriptions:
-                c.execute("DELETE FROM push_subscriptions WHERE id = ?", (sub_id,))
-                logger.info(f"🗑️ Removed invalid subscription {sub_id}")
+            self._prune_subscriptions(c, failed_subscriptions)
+        if conn is not None:
             conn.commit()
             conn.close()
         
-        return success_count > 0
+        return len(succeeded) > 0
     
-    def check_and_send_pending_notifications(self):
+    @staticmethod
+    def _prune_subscriptions(c, subscription_ids):
+        """Delete expired subscriptions in bulk using an existing cursor."""
+        for start in range(0, len(subscription_ids), BROADCAST_BATCH_SIZE):
+            chunk = subscription_ids[start:start + BROADCAST_BATCH_SIZE]
+            placeholders = ','.join('?' for _ in chunk)
+            c.execute(f"DELETE FROM push_subscriptions WHERE id IN ({placeholders})", chunk)
+        logger.info(f"🗑️ Removed {len(subscription_ids)} invalid subscription(s)")
+    
+    @staticmethod
+    def _record_delivery(c, succeeded, failed, now):
         """
-        Check for pending notifications that should be sent now.
-        Called periodically by APScheduler.
+        Update delivery health of subscriptions using an existing cursor.
+        A success resets the failure counter, so failure_count counts
+        consecutive failures; the retention engine prunes subscriptions
+        that reach the limit.
         """
-        conn = sqlite3.connect(self.db_path)
-        c = conn.cursor()
+        if succeeded:
+            c.executemany("""
+                UPDATE push_subscriptions SET last_success_at = ?, failure_count = 0 WHERE id = ?
+            """, [(now, sub_id) for sub_id in succeeded])
+        if failed:
+            c.executemany("""
+                UPDATE push_subscriptions
+                SET last_failure_at = ?, failure_count = COALESCE(failure_count, 0) + 1
+                WHERE id = ?
+            """, [(now, sub_id) for sub_id in failed])
+    
+    def enqueue_push(self, c, user_id, title, body, url=None, tag=None):
+        """
+        Queue a push to one user using an existing cursor (no commit), so it is
+        sent only if the caller's transaction commits (e.g. a waitlist promotion).
         
-        now = datetime.now()
+        Returns False without a job queue: the caller sends it after committing
+        with `send_push_notification`.
+        """
+        if not self.job_queue:
+            return False
+        self.job_queue.enqueue('push', {'user_id': user_id, 'title': title, 'body': body, 'url': url, 'tag': tag},
+                               max_attempts=3, cursor=c)
+        return True
+    
+    def send_push_job(self, payload):
+        """Job handler for 'push'."""
+        self.send_push_notification(payload['user_id'], payload['title'], payload['body'],
+                                    url=payload.get('url'), tag=payload.get('tag'))
+    
+    def create_broadcast(self, c, title, body, url=None, audience='all', created_by=None):
+        """
+        Create a broadcast campaign using an existing cursor (no commit).
+        
+        With a job queue a 'broadcast' job is enqueued in the same transaction;
+        otherwise the caller starts `run_broadcast` after committing.
+        
+        Args:
+            c: Cursor of the caller's transaction
+            title: Notification title
+            body: Notification body
+            url: Optional URL to open when clicked
+            audience: 'all' subscriptions or only 'whitelist'ed users
+            created_by: Login of the admin who sent it
+        
+        Returns the campaign ID.
+        """
+        if audience not in ('all', 'whitelist'):
+            raise ValueError(f"Invalid broadcast audience: {audience!r}")
         
-        # Find notifications that should be sent
         c.execute("""
-            SELECT sn.id, sn.user_id, sn.event_id, sn.notification_type,
-                   e.title, e.day, e.start_time, e.event_date
-            FROM scheduled_notifications sn
-            JOIN events e ON sn.event_id = e.id
-            WHERE sn.sent = 0 AND sn.scheduled_time <= ?
-        """, (now,))
+            INSERT INTO broadcast_campaigns (title, body, url, audience, created_by, created_at)
+            VALUES (?, ?, ?, ?, ?, ?)
+        """, (title, body, url or '/', audience, created_by, datetime.now()))
+        campaign_id = c.lastrowid
         
-        pending = c.fetchall()
+        if self.job_queue:
+            self.job_queue.enqueue('broadcast', {'campaign_id': campaign_id}, max_attempts=3, cursor=c)
+        return campaign_id
+    
+    @staticmethod
+    def _broadcast_audience_query(audience):
+        """Return the FROM/WHERE clause selecting the subscriptions of an audience."""
+        if audience == 'whitelist':
+            return """
+                FROM push_subscriptions ps
+                JOIN users u ON u.intra_id = ps.user_id
+                JOIN baywatcher_whitelist w ON w.intra_login = u.login
+                WHERE ps.id > ?
+            """
+        return "FROM push_subscriptions ps WHERE ps.id > ?"
+    
+    def _send_broadcast_push(self, subscription, data, vapid, session):
+        """
+        Send one broadcast push. Runs in the broadcast thread pool.
+        Returns (sub_id, endpoint, status_code, error); error is None on success.
+        """
+        sub_id, endpoint, p256dh, auth = subscription
+        try:
+            webpush(
+                subscription_info={'endpoint': endpoint, 'keys': {'p256dh': p256dh, 'auth': auth}},
+                data=data,
+                vapid_private_key=vapid,
+                vapid_claims=dict(self.vapid_claims),
+                timeout=10,
+                requests_session=session
+            )
+            return sub_id, endpoint, None, None
+        except WebPushException as e:
+            status_code = e.response.status_code if e.response is not None else None
+            return sub_id, endpoint, status_code, str(e)[:500]
+        except Exception as e:
+            return sub_id, endpoint, None, str(e)[:500]
+    
+    def run_broadcast(self, campaign_id):
+        """
+        Fan out a broadcast campaign to every subscription of its audience.
         
-        for notif_id, user_id, event_id, notif_type, event_title, event_day, event_time, event_date in pending:
-            try:
-                # Prepare notification message
-                time_msg = "domani" if notif_type == '24h_before' else "tra 1 ora"
-                title = f"Promemoria Evento: {event_title}"
-                body = f"Il tuo evento '{event_title}' inizia {time_msg} ({event_day} alle {event_time})"
-                
-                # Send push notification
-                success = self.send_push_notification(
-                    user_id=user_id,
-                    title=title,
-                    body=body,
-                    url='/calendar'
-                )
+        Subscriptions are read in ID order, BROADCAST_BATCH_SIZE at a time,
+        and sent concurrently by a bounded thread pool sharing one keep-alive
+        HTTP session and one parsed VAPID key. After each batch the counters,
+        the failures and the resume cursor are committed and expired
+        subscriptions are pruned in bulk, so a retried job resumes where the
+        previous attempt stopped.
+        """
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        c = conn.cursor()
+        
+        c.execute("""
+            SELECT title, body, url, audience, status, last_subscription_id
+            FROM broadcast_campaigns
+            WHERE id = ?
+        """, (campaign_id,))
+        campaign = c.fetchone()
+        if not campaign:
+            conn.close()
+            logger.warning(f"Broadcast campaign {campaign_id} not found, skipping")
+            return
+        
+        title, body, url, audience, status, cursor = campaign
+        if status in ('done', 'failed'):
+            conn.close()
+            return
+        
+        audience_query = self._broadcast_audience_query(audience)
+        
+        if status == 'queued':
+            c.execute(f"SELECT COUNT(*) {audience_query}", (0,))
+            c.execute("""
+                UPDATE broadcast_campaigns
+                SET status = 'running', total = ?, started_at = ?
+                WHERE id = ?
+            """, (c.fetchone()[0], datetime.now(), campaign_id))
+            conn.commit()
+        
+        data = json.dumps({
+            'title': title,
+            'body': body,
+            'icon': '/static/favicon.ico',
+            'badge': '/static/badge.png',
+            'vibrate': [200, 100, 200],
+            'tag': f"broadcast-{campaign_id}",
+            'data': {'url': url or '/'}
+        })
+        
+        try:
+            vapid = Vapid.from_string(private_key=self.vapid_private_key)
+            
+            with ThreadPoolExecutor(max_workers=self.broadcast_concurrency) as pool, requests.Session() as session:
+                adapter = HTTPAdapter(pool_connections=self.broadcast_concurrency,
+                                      pool_maxsize=self.broadcast_concurrency)
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
                 
-                if success:
-                    # Mark as sent
-                    c.execute("""
-                        UPDATE scheduled_notifications
-                        SET sent = 1, sent_at = ?
-                        WHERE id = ?
-                    """, (now, notif_id))
-                    logger.info(f"📨 Sent {notif_type} notification for event {event_id} to user {user_id}")
-                else:
-                    # Mark error
+                while True:
+                    c.execute(f"""
+                        SELECT ps.id, ps.endpoint, ps.p256dh, ps.auth
+                        {audience_query}
+                        ORDER BY ps.id
+                        LIMIT ?
+                    """, (cursor, BROADCAST_BATCH_SIZE))
+                    batch = c.fetchall()
+                    if not batch:
+                        break
+                    
+                    results = list(pool.map(
+                        lambda sub: self._send_broadcast_push(sub, data, vapid, session), batch))
+                    
+                    now = datetime.now()
+                    failures = [r for r in results if r[3] is not None]
+                    gone = [r[0] for r in failures if r[2] in GONE_STATUS_CODES]
+                    cursor = batch[-1][0]
+                    
+                    self._record_delivery(
+                        c,
+                        [r[0] for r in results if r[3] is None],
+                        [r[0] for r in failures if r[2] not in GONE_STATUS_CODES],
+                        now
+                    )
+                    
+                    if failures:
+                        c.executemany("""
+                            INSERT INTO broadcast_failures (campaign_id, subscription_id, endpoint, status_code, error, created_at)
+                            VALUES (?, ?, ?, ?, ?, ?)
+                        """, [(campaign_id, sub_id, endpoint, code, error, now)
+                              for sub_id, endpoint, code, error in failures])
+                    if gone:
+                        self._prune_subscriptions(c, gone)
+                    
                     c.execute("""
-                        UPDATE scheduled_notifications
-                        SET error_message = ?
+                        UPDATE broadcast_campaigns
+                        SET sent = sent + ?, failed = failed + ?, pruned = pruned + ?,
+                            last_subscription_id = ?
                         WHERE id = ?
-                    """, ("No active push subscriptions", notif_id))
-                    logger.warning(f"⚠️ Could not send notification {notif_id}: no subscriptions")
-                
-            except Exception as e:
-                logger.error(f"❌ Error sending notification {notif_id}: {e}")
-                c.execute("""
-                    UPDATE scheduled_notifications
-                    SET error_message = ?
-                    WHERE id = ?
-                """, (str(e), notif_id))
+                    """, (len(results) - len(failures), len(failures), len(gone), cursor, campaign_id))
+                    conn.commit()
+        except Exception as e:
+            # With a job queue the job is retried and resumes from the cursor
+            c.execute("""
+                UPDATE broadcast_campaigns
+                SET status = CASE WHEN ? THEN status ELSE 'failed' END, error_message = ?
+                WHERE id = ?
+            """, (self.job_queue is not None, str(e), campaign_id))
+            conn.commit()
+            conn.close()
+            logger.error(f"❌ Broadcast {campaign_id} interrupted: {e}")
+            raise
         
+        c.execute("""
+            UPDATE broadcast_campaigns
+            SET status = 'done', finished_at = ?, error_message = NULL
+            WHERE id = ?
+        """, (datetime.now(), campaign_id))
+        c.execute("SELECT sent, failed, pruned FROM broadcast_campaigns WHERE id = ?", (campaign_id,))
+        sent, failed, pruned = c.fetchone()
         conn.commit()
         conn.close()
         
-        if pending:
-            logger.info(f"📬 Processed {len(pending)} pending notification(s)")
+        logger.info(f"📣 Broadcast {campaign_id} done: {sent} sent, {failed} failed, {pruned} pruned")
     
-    def cleanup_old_notifications(self):
+    def send_broadcast_job(self, payload):
+        """Job handler for 'broadcast'."""
+        self.run_broadcast(payload['campaign_id'])
+    
+    @staticmethod
+    def build_digest_message(offset_minutes, events, now=None):
+        """
+        Build title and body for a reminder push covering one or more events.
+        
+        The lead time of each event is computed from its start and `now`, not
+        from the reminder offset: rows joining a digest early are sent before
+        their own offset, and a digest can mix start times.
+        
+        Args:
+            offset_minutes: Reminder lead time in minutes (used when an event has no date)
+            events: List of dicts with 'title', 'day', 'start_time' and 'event_date'
+            now: Sending time (default: now)
+        """
+        now = now or datetime.now()
+        
+        if len(events) == 1:
+            event = events[0]
+            title = f"Promemoria Evento: {event['title']}"
+            body = (f"Il tuo evento '{event['title']}' inizia {describe_lead_time(event, offset_minutes, now)} "
+                    f"({event['day']} alle {event['start_time']})")
+            return title, body
+        
+        title = f"Promemoria: {len(events)} eventi in arrivo"
+        lines = [f"• {e['title']} ({e['day']} alle {e['start_time']}) - inizia {describe_lead_time(e, offset_minutes, now)}"
+                 for e in events]
+        body = "\n".join(lines)
+        return title, body
+    
+    def _collect_due_digests(self, c, now):
+        """
+        Group pending notifications into digests using an existing cursor.
+        
+        Notifications of the same type for the same user that fall within
+        the digest window are merged into a single digest. A digest is
+        returned as soon as at least one of its notifications is due.
+        Rows already handed to the job queue or to the email fallback are skipped.
+        """
+        horizon = now + self.digest_window
+        
+        # Find notifications due now, plus the ones that can join their digest
+        due = run(c, 'notifications_due', (now, horizon)).fetchall()
+        
+        # Group by (user, notification type)
+        digests = {}
+        for notif_id, user_id, event_id, notif_type, offset, is_due, event_title, event_day, event_time, event_date in due:
+            digest = digests.setdefault((user_id, notif_type), {
+                'user_id': user_id,
+                'notif_type': notif_type,
+                'offset': offset,
+                'due': False,
+                'ids': [],
+                'events': []
+            })
+            digest['due'] = digest['due'] or bool(is_due)
+            digest['ids'].append(notif_id)
+            digest['events'].append({
+                'id': event_id,
+                'title': event_title,
+                'day': event_day,
+                'start_time': event_time,
+                'event_date': event_date
+            })
+        
+        # Nothing due yet for a user: wait for the next tick
+        return [digest for digest in digests.values() if digest['due']]
+    
+    def _deliver_digest(self, c, digest, now):
         """
-        Clean up old sent notifications (older than 7 days).
-        Called daily by APScheduler.
+        Send one push for a digest and mark its rows using an existing cursor.
+        Exceptions are propagated to the caller.
         """
+        user_id = digest['user_id']
+        notif_type = digest['notif_type']
+        notif_ids = digest['ids']
+        events = digest['events']
+        
+        offset = digest['offset'] or offset_for_notification_type(notif_type)
+        title, body = self.build_digest_message(offset, events, now)
+        
+        # Send one push for the whole digest
+        success = self.send_push_notification(
+            user_id=user_id,
+            title=title,
+            body=body,
+            url='/calendar',
+            tag=f"event-{notif_type}-{events[0]['id']}",
+            data={'events': [e['id'] for e in events]},
+            cursor=c
+        )
+        
+        if success:
+            # Mark as sent
+            c.executemany("""
+                UPDATE scheduled_notifications
+                SET sent = 1, sent_at = ?
+                WHERE id = ?
+            """, [(now, notif_id) for notif_id in notif_ids])
+            logger.info(f"📨 Sent {notif_type} digest with {len(events)} event(s) to user {user_id}")
+        elif self.email_fallback:
+            # Hand over to the email fallback job
+            c.executemany("""
+                UPDATE scheduled_notifications
+                SET error_message = ?, email_status = 'pending'
+                WHERE id = ?
+            """, [("No active push subscriptions", notif_id) for notif_id in notif_ids])
+            logger.info(f"📧 {notif_type} digest for user {user_id} queued for email: no subscriptions")
+        else:
+            # Mark error
+            c.executemany("""
+                UPDATE scheduled_notifications
+                SET error_message = ?
+                WHERE id = ?
+            """, [("No active push subscriptions", notif_id) for notif_id in notif_ids])
+            logger.warning(f"⚠️ Could not send {notif_type} digest to user {user_id}: no subscriptions")
+    
+    def _mark_digest_error(self, c, digest, error):
+        logger.error(f"❌ Error sending {digest['notif_type']} digest to user {digest['user_id']}: {error}")
+        c.executemany("""
+            UPDATE scheduled_notifications
+            SET error_message = ?
+            WHERE id = ?
+        """, [(str(error), notif_id) for notif_id in digest['ids']])
+    
+    @staticmethod
+    def build_email_message(events):
+        """
+        Build subject and body of a fallback email covering all pending
+        reminders of one user.
+        
+        Args:
+            events: List of dicts with 'title', 'day', 'start_time' and 'offset'
+        """
+        if len(events) == 1:
+            event = events[0]
+            subject = f"Promemoria Evento: {event['title']}"
+        else:
+            subject = f"Promemoria: {len(events)} eventi in arrivo"
+        
+        lines = [f"• {e['title']} ({e['day']} alle {e['start_time']}) - inizia {describe_offset(e['offset'])}"
+                 for e in events]
+        body = "Ciao!\n\nTi ricordiamo i tuoi prossimi eventi:\n\n" + "\n".join(lines) + \
+               "\n\nAttiva le notifiche push dal tuo profilo per riceverle sul dispositivo."
+        return subject, body
+    
+    def send_email_fallbacks(self):
+        """
+        Email the reminders that could not be pushed (email_status = 'pending').
+        Called periodically by APScheduler.
+        
+        Users are processed `batch_size` at a time; each user gets one email
+        with all their pending reminders, and every batch goes through the
+        same SMTP connection. Rows for events that already started are
+        expired, users without an address are marked 'no_address', and rows
+        whose message was not attempted because the connection dropped stay
+        pending for the next run.
+        """
+        if not self.email_fallback:
+            return
+        
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        c = conn.cursor()
+        
+        totals = {'sent': 0, 'failed': 0, 'no_address': 0, 'expired': 0}
+        
+        try:
+            while True:
+                now = datetime.now()
+                user_ids = [row[0] for row in run(c, 'notifications_email_users', (self.email_fallback.batch_size,)).fetchall()]
+                if not user_ids:
+                    break
+                
+                placeholders = ','.join('?' for _ in user_ids)
+                c.execute(f"""
+                    SELECT sn.id, sn.user_id, sn.notification_type, sn.offset_minutes,
+                           e.title, e.day, e.start_time, e.event_date, u.email
+                    FROM scheduled_notifications sn
+                    JOIN events e ON sn.event_id = e.id
+                    LEFT JOIN users u ON u.intra_id = sn.user_id
+                    WHERE sn.email_status = 'pending' AND sn.user_id IN ({placeholders})
+                    ORDER BY sn.user_id, e.event_date, e.start_time
+                """, user_ids)
+                
+                # Group per user, dropping reminders for events already started
+                pending = {}
+                status_updates = []
+                for notif_id, user_id, notif_type, offset, title, day, start_time, event_date, email in c.fetchall():
+                    try:
+                        started = datetime.strptime(f"{event_date} {start_time}", '%Y-%m-%d %H:%M') <= now
+                    except (TypeError, ValueError):
+                        started = False
+                    if started:
+                        status_updates.append(('expired', None, notif_id))
+                        totals['expired'] += 1
+                        continue
+                    if not email:
+                        status_updates.append(('no_address', None, notif_id))
+                        totals['no_address'] += 1
+                        continue
+                    
+                    entry = pending.setdefault(user_id, {'email': email, 'ids': [], 'events': []})
+                    entry['ids'].append(notif_id)
+                    entry['events'].append({
+                        'title': title,
+                        'day': day,
+                        'start_time': start_time,
+                        'offset': offset or offset_for_notification_type(notif_type)
+                    })
+                
+                batch = list(pending.items())
+                messages = [
+                    self.email_fallback.build_message(entry['email'], *self.build_email_message(entry['events']))
+                    for _, entry in batch
+                ]
+                results = self.email_fallback.send_batch(messages)
+                
+                for (user_id, entry), error in zip(batch, results):
+                    if error is None:
+                        status_updates.extend(('sent', None, notif_id) for notif_id in entry['ids'])
+                        totals['sent'] += 1
+                    else:
+                        status_updates.extend(('failed', error, notif_id) for notif_id in entry['ids'])
+                        totals['failed'] += 1
+                
+                # Not attempted (connection dropped): keep pending, stop this run
+                not_attempted = batch[len(results):]
+                
+                c.executemany("""
+                    UPDATE scheduled_notifications
+                    SET email_status = ?1,
+                        sent = CASE WHEN ?1 = 'sent' THEN 1 ELSE sent END,
+                        sent_at = CASE WHEN ?1 = 'sent' THEN ?2 ELSE sent_at END,
+                        error_message = COALESCE(?3, error_message)
+                    WHERE id = ?4
+                """, [(status, now, error, notif_id) for status, error, notif_id in status_updates])
+                conn.commit()
+                
+                if not_attempted:
+                    break
+        finally:
+            conn.close()
+        
+        if any(totals.values()):
+            logger.info(f"📧 Email fallback: {totals['sent']} sent, {totals['failed']} failed, "
+                        f"{totals['no_address']} without address, {totals['expired']} expired")
+        return totals
+    
+    def check_and_send_pending_notifications(self):
+        """
+        Check for pending notifications that should be sent now.
+        Called periodically by APScheduler.
+        
+        With a job queue the digests are only enqueued; the worker sends them.
+        """
+        if self.job_queue:
+            return self.enqueue_pending_notifications()
+        
         conn = sqlite3.connect(self.db_path)
         c = conn.cursor()
         
-        cutoff_date = datetime.now() - timedelta(days=7)
+        now = datetime.now()
+        digests = self._collect_due_digests(c, now)
         
-        c.execute("""
-            DELETE FROM scheduled_notifications
-            WHERE sent = 1 AND sent_at < ?
-        """, (cutoff_date,))
+        processed = 0
+        for digest in digests:
+            processed += len(digest['ids'])
+            try:
+                self._deliver_digest(c, digest, now)
+            except Exception as e:
+                self._mark_digest_error(c, digest, e)
         
-        deleted = c.rowcount
         conn.commit()
         conn.close()
         
-        if deleted > 0:
-            logger.info(f"🧹 Cleaned up {deleted} old notification(s)")
+        if processed:
+            logger.info(f"📬 Processed {processed} pending notification(s)")
+    
+    def enqueue_pending_notifications(self):
+        """
+        Enqueue one 'send_digest' job per due digest.
+        
+        Runs inside BEGIN IMMEDIATE and stamps the rows with the job ID, so
+        concurrent producers never enqueue the same notification twice.
+        """
+        conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+        c = conn.cursor()
+        
+        try:
+            c.execute("BEGIN IMMEDIATE")
+            digests = self._collect_due_digests(c, datetime.now())
+            
+            for digest in digests:
+                job_id = self.job_queue.enqueue('send_digest', {
+                    'user_id': digest['user_id'],
+                    'notif_type': digest['notif_type'],
+                    'offset': digest['offset'],
+                    'ids': digest['ids']
+                }, cursor=c)
+                c.executemany("UPDATE scheduled_notifications SET job_id = ? WHERE id = ?",
+                              [(job_id, notif_id) for notif_id in digest['ids']])
+            
+            c.execute("COMMIT")
+        except Exception:
+            if conn.in_transaction:
+                c.execute("ROLLBACK")
+            raise
+        finally:
+            conn.close()
+        
+        if digests:
+            logger.info(f"📥 Enqueued {len(digests)} notification digest(s)")
+        return len(digests)
+    
+    def send_digest_job(self, payload):
+        """
+        Job handler for 'send_digest'.
+        
+        Rows are re-read so notifications cancelled after enqueueing (user
+        unregistered, event deleted) are skipped. Errors are recorded on the
+        rows and re-raised so the job queue retries the job.
+        """
+        notif_ids = payload.get('ids') or []
+        if not notif_ids:
+            return
+        
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        c = conn.cursor()
+        
+        placeholders = ','.join('?' for _ in notif_ids)
+        c.execute(f"""
+            SELECT sn.id, e.id, e.title, e.day, e.start_time, e.event_date
+            FROM scheduled_notifications sn
+            JOIN events e ON sn.event_id = e.id
+            WHERE sn.id IN ({placeholders}) AND sn.sent = 0
+            ORDER BY e.event_date, e.start_time
+        """, notif_ids)
+        rows = c.fetchall()
+        
+        if not rows:
+            conn.close()
+            logger.info(f"Digest for user {payload.get('user_id')} has nothing left to send, skipping")
+            return
+        
+        digest = {
+            'user_id': payload['user_id'],
+            'notif_type': payload['notif_type'],
+            'offset': payload.get('offset'),
+            'ids': [row[0] for row in rows],
+            'events': [
+                {'id': row[1], 'title': row[2], 'day': row[3], 'start_time': row[4], 'event_date': row[5]}
+                for row in rows
+            ]
+        }
+        
+        try:
+            self._deliver_digest(c, digest, datetime.now())
+        except Exception as e:
+            self._mark_digest_error(c, digest, e)
+            raise
+        finally:
+            conn.commit()
+            conn.close()
+    
+    def cleanup_old_notifications(self):
+        """
+        Run the retention policies (old sent notifications, orphaned rows,
+        finished jobs, ...). Called every 15 minutes by APScheduler; each run
+        is bounded, so a large backlog is worked off over several runs.
+        """
+        return self.retention.run()
     
     def shutdown(self):
         """Shutdown the scheduler gracefully."""
         if self.scheduler.running:
             self.scheduler.shutdown()
             logger.info("NotificationManager scheduler stopped")
+        if self.leader_election:
+            self.leader_election.release()
+        if self.email_fallback:
+            self.email_fallback.close()
+
+
+class NotificationWorker:
+    """
+    Out-of-process consumer of the job queue.
+    Claims jobs with a lease, runs the matching handler and acks them.
+    """
+    
+    def __init__(self, manager, job_queue, worker_id=None, poll_interval=2, batch_size=20):
+        """
+        Initialize the worker.
+        
+        Args:
+            manager: NotificationManager used by the job handlers
+            job_queue: JobQueue to consume
+            worker_id: Identifier stored on claimed jobs (default: hostname:pid)
+            poll_interval: Seconds to sleep when the queue is empty
+            batch_size: Maximum number of jobs claimed at once
+        """
+        self.manager = manager
+        self.job_queue = job_queue
+        self.worker_id = worker_id or f"{socket.gethostname()}:{os.getpid()}"
+        self.poll_interval = poll_interval
+        self.batch_size = batch_size
+        self.running = False
+        self.handlers = {
+            'send_digest': manager.send_digest_job,
+            'broadcast': manager.send_broadcast_job,
+            'push': manager.send_push_job
+        }
+    
+    def register(self, kind, handler):
+        """Register a handler for a job kind."""
+        self.handlers[kind] = handler
+    
+    def run_once(self):
+        """Claim and process one batch of jobs. Returns the number of jobs processed."""
+        jobs = self.job_queue.claim(self.worker_id, limit=self.batch_size)
+        if not jobs:
+            return 0
+        
+        # Keep the lease alive on every job of the batch until it is processed:
+        # while a long job (broadcast) runs, the ones behind it must not expire
+        # and be claimed by another worker
+        held = {job['id'] for job in jobs}
+        lock = threading.Lock()
+        done = threading.Event()
+        renewer = threading.Thread(target=self._renew_leases, args=(held, lock, done), daemon=True)
+        renewer.start()
+        try:
+            for job in jobs:
+                try:
+                    self._process(job)
+                finally:
+                    with lock:
+                        held.discard(job['id'])
+        finally:
+            done.set()
+            renewer.join()
+        
+        return len(jobs)
+    
+    def _process(self, job):
+        # The lease may have run out before this job's turn: another worker owns it now
+        if not self.job_queue.extend(job['id'], self.worker_id):
+            logger.warning(f"⚠️ Lost the lease on job {job['id']}, skipping it")
+            return
+        
+        handler = self.handlers.get(job['kind'])
+        if not handler:
+            self.job_queue.fail(job['id'], self.worker_id, f"No handler for job kind '{job['kind']}'")
+            return
+        
+        try:
+            handler(job['payload'])
+            if not self.job_queue.ack(job['id'], self.worker_id):
+                logger.warning(f"⚠️ Lost the lease on job {job['id']} while running it")
+        except Exception as e:
+            self.job_queue.fail(job['id'], self.worker_id, e)
+    
+    def _renew_leases(self, held, lock, done):
+        interval = max(1, self.job_queue.lease.total_seconds() / 3)
+        while not done.wait(interval):
+            with lock:
+                job_ids = list(held)
+            for job_id in job_ids:
+                try:
+                    if not self.job_queue.extend(job_id, self.worker_id):
+                        # Reported by _process when the job's turn comes
+                        with lock:
+                            held.discard(job_id)
+                except Exception as e:
+                    logger.error(f"❌ Could not renew the lease on job {job_id}: {e}")
+    
+    def stop(self, *args):
+        """Stop the loop after the current batch."""
+        self.running = False
+    
+    def run_forever(self):
+        """Process jobs until SIGINT/SIGTERM."""
+        self.running = True
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        logger.info(f"👷 Notification worker {self.worker_id} started")
+        
+        while self.running:
+            try:
+                processed = self.run_once()
+            except Exception as e:
+                logger.error(f"❌ Worker loop error: {e}")
+                processed = 0
+            
+            if not processed:
+                time.sleep(self.poll_interval)
+        
+        logger.info(f"Notification worker {self.worker_id} stopped")
+
+
+def main(argv=None):
+    """Entry point for `python -m notifications worker`."""
+    parser = argparse.ArgumentParser(prog='python -m notifications')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    worker_parser = subparsers.add_parser('worker', help='Deliver queued notifications')
+    worker_parser.add_argument('--poll-interval', type=float,
+                               default=float(os.getenv('NOTIFICATION_WORKER_POLL_SECONDS', '2')))
+    worker_parser.add_argument('--batch-size', type=int,
+                               default=int(os.getenv('NOTIFICATION_WORKER_BATCH_SIZE', '20')))
+    args = parser.parse_args(argv)
+    
+    from dotenv import load_dotenv
+    load_dotenv(os.getenv('ENV_FILE', '.env'))
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    logging.getLogger('apscheduler').setLevel(logging.WARNING)
+    
+    db_path = os.path.join(os.getenv('DB_DIR', './calendar_data'), 'calendar.db')
+    vapid_private_key = os.getenv('VAPID_PRIVATE_KEY')
+    vapid_public_key = os.getenv('VAPID_PUBLIC_KEY')
+    vapid_email = os.getenv('VAPID_EMAIL')
+    
+    if not (vapid_private_key and vapid_public_key and vapid_email):
+        logger.error("❌ VAPID keys not configured - nothing to deliver")
+        return 1
+    
+    job_queue = JobQueue(db_path, lease_seconds=int(os.getenv('JOB_LEASE_SECONDS', '60')))
+    manager = NotificationManager(
+        db_path=db_path,
+        vapid_private_key=vapid_private_key,
+        vapid_public_key=vapid_public_key,
+        vapid_claims={'sub': f'mailto:{vapid_email}'},
+        digest_window_minutes=int(os.getenv('NOTIFICATION_DIGEST_WINDOW_MINUTES', '5')),
+        job_queue=job_queue,
+        leader_election=LeaderElection(db_path, lease_seconds=int(os.getenv('LEADER_LEASE_SECONDS', '15'))),
+        broadcast_concurrency=int(os.getenv('BROADCAST_CONCURRENCY', '32')),
+        email_fallback=email_fallback_from_env(),
+        retention=retention_from_env(db_path)
+    )
+    worker = NotificationWorker(manager, job_queue,
+                                poll_interval=args.poll_interval,
+                                batch_size=args.batch_size)
+    try:
+        worker.run_forever()
+    finally:
+        manager.shutdown()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,289 @@
+"""
+Query catalog.
+Every shared or hot-path SQL statement is defined here once, by name, and
+executed with `run`: the same SQL string is sent every time, so repeated
+executions on a connection are served by its prepared statement cache.
+
+Hot queries run on every request or scheduler tick. `check_plans` runs
+EXPLAIN QUERY PLAN on them and reports the ones that scan a whole table;
+`python queries.py [db]` exits with an error, and the Docker build runs it
+on a fresh schema, so a query edit that loses its index fails the build.
+"""
+
+import os
+import sys
+import sqlite3
+import argparse
+from models import Event, Registration, LogEntry, select_sql
+
+CATALOG = {}
+
+
+class Query:
+    """A named SQL statement; rows are built with `model.from_row` if a model is given."""
+
+    __slots__ = ('name', 'sql', 'hot', 'model')
+
+    def __init__(self, name, sql, hot, model):
+        self.name = name
+        self.sql = sql
+        self.hot = hot
+        self.model = model
+
+    @property
+    def param_count(self):
+        return self.sql.count('?')
+
+
+def define(name, sql, hot=True, model=None):
+    """Add a query to the catalog (whitespace normalized, so the string is stable)"""
+    if name in CATALOG:
+        raise ValueError(f"Query {name!r} defined twice")
+    CATALOG[name] = Query(name, ' '.join(sql.split()), hot, model)
+
+
+def run(c, name, params=()):
+    """Execute a catalog query on cursor `c` and return the cursor to read from"""
+    query = CATALOG[name]
+    if query.model is not None:
+        # Own cursor on the same connection: same transaction, own row factory
+        c = c.connection.cursor()
+        c.row_factory = query.model.from_row
+    return c.execute(query.sql, params)
+
+
+def run_many(c, name, seq_of_params):
+    return c.executemany(CATALOG[name].sql, seq_of_params)
+
+
+# Settings
+
+define('setting_get', "SELECT value FROM settings WHERE key = ?")
+define('setting_set', "UPDATE settings SET value = ? WHERE key = ?")
+define('setting_put', "INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)", hot=False)
+
+# Users and whitelist
+
+define('user_id_by_intra', "SELECT id FROM users WHERE intra_id = ?")
+define('whitelist_contains', "SELECT COUNT(*) FROM baywatcher_whitelist WHERE intra_login = ?")
+
+# Events
+
+define('event_by_id', select_sql(Event, 'id = ?'), model=Event)
+define('event_ids_by_week', "SELECT id FROM events WHERE week = ?")
+define('event_ids_by_week_day', "SELECT id FROM events WHERE week = ? AND day = ?", hot=False)
+define('event_registered_increment', "UPDATE events SET registered = registered + 1 WHERE id = ?")
+define('event_registered_decrement', "UPDATE events SET registered = registered - 1 WHERE id = ? AND registered > 0")
+define('event_registered_add', "UPDATE events SET registered = registered + ? WHERE id = ?")
+define('events_by_week', select_sql(Event, 'week = ?'), hot=False, model=Event)
+
+# Registrations
+
+define('registrations_by_event', select_sql(Registration, 'event_id = ?', 'registration_date, id'), model=Registration)
+define('registration_exists', "SELECT COUNT(*) FROM registrations WHERE event_id = ? AND participant_name = ?")
+define('registration_id', "SELECT id FROM registrations WHERE event_id = ? AND participant_name = ? LIMIT 1")
+define('registration_insert', "INSERT INTO registrations (event_id, participant_name, attended) VALUES (?, ?, ?)")
+define('registration_set_attended', """
+    UPDATE registrations SET attended = ?
+    WHERE event_id = ? AND participant_name = ?
+""")
+# One row only, even if the name is registered twice
+define('registration_delete_one', """
+    DELETE FROM registrations WHERE rowid = (
+        SELECT rowid FROM registrations
+        WHERE event_id = ? AND participant_name = ?
+        LIMIT 1
+    )
+""")
+define('registrations_delete_by_event', "DELETE FROM registrations WHERE event_id = ?")
+define('registrations_by_week', """
+    SELECT r.event_id, r.participant_name FROM registrations r
+    JOIN events e ON r.event_id = e.id
+    WHERE e.week = ?
+""", hot=False)
+define('registrations_count_user_week', """
+    SELECT COUNT(*) FROM registrations r
+    JOIN events e ON r.event_id = e.id
+    WHERE r.participant_name = ? AND e.week = ?
+""")
+
+# Allocation windows and preferences (lottery weeks)
+
+define('allocation_window', "SELECT closes_at, status FROM week_allocations WHERE week = ?")
+define('allocation_open', """
+    INSERT OR REPLACE INTO week_allocations (week, closes_at, status, created_by, created_at)
+    VALUES (?, ?, 'open', ?, ?)
+""", hot=False)
+# Closing claims the window: only one process gets rowcount 1
+define('allocation_close', """
+    UPDATE week_allocations SET status = 'allocated', allocated_at = ?, seed = ?
+    WHERE week = ? AND status = 'open'
+""")
+define('allocation_delete', "DELETE FROM week_allocations WHERE week = ?", hot=False)
+define('allocations_due', "SELECT week FROM week_allocations WHERE status = 'open' AND closes_at <= ?")
+define('preference_insert', """
+    INSERT OR IGNORE INTO registration_preferences (week, event_id, participant_name, created_at)
+    VALUES (?, ?, ?, ?)
+""")
+define('preference_delete', "DELETE FROM registration_preferences WHERE event_id = ? AND participant_name = ?")
+# Only whitelisted users take part in the draw
+define('preferences_by_week', """
+    SELECT p.event_id, p.participant_name FROM registration_preferences p
+    JOIN baywatcher_whitelist w ON w.intra_login = p.participant_name
+    WHERE p.week = ? ORDER BY p.id
+""", hot=False)
+define('preferences_user_week', "SELECT event_id FROM registration_preferences WHERE week = ? AND participant_name = ?")
+define('preferences_demand_week', "SELECT event_id, COUNT(*) FROM registration_preferences WHERE week = ? GROUP BY event_id")
+define('preferences_delete_week', "DELETE FROM registration_preferences WHERE week = ?")
+
+# Waitlists (FIFO per event: the head is the lowest id)
+
+define('waitlist_join', """
+    INSERT OR IGNORE INTO waitlist (event_id, participant_name, created_at) VALUES (?, ?, ?)
+""")
+define('waitlist_leave', "DELETE FROM waitlist WHERE event_id = ? AND participant_name = ?")
+define('waitlist_head', "SELECT id, participant_name FROM waitlist WHERE event_id = ? ORDER BY id LIMIT 1")
+define('waitlist_pop', "DELETE FROM waitlist WHERE id = ?")
+define('waitlist_size', "SELECT COUNT(*) FROM waitlist WHERE event_id = ?")
+define('waitlist_position', """
+    SELECT COUNT(*) FROM waitlist
+    WHERE event_id = ? AND id <= (SELECT id FROM waitlist WHERE event_id = ? AND participant_name = ?)
+""")
+define('waitlist_user_week', """
+    SELECT w.event_id, (SELECT COUNT(*) FROM waitlist x WHERE x.event_id = w.event_id AND x.id <= w.id)
+    FROM waitlist w
+    JOIN events e ON w.event_id = e.id
+    WHERE w.participant_name = ? AND e.week = ?
+""")
+
+# Action logs and change feed
+
+define('log_by_id', select_sql(LogEntry, 'id = ?'), model=LogEntry)
+define('log_insert', """
+    INSERT INTO action_logs
+    (timestamp, user_id, username, action_type, action_description,
+     ip_address, user_agent, resource_id, resource_type, old_value, new_value)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+""")
+define('change_insert', "INSERT INTO changes (entity, entity_id, op, data, created_at) VALUES (?, ?, ?, ?, ?)")
+define('changes_head', "SELECT COALESCE(MAX(seq), 0) FROM changes")
+define('changes_after', "SELECT seq, entity, entity_id FROM changes WHERE seq > ? ORDER BY seq")
+define('changes_page', """
+    SELECT seq, entity, entity_id, op, data, created_at FROM changes
+    WHERE seq > ?
+    ORDER BY seq
+    LIMIT ?
+""")
+# The whitelist holds student logins: page for non-admins
+define('changes_page_public', """
+    SELECT seq, entity, entity_id, op, data, created_at FROM changes
+    WHERE seq > ? AND entity != 'whitelist'
+    ORDER BY seq
+    LIMIT ?
+""")
+
+# Notifications
+
+define('notification_preferences', """
+    SELECT notifications_enabled, notify_24h_before, notify_1h_before
+    FROM user_notification_preferences
+    WHERE user_id = ?
+""")
+define('notification_offsets', """
+    SELECT offset_minutes
+    FROM user_notification_offsets
+    WHERE user_id = ?
+    ORDER BY offset_minutes DESC
+""")
+define('notifications_insert', """
+    INSERT INTO scheduled_notifications
+    (user_id, event_id, registration_id, notification_type, offset_minutes, scheduled_time)
+    VALUES (?, ?, ?, ?, ?, ?)
+""")
+define('notifications_cancel_registration', """
+    DELETE FROM scheduled_notifications
+    WHERE registration_id = ? AND sent = 0
+""")
+define('notifications_delete_by_event', "DELETE FROM scheduled_notifications WHERE event_id = ?")
+# Notifications due now, plus the ones that can join their digest
+define('notifications_due', """
+    SELECT sn.id, sn.user_id, sn.event_id, sn.notification_type, sn.offset_minutes,
+           sn.scheduled_time <= ? AS is_due,
+           e.title, e.day, e.start_time, e.event_date
+    FROM scheduled_notifications sn
+    JOIN events e ON sn.event_id = e.id
+    WHERE sn.sent = 0 AND sn.scheduled_time <= ? AND sn.job_id IS NULL AND sn.email_status IS NULL
+    ORDER BY sn.user_id, sn.notification_type, e.event_date, e.start_time
+""")
+define('notifications_email_users', """
+    SELECT DISTINCT user_id FROM scheduled_notifications
+    WHERE email_status = 'pending'
+    LIMIT ?
+""")
+define('push_subscriptions_by_user', """
+    SELECT id, endpoint, p256dh, auth
+    FROM push_subscriptions
+    WHERE user_id = ?
+""")
+
+# Idempotency keys
+
+define('idempotency_delete_expired', "DELETE FROM idempotency_keys WHERE key = ? AND expires_at <= ?")
+define('idempotency_claim', """
+    INSERT OR IGNORE INTO idempotency_keys (key, created_at, expires_at)
+    VALUES (?, ?, ?)
+""")
+define('idempotency_get', "SELECT outcome FROM idempotency_keys WHERE key = ?")
+define('idempotency_complete', "UPDATE idempotency_keys SET outcome = ?, expires_at = ? WHERE key = ?")
+define('idempotency_release', "DELETE FROM idempotency_keys WHERE key = ? AND outcome IS NULL")
+
+
+# Plan verification
+
+def explain(conn, name):
+    """EXPLAIN QUERY PLAN of a catalog query (NULL parameters), as a list of detail strings"""
+    query = CATALOG[name]
+    rows = conn.execute(f"EXPLAIN QUERY PLAN {query.sql}", (None,) * query.param_count).fetchall()
+    return [row[-1] for row in rows]
+
+
+def check_plans(conn, names=None):
+    """
+    Return (name, detail) for every hot query whose plan scans a table.
+    `SCAN t USING COVERING INDEX` still reads the whole index and is reported too.
+    """
+    problems = []
+    for name in names or CATALOG:
+        if not CATALOG[name].hot:
+            continue
+        for detail in explain(conn, name):
+            if detail.startswith('SCAN '):
+                problems.append((name, detail))
+    return problems
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Check that the hot queries of the catalog use an index")
+    parser.add_argument('db', nargs='?', default=os.path.join(os.getenv('DB_DIR', './calendar_data'), 'calendar.db'),
+                        help="SQLite database (schema created by the app)")
+    parser.add_argument('-v', '--verbose', action='store_true', help="print the plan of every query")
+    args = parser.parse_args(argv)
+
+    conn = sqlite3.connect(args.db)
+    try:
+        if args.verbose:
+            for name in CATALOG:
+                print(f"{name}: {' | '.join(explain(conn, name)) or '-'}")
+        problems = check_plans(conn)
+    finally:
+        conn.close()
+
+    for name, detail in problems:
+        print(f"❌ {name}: {detail}")
+    if not problems:
+        print(f"✅ {sum(1 for q in CATALOG.values() if q.hot)} hot queries use an index")
+    return 1 if problems else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
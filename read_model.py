@@ -0,0 +1,339 @@
+"""
+In-memory read model of the pool.
+Events, registrations, whitelist, settings, users and allocation windows are loaded once and
+kept in sync by re-reading only the entities named in the change feed.
+Read routes are served from it; a periodic check compares it with the database.
+"""
+
+import sqlite3
+import threading
+import logging
+from datetime import datetime
+from models import Event, Registration, User, fetch_all
+from queries import run
+
+logger = logging.getLogger(__name__)
+
+# Same order as the ORDER BY CASE of the SQL queries (other days first, like NULL)
+DAY_ORDER = {'Lunedì': 1, 'Martedì': 2, 'Mercoledì': 3, 'Giovedì': 4, 'Venerdì': 5}
+
+
+def day_rank(day):
+    """Position of a weekday in the calendar ordering"""
+    return DAY_ORDER.get(day, 0)
+
+
+class PoolState:
+    """
+    One version of the model. Never modified after construction: readers
+    keep a reference for the whole request, a refresh builds a new one.
+
+    Base data:
+        settings: key -> value (strings, as stored)
+        events: id -> Event
+        registrations: event id -> [Registration] in registration order
+        whitelist: [{'id', 'login', 'added_at'}] ordered by login
+        users: login -> User
+        allocations: week -> {'closes_at', 'status'} of the lottery weeks
+
+    Indexes derived from it: events by week and day (ordered by start time),
+    registrations by participant, whitelisted logins as a set.
+    """
+
+    BASE = ('settings', 'events', 'registrations', 'whitelist', 'users', 'allocations')
+
+    def __init__(self, settings, events, registrations, whitelist, users, allocations):
+        self.settings = settings
+        self.events = events
+        self.registrations = registrations
+        self.whitelist = whitelist
+        self.users = users
+        self.allocations = allocations
+
+        self.whitelist_logins = frozenset(w['login'] for w in whitelist)
+
+        self.by_week = {}
+        for event in sorted(events.values(), key=lambda e: (e.start_time, e.id)):
+            self.by_week.setdefault(event.week, {}).setdefault(event.day, []).append(event)
+
+        # Registrations of deleted events are not visible (the SQL queries JOIN on events)
+        self.by_participant = {}
+        for event_id, registrations_list in registrations.items():
+            if event_id not in events:
+                continue
+            for registration in registrations_list:
+                self.by_participant.setdefault(registration.participant_name, []).append((events[event_id], registration))
+
+    def setting(self, key, default=None):
+        return self.settings.get(key, default)
+
+    def int_setting(self, key, default=0):
+        value = self.settings.get(key)
+        return int(value) if value is not None else default
+
+    def open_allocation(self, week):
+        """Allocation window of a week while registrations are collected as preferences, or None"""
+        allocation = self.allocations.get(week)
+        return allocation if allocation and allocation['status'] == 'open' else None
+
+    def week_events(self, week):
+        """Events of a week, ordered by day and start time"""
+        days = self.by_week.get(week, {})
+        return [event for day in sorted(days, key=day_rank) for event in days[day]]
+
+    def event_registrations(self, event_id):
+        return self.registrations.get(event_id, [])
+
+    def participant_events(self, name):
+        """[(event, registration)] of a participant, ordered by day and start time"""
+        return sorted(self.by_participant.get(name, []),
+                      key=lambda item: (day_rank(item[0].day), item[0].start_time))
+
+    def participants(self):
+        """Names with at least one registration, in alphabetical order"""
+        return sorted(self.by_participant)
+
+    def snapshot(self, event_id):
+        """Same shape as the event snapshots of the change feed (None if the event does not exist)"""
+        event = self.events.get(event_id)
+        if event is None:
+            return None
+        registrations = self.event_registrations(event_id)
+        return dict(event.to_dict(),
+                    participants=[r.participant_name for r in registrations],
+                    absent=[r.participant_name for r in registrations if r.is_absent])
+
+
+class ReadModel:
+    """
+    Keeps a PoolState in memory and in sync with the database.
+
+    `sync()` reads the change feed after the last applied seq and re-reads
+    only the events, weeks, settings, whitelist or allocations it names. The web process
+    calls it at the end of every write request; the background loop calls it
+    too, to pick up writes made by other processes. Users are not in the
+    change feed: login updates them with `sync(users=[login])`.
+
+    `check()` compares the model with a full read of the database and
+    replaces it on a mismatch.
+    """
+
+    def __init__(self, db_path):
+        """
+        Initialize the read model (the state is loaded on first use).
+
+        Args:
+            db_path: Path to SQLite database
+        """
+        self.db_path = db_path
+        self.state = None
+        self.seq = 0
+        self._lock = threading.Lock()
+        self.loaded_at = None
+        self.syncs = 0
+        self.checks = 0
+        self.mismatches = 0
+        self.last_check_at = None
+
+    def _connect(self):
+        return sqlite3.connect(self.db_path, timeout=30)
+
+    def snapshot(self):
+        """Return the current PoolState, loading it if needed"""
+        state = self.state
+        if state is None:
+            state = self.load()
+        return state
+
+    # Database reads
+
+    def _read_seq(self, c):
+        return run(c, 'changes_head').fetchone()[0]
+
+    def _read_settings(self, c):
+        c.execute("SELECT key, value FROM settings")
+        return dict(c.fetchall())
+
+    def _read_events(self, c, event_ids=None, weeks=None):
+        where, params = None, []
+        if event_ids is not None or weeks is not None:
+            event_ids, weeks = list(event_ids or []), list(weeks or [])
+            where = (f"id IN ({','.join('?' * len(event_ids))})"
+                     f" OR week IN ({','.join('?' * len(weeks))})")
+            params = event_ids + weeks
+        return {event.id: event for event in fetch_all(c, Event, where, params)}
+
+    def _read_registrations(self, c, event_ids=None):
+        where, params = None, []
+        if event_ids is not None:
+            params = list(event_ids)
+            where = f"event_id IN ({','.join('?' * len(params))})"
+        registrations = {}
+        for registration in fetch_all(c, Registration, where, params, order_by='registration_date, id'):
+            registrations.setdefault(registration.event_id, []).append(registration)
+        return registrations
+
+    def _read_whitelist(self, c):
+        c.execute("SELECT id, intra_login, added_at FROM baywatcher_whitelist ORDER BY intra_login")
+        return [{'id': w[0], 'login': w[1], 'added_at': w[2]} for w in c.fetchall()]
+
+    def _read_users(self, c, logins=None):
+        where, params = None, []
+        if logins is not None:
+            params = list(logins)
+            where = f"login IN ({','.join('?' * len(params))})"
+        return {user.login: user for user in fetch_all(c, User, where, params)}
+
+    def _read_allocations(self, c):
+        c.execute("SELECT week, closes_at, status FROM week_allocations")
+        return {row[0]: {'closes_at': row[1], 'status': row[2]} for row in c.fetchall()}
+
+    def _read_all(self, c):
+        return PoolState(self._read_settings(c), self._read_events(c), self._read_registrations(c),
+                         self._read_whitelist(c), self._read_users(c), self._read_allocations(c))
+
+    # Updates
+
+    def load(self):
+        """Read the whole model from the database"""
+        with self._lock:
+            conn = self._connect()
+            try:
+                c = conn.cursor()
+                # seq first: changes committed during the read are applied again by the next sync
+                seq = self._read_seq(c)
+                self.state = self._read_all(c)
+                self.seq = seq
+                self.loaded_at = datetime.now()
+            finally:
+                conn.close()
+            logger.info(f"📚 Read model loaded: {len(self.state.events)} events, "
+                        f"{sum(len(r) for r in self.state.registrations.values())} registrations")
+            return self.state
+
+    def sync(self, users=()):
+        """
+        Apply the change feed entries after the last applied seq, and re-read
+        the `users` (logins). Returns the number of entries applied.
+        """
+        if self.state is None:
+            self.load()
+            return 0
+
+        with self._lock:
+            conn = self._connect()
+            try:
+                c = conn.cursor()
+                floor_row = run(c, 'setting_get', ('changes_floor',)).fetchone()
+                if floor_row and int(floor_row[0]) > self.seq:
+                    # Entries compacted away by retention: the only safe option is a full reload
+                    self.seq = self._read_seq(c)
+                    self.state = self._read_all(c)
+                    self.loaded_at = datetime.now()
+                    return 0
+
+                changes = run(c, 'changes_after', (self.seq,)).fetchall()
+                if not changes and not users:
+                    return 0
+
+                state = self.state
+                event_ids, weeks = set(), set()
+                all_events = reload_settings = reload_whitelist = reload_allocations = False
+                for seq, entity, entity_id in changes:
+                    if entity == 'event':
+                        if entity_id is None:
+                            all_events = True
+                        else:
+                            event_ids.add(int(entity_id))
+                    elif entity == 'week':
+                        weeks.add(int(entity_id))
+                    elif entity == 'setting':
+                        reload_settings = True
+                    elif entity == 'whitelist':
+                        reload_whitelist = True
+                    elif entity == 'allocation':
+                        reload_allocations = True
+
+                events, registrations = state.events, state.registrations
+                if all_events:
+                    events, registrations = self._read_events(c), self._read_registrations(c)
+                elif event_ids or weeks:
+                    stale = event_ids | {event_id for event_id, event in events.items() if event.week in weeks}
+                    events = {k: v for k, v in events.items() if k not in stale}
+                    registrations = {k: v for k, v in registrations.items() if k not in stale}
+                    fresh = self._read_events(c, event_ids, weeks)
+                    events.update(fresh)
+                    registrations.update(self._read_registrations(c, fresh))
+
+                users_by_login = state.users
+                if users:
+                    users_by_login = dict(users_by_login)
+                    for login in users:
+                        users_by_login.pop(login, None)
+                    users_by_login.update(self._read_users(c, users))
+
+                self.state = PoolState(
+                    self._read_settings(c) if reload_settings else state.settings,
+                    events,
+                    registrations,
+                    self._read_whitelist(c) if reload_whitelist else state.whitelist,
+                    users_by_login,
+                    self._read_allocations(c) if reload_allocations else state.allocations
+                )
+                if changes:
+                    self.seq = changes[-1][0]
+                self.syncs += 1
+                return len(changes)
+            finally:
+                conn.close()
+
+    def _differences(self, fresh):
+        current = self.state
+        return [name for name in PoolState.BASE
+                if current is None or getattr(current, name) != getattr(fresh, name)]
+
+    def check(self):
+        """
+        Compare the model with the database and return the parts that differ.
+
+        A write committed but not yet synced looks like a difference, so the
+        model is synced first and a mismatch is reported only if it persists.
+        On a mismatch the model is replaced with the fresh read.
+        """
+        self.sync()
+        with self._lock:
+            conn = self._connect()
+            try:
+                c = conn.cursor()
+                seq = self._read_seq(c)
+                fresh = self._read_all(c)
+            finally:
+                conn.close()
+
+            self.checks += 1
+            self.last_check_at = datetime.now()
+            if seq != self.seq:
+                # Writes landed during the check: compare again next time
+                return []
+            differences = self._differences(fresh)
+            if differences:
+                self.mismatches += 1
+                logger.warning(f"⚠️ Read model out of sync with the database ({', '.join(differences)}): reloaded")
+                self.state = fresh
+                self.loaded_at = datetime.now()
+            return differences
+
+    def stats(self):
+        """Return size and sync counters"""
+        state = self.state
+        return {
+            'loaded_at': self.loaded_at.isoformat() if self.loaded_at else None,
+            'seq': self.seq,
+            'events': len(state.events) if state else 0,
+            'registrations': sum(len(r) for r in state.registrations.values()) if state else 0,
+            'whitelist': len(state.whitelist) if state else 0,
+            'syncs': self.syncs,
+            'checks': self.checks,
+            'mismatches': self.mismatches,
+            'last_check_at': self.last_check_at.isoformat() if self.last_check_at else None
+        }
@@ -0,0 +1,273 @@
+"""
+Retention engine: declarative cleanup policies for rows that are no longer needed.
+Each policy deletes in small batches so the database is never locked for long.
+"""
+
+import os
+import sqlite3
+import logging
+from datetime import datetime, timedelta
+
+logger = logging.getLogger(__name__)
+
+# Policies run in this order. `where` selects the rows to delete from `table`
+# and can use the named parameters :now, :today, :cutoff (now - max_age_days)
+# and the policy's own 'params'. A policy with max_age_days set to 0 is disabled.
+RETENTION_POLICIES = [
+    {
+        'name': 'orphaned_notifications',
+        'table': 'scheduled_notifications',
+        'description': 'Reminders whose event or registration was deleted',
+        'where': """
+            NOT EXISTS (SELECT 1 FROM events e WHERE e.id = scheduled_notifications.event_id)
+            OR NOT EXISTS (SELECT 1 FROM registrations r WHERE r.id = scheduled_notifications.registration_id)
+        """
+    },
+    {
+        'name': 'orphaned_waitlist',
+        'table': 'waitlist',
+        'description': 'Waitlist entries of deleted events',
+        'where': "NOT EXISTS (SELECT 1 FROM events e WHERE e.id = waitlist.event_id)"
+    },
+    {
+        'name': 'past_unsent_notifications',
+        'table': 'scheduled_notifications',
+        'description': 'Unsent reminders for events that already took place',
+        'where': """
+            sent = 0 AND event_id IN (SELECT id FROM events WHERE event_date < :today)
+        """
+    },
+    {
+        'name': 'sent_notifications',
+        'table': 'scheduled_notifications',
+        'description': 'Reminders sent more than max_age_days ago',
+        'max_age_days': 7,
+        'where': "sent = 1 AND sent_at < :cutoff"
+    },
+    {
+        'name': 'orphaned_push_subscriptions',
+        'table': 'push_subscriptions',
+        'description': 'Push subscriptions of users that no longer exist',
+        'where': "NOT EXISTS (SELECT 1 FROM users u WHERE u.intra_id = push_subscriptions.user_id)"
+    },
+    {
+        'name': 'failing_push_subscriptions',
+        'table': 'push_subscriptions',
+        'description': 'Push subscriptions that failed max_failures times in a row',
+        'params': {'max_failures': 5},
+        'where': "failure_count >= :max_failures"
+    },
+    {
+        'name': 'old_templates',
+        'table': 'week_templates',
+        'description': 'Week templates created more than max_age_days ago (disabled by default)',
+        'max_age_days': 0,
+        'where': "created_at < :cutoff"
+    },
+    {
+        'name': 'orphaned_template_events',
+        'table': 'template_events',
+        'description': 'Template events whose template was deleted',
+        'where': "NOT EXISTS (SELECT 1 FROM week_templates wt WHERE wt.id = template_events.template_id)"
+    },
+    {
+        'name': 'finished_jobs',
+        'table': 'job_queue',
+        'description': 'Done or failed jobs finished more than max_age_days ago',
+        'max_age_days': 7,
+        'where': "status IN ('done', 'failed') AND finished_at < :cutoff"
+    },
+    {
+        'name': 'old_broadcast_failures',
+        'table': 'broadcast_failures',
+        'description': 'Broadcast delivery failures older than max_age_days',
+        'max_age_days': 30,
+        'where': "created_at < :cutoff"
+    },
+    {
+        'name': 'expired_idempotency_keys',
+        'table': 'idempotency_keys',
+        'description': 'Idempotency keys whose outcome is no longer replayed',
+        'where': "expires_at < :now"
+    },
+    {
+        'name': 'superseded_changes',
+        'table': 'changes',
+        'description': 'Change feed entries replaced by a newer entry for the same entity',
+        'where': """
+            entity_id IS NOT NULL AND EXISTS (
+                SELECT 1 FROM changes n
+                WHERE n.entity = changes.entity AND n.entity_id = changes.entity_id AND n.seq > changes.seq
+            )
+        """
+    },
+    {
+        'name': 'old_changes',
+        'table': 'changes',
+        'description': 'Change feed entries older than max_age_days (clients behind them reload)',
+        'max_age_days': 7,
+        'where': "created_at < :cutoff"
+    }
+]
+
+
+class RetentionEngine:
+    """
+    Runs the retention policies incrementally.
+
+    Every run deletes at most `batch_size` rows per statement and at most
+    `max_batches` batches per policy; policies that still have rows left are
+    flagged as backlog and continue on the next run. Counters are kept in
+    the `retention_stats` table.
+    """
+
+    def __init__(self, db_path, policies=None, batch_size=500, max_batches=20, overrides=None):
+        """
+        Initialize the engine.
+
+        Args:
+            db_path: Path to SQLite database
+            policies: List of policy dicts (default: RETENTION_POLICIES)
+            batch_size: Rows deleted per transaction
+            max_batches: Transactions per policy and run
+            overrides: Optional {policy name: dict} merged into the policies,
+                e.g. {'old_templates': {'max_age_days': 365}}
+        """
+        self.db_path = db_path
+        self.batch_size = batch_size
+        self.max_batches = max_batches
+        self.policies = []
+        for policy in policies or RETENTION_POLICIES:
+            policy = dict(policy)
+            policy.update((overrides or {}).get(policy['name'], {}))
+            self.policies.append(policy)
+
+    @staticmethod
+    def _params(policy, now):
+        params = {'now': now, 'today': now.strftime('%Y-%m-%d'), **policy.get('params', {})}
+        if 'max_age_days' in policy:
+            params['cutoff'] = now - timedelta(days=policy['max_age_days'])
+        return params
+
+    @staticmethod
+    def _enabled(policy):
+        return policy.get('max_age_days') != 0
+
+    def run(self):
+        """
+        Run every enabled policy within the batch budget.
+        Returns {policy name: rows deleted in this run}.
+        """
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        c = conn.cursor()
+
+        deleted = {}
+        backlog = set()
+
+        try:
+            for policy in self.policies:
+                if not self._enabled(policy):
+                    continue
+
+                table = policy['table']
+                params = self._params(policy, datetime.now())
+                params['batch_size'] = self.batch_size
+                count = 0
+
+                for _ in range(self.max_batches):
+                    try:
+                        c.execute(f"""
+                            DELETE FROM {table} WHERE rowid IN (
+                                SELECT rowid FROM {table} WHERE {policy['where']} LIMIT :batch_size
+                            )
+                        """, params)
+                    except sqlite3.OperationalError as e:
+                        # Table not created yet (e.g. feature never used)
+                        logger.warning(f"⚠️ Retention policy '{policy['name']}' skipped: {e}")
+                        break
+                    conn.commit()
+
+                    count += c.rowcount
+                    if c.rowcount < self.batch_size:
+                        break
+                else:
+                    backlog.add(policy['name'])
+
+                deleted[policy['name']] = count
+
+            now = datetime.now()
+            c.executemany("""
+                INSERT INTO retention_stats (policy, last_run_at, last_deleted, total_deleted, backlog)
+                VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT(policy) DO UPDATE SET
+                    last_run_at = excluded.last_run_at,
+                    last_deleted = excluded.last_deleted,
+                    total_deleted = retention_stats.total_deleted + excluded.last_deleted,
+                    backlog = excluded.backlog
+            """, [(name, now, count, count, int(name in backlog)) for name, count in deleted.items()])
+            conn.commit()
+        finally:
+            conn.close()
+
+        if any(deleted.values()):
+            summary = ', '.join(f"{name}={count}" for name, count in deleted.items() if count)
+            logger.info(f"🧹 Retention: {summary}{' (backlog left)' if backlog else ''}")
+        return deleted
+
+    def pending_counts(self):
+        """Return {policy name: rows currently matching the policy} for enabled policies."""
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        c = conn.cursor()
+        counts = {}
+        now = datetime.now()
+        try:
+            for policy in self.policies:
+                if not self._enabled(policy):
+                    continue
+                try:
+                    c.execute(f"SELECT COUNT(*) FROM {policy['table']} WHERE {policy['where']}",
+                              self._params(policy, now))
+                    counts[policy['name']] = c.fetchone()[0]
+                except sqlite3.OperationalError:
+                    counts[policy['name']] = None
+        finally:
+            conn.close()
+        return counts
+
+    def stats(self):
+        """Return the stored counters, one dict per policy, in policy order."""
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        conn.row_factory = sqlite3.Row
+        c = conn.cursor()
+        c.execute("SELECT * FROM retention_stats")
+        rows = {row['policy']: dict(row) for row in c.fetchall()}
+        conn.close()
+
+        return [
+            {
+                'policy': policy['name'],
+                'table': policy['table'],
+                'description': policy['description'],
+                'enabled': self._enabled(policy),
+                'max_age_days': policy.get('max_age_days'),
+                'params': policy.get('params', {}),
+                'last_run_at': rows.get(policy['name'], {}).get('last_run_at'),
+                'last_deleted': rows.get(policy['name'], {}).get('last_deleted', 0),
+                'total_deleted': rows.get(policy['name'], {}).get('total_deleted', 0),
+                'backlog': bool(rows.get(policy['name'], {}).get('backlog', 0))
+            }
+            for policy in self.policies
+        ]
+
+
+def retention_from_env(db_path):
+    """Build a RetentionEngine configured by RETENTION_*, TEMPLATE_RETENTION_DAYS and PUSH_MAX_FAILURES."""
+    return RetentionEngine(
+        db_path,
+        batch_size=int(os.getenv('RETENTION_BATCH_SIZE', '500')),
+        max_batches=int(os.getenv('RETENTION_MAX_BATCHES', '20')),
+        overrides={
+            'old_templates': {'max_age_days': int(os.getenv('TEMPLATE_RETENTION_DAYS', '0'))},
+            'failing_push_subscriptions': {'params': {'max_failures': int(os.getenv('PUSH_MAX_FAILURES', '5'))}}
+        }
+    )
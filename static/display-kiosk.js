@@ -0,0 +1,192 @@
+/**
+ * Display Kiosk
+ * The /display/kiosk page is loaded once: event deltas and week rollovers are
+ * pushed over Socket.IO and applied to the grid, the rotation with the
+ * monitoring page happens in the browser.
+ */
+
+(function () {
+    const config = window.KIOSK;
+    const MONTHS = ['Gen', 'Feb', 'Mar', 'Apr', 'Mag', 'Giu', 'Lug', 'Ago', 'Set', 'Ott', 'Nov', 'Dic'];
+
+    let displayWeek = config.state.display_week;
+    let dayDates = config.state.day_dates || {};
+    // Event id -> snapshot (participants, absent, ...)
+    let events = {};
+    let rolloverTimer = null;
+
+    function setState(state) {
+        displayWeek = state.display_week;
+        dayDates = state.day_dates || {};
+        events = {};
+        state.events.forEach((event) => { events[event.id] = event; });
+        render();
+    }
+
+    function reload() {
+        return fetch('/display/data')
+            .then((response) => response.json())
+            .then(setState)
+            .catch((error) => console.error('❌ Kiosk reload failed:', error));
+    }
+
+    // Same rules as the event_type_class Jinja filter
+    function eventTypeClass(title) {
+        const t = (title || '').toLowerCase();
+        if (t.includes('esam') || t.includes('sorveglianza')) return 'event-type-esame';
+        if (t.includes('icebreaker')) return 'event-type-icebreaker';
+        if (t.includes('rush') || t.includes('correzion')) return 'event-type-rush';
+        if (t.includes('cluster') || t.includes('presenza')) return 'event-type-cluster';
+        if (t.includes('accoglienza')) return 'event-type-accoglienza';
+        return 'event-type-custom';
+    }
+
+    function formatDate(date) {
+        const parts = (date || '').split('-');
+        return parts.length === 3 ? `${parseInt(parts[2], 10)} ${MONTHS[parseInt(parts[1], 10) - 1]}` : (date || '');
+    }
+
+    function eventEnd(event) {
+        const date = event.event_date || dayDates[event.day];
+        if (!date || !event.end_time) {
+            return null;
+        }
+        return new Date(`${date}T${event.end_time}:00`);
+    }
+
+    function element(tag, className, text) {
+        const node = document.createElement(tag);
+        if (className) node.className = className;
+        if (text !== undefined) node.textContent = text;
+        return node;
+    }
+
+    function renderEvent(event, now) {
+        const visible = event.participants.filter((name) => !event.absent.includes(name));
+        const end = eventEnd(event);
+        const isPassed = end !== null && now > end;
+        const available = event.max_slots - visible.length;
+
+        const card = element('div', `display-event ${eventTypeClass(event.title)} ${available > 0 && !isPassed ? 'available' : 'unavailable'}`);
+        card.appendChild(element('div', 'display-event-title', event.title));
+        card.appendChild(element('div', 'display-event-time', `🕐 ${event.start_time} - ${event.end_time}`));
+
+        const info = element('div', 'display-event-info');
+        const left = element('div', 'display-event-left');
+        if (isPassed) {
+            left.appendChild(element('span', 'display-slots passed', '⏰ Scaduto'));
+        } else if (available > 0) {
+            left.appendChild(element('span', 'display-slots available', `👥 ${visible.length}/${event.max_slots} (${available} liberi)`));
+        } else {
+            left.appendChild(element('span', 'display-slots full', `⚠️ Pieno (${event.max_slots}/${event.max_slots})`));
+        }
+        info.appendChild(left);
+
+        if (visible.length) {
+            const right = element('div', 'display-event-right');
+            const wrapper = element('div', 'display-participants');
+            const list = element('div', 'display-participants-list');
+            visible.forEach((name) => list.appendChild(element('span', 'display-participant-badge', name)));
+            wrapper.appendChild(list);
+            right.appendChild(wrapper);
+            info.appendChild(right);
+        }
+        card.appendChild(info);
+        return card;
+    }
+
+    function render() {
+        const now = new Date();
+        document.getElementById('displayWeekBadge').textContent = `Week ${displayWeek}`;
+        document.querySelectorAll('[data-day-date]').forEach((node) => {
+            const date = dayDates[node.dataset.dayDate];
+            node.textContent = date ? formatDate(date) : '';
+        });
+
+        config.days.forEach((day) => {
+            const cell = document.querySelector(`td[data-day="${day}"]`);
+            const dayEvents = Object.values(events)
+                .filter((event) => event.day === day)
+                .sort((a, b) => a.start_time.localeCompare(b.start_time));
+            cell.replaceChildren();
+            if (!dayEvents.length) {
+                const empty = element('div', 'display-empty');
+                empty.append('📭', document.createElement('br'), 'Nessun evento');
+                cell.appendChild(empty);
+                return;
+            }
+            dayEvents.forEach((event) => cell.appendChild(renderEvent(event, now)));
+        });
+        scheduleRollover();
+    }
+
+    // When the last event of the week ends, ask the server once: it moves the display to the next week
+    function scheduleRollover() {
+        clearTimeout(rolloverTimer);
+        const ends = Object.values(events).map(eventEnd).filter((end) => end !== null);
+        if (!ends.length) {
+            return;
+        }
+        const delay = Math.max(...ends) - Date.now();
+        if (delay > 0 && delay < 2147483647) {
+            rolloverTimer = setTimeout(reload, delay + 5000);
+        }
+    }
+
+    function addUnique(list, names) {
+        (names || []).forEach((name) => { if (!list.includes(name)) list.push(name); });
+    }
+
+    function applyEventUpdate(data) {
+        if (data.action === 'delete' || data.week !== displayWeek) {
+            if (!(data.id in events)) {
+                return;
+            }
+            delete events[data.id];
+            render();
+            return;
+        }
+
+        const current = events[data.id] || { participants: [], absent: [] };
+        const next = Object.assign({}, current, data);
+        // Compact messages carry diffs instead of full lists; both are applied idempotently
+        ['participants', 'absent'].forEach((key) => {
+            const list = Array.isArray(data[key]) ? data[key].slice() : current[key].slice();
+            addUnique(list, data[`${key}_added`]);
+            const removed = data[`${key}_removed`] || [];
+            next[key] = list.filter((name) => !removed.includes(name));
+            delete next[`${key}_added`];
+            delete next[`${key}_removed`];
+        });
+        events[data.id] = next;
+        render();
+    }
+
+    const live = new LiveUpdates({ channels: ['display'], onResync: reload });
+    live.on('event_update', applyEventUpdate);
+    live.on('display_week', reload);
+    live.on('week_changed', (data) => {
+        if (data.week === null || data.week === displayWeek) {
+            reload();
+        }
+    });
+
+    // "Passed" and availability depend on the clock: repaint every minute without any request
+    setInterval(render, 60000);
+
+    // Rotation with the monitoring page
+    const frame = document.getElementById('kioskRotateFrame');
+    if (frame && config.rotateUrl) {
+        const period = config.rotateSeconds * 1000;
+        let showingFrame = false;
+        setInterval(() => {
+            showingFrame = !showingFrame;
+            if (showingFrame) {
+                frame.src = config.rotateUrl;
+            }
+            frame.style.display = showingFrame ? 'block' : 'none';
+        }, period);
+    }
+
+    setState(config.state);
+})();
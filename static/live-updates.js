@@ -0,0 +1,86 @@
+/**
+ * Live Updates
+ * Socket.IO connection that resumes from the last received message after a reconnect.
+ * Missed messages are replayed by the server; if they are no longer available
+ * the 'resync' handler runs (default: reload the page).
+ * By default the compact wire format is requested (short keys, participant
+ * diffs): handlers always receive messages with the full key names.
+ */
+
+class LiveUpdates {
+    constructor(options = {}) {
+        const state = window.LIVE_STATE || {};
+        this.epoch = state.epoch || null;
+        this.seq = state.seq || 0;
+        this.handlers = {};
+        this.onResync = options.onResync || (() => location.reload());
+        this.format = options.format || 'compact';
+        // Extra server channels, e.g. ['display'] for the kiosk
+        this.channels = options.channels || [];
+        // Short key -> full key
+        this.keys = {};
+        Object.entries(state.keys || {}).forEach(([full, short]) => { this.keys[short] = full; });
+        // Transport order comes from the server policy (SOCKETIO_TRANSPORT)
+        this.transports = state.transports || ['polling', 'websocket'];
+        this.socket = io({ transports: this.transports, rememberUpgrade: true });
+
+        // WebSocket blocked (proxy, firewall): retry with long-polling first
+        this.socket.on('connect_error', () => {
+            if (this.transports[0] === 'websocket' && this.transports.includes('polling')) {
+                console.warn('⚠️ WebSocket unavailable, falling back to long-polling');
+                this.socket.io.opts.transports = ['polling', 'websocket'];
+            }
+        });
+
+        // On connect (and every reconnect) ask for the messages missed since the last seq
+        this.socket.on('connect', () => {
+            this.socket.emit('resume', { epoch: this.epoch, seq: this.seq, format: this.format, channels: this.channels });
+        });
+
+        this.socket.on('resync', (head) => {
+            console.warn('🔄 Live updates gap too large, resyncing');
+            this.epoch = head.epoch;
+            this.seq = head.seq;
+            this.onResync(head);
+        });
+
+        // Single dispatcher: drops duplicates (live + replay) and advances the seq
+        // also for messages this page does not handle
+        this.socket.onAny((event, data) => {
+            data = this.expand(data);
+            if (data && typeof data.seq === 'number') {
+                if (data.seq <= this.seq) {
+                    return;
+                }
+                this.seq = data.seq;
+            }
+            const handler = this.handlers[event];
+            if (handler) {
+                handler(data);
+            }
+        });
+    }
+
+    /**
+     * Convert a compact message (short keys) back to full key names.
+     * Full-format messages (e.g. admin-only ones) are returned as they are.
+     */
+    expand(data) {
+        if (!data || typeof data !== 'object' || data.seq !== undefined || data.s === undefined) {
+            return data;
+        }
+        const expanded = {};
+        Object.entries(data).forEach(([key, value]) => {
+            expanded[this.keys[key] || key] = value;
+        });
+        return expanded;
+    }
+
+    /**
+     * Register the handler of a sequenced server message
+     */
+    on(event, handler) {
+        this.handlers[event] = handler;
+        return this;
+    }
+}
@@ -41,6 +41,10 @@ class PushNotificationManager {
 
             if (this.isSubscribed) {
                 console.log('User is already subscribed to push notifications');
+                // The browser may have rotated the endpoint: tell the server to replace the old one
+                if (localStorage.getItem('push-endpoint') !== subscription.endpoint) {
+                    await this.sendSubscription(subscription);
+                }
             }
 
             return true;
@@ -72,28 +76,57 @@ class PushNotificationManager {
             console.log('User is subscribed:', subscription);
 
             // Send subscription to server
-            const response = await fetch('/api/push/subscribe', {
-                method: 'POST',
-                headers: {
-                    'Content-Type': 'application/json'
-                },
-                body: JSON.stringify(subscription.toJSON())
-            });
-
-            if (response.ok) {
+            if (await this.sendSubscription(subscription)) {
                 this.isSubscribed = true;
-                console.log('Subscription sent to server successfully');
                 return true;
-            } else {
-                console.error('Failed to send subscription to server');
-                return false;
             }
+            return false;
         } catch (error) {
             console.error('Error subscribing to push notifications:', error);
             return false;
         }
     }
 
+    /**
+     * Send a subscription to the server, replacing the endpoint previously used by this browser
+     */
+    async sendSubscription(subscription) {
+        const previousEndpoint = localStorage.getItem('push-endpoint');
+        const payload = subscription.toJSON();
+        if (previousEndpoint && previousEndpoint !== subscription.endpoint) {
+            payload.previous_endpoint = previousEndpoint;
+        }
+
+        const response = await fetch('/api/push/subscribe', {
+            method: 'POST',
+            headers: {
+                'Content-Type': 'application/json'
+            },
+            body: JSON.stringify(payload)
+        });
+
+        if (!response.ok) {
+            console.error('Failed to send subscription to server');
+            return false;
+        }
+        localStorage.setItem('push-endpoint', subscription.endpoint);
+        console.log('Subscription sent to server successfully');
+        return true;
+    }
+
+    /**
+     * Endpoint of this browser's subscription, or null
+     */
+    async currentEndpoint() {
+        const registration = this.swRegistration
+            || ('serviceWorker' in navigator ? await navigator.serviceWorker.getRegistration('/') : null);
+        if (!registration) {
+            return null;
+        }
+        const subscription = await registration.pushManager.getSubscription();
+        return subscription ? subscription.endpoint : null;
+    }
+
     /**
      * Unsubscribe from push notifications
      */
@@ -119,6 +152,7 @@ class PushNotificationManager {
             });
 
             this.isSubscribed = false;
+            localStorage.removeItem('push-endpoint');
             console.log('User unsubscribed from push notifications');
             return true;
         } catch (error) {
@@ -165,7 +199,7 @@ class PushNotificationManager {
         // You can customize this prompt UI
         const enable = confirm(
             '🔔 Vuoi ricevere notifiche per gli eventi a cui ti iscrivi?\n\n' +
-            'Ti avviseremo 24 ore e 1 ora prima di ogni evento.'
+            'Di default ti avviseremo 24 ore e 1 ora prima di ogni evento (puoi cambiarlo dal profilo).'
         );
 
         if (enable) {